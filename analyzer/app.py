@@ -1,6 +1,9 @@
-import connexion, yaml, logging, logging.config, json, os 
+import connexion, yaml, logging, logging.config, json, os, atexit, time
+import httpx
+from concurrent.futures import ThreadPoolExecutor
 from flask import jsonify  
-from pykafka import KafkaClient
+from event_index import EventIndex, MAX_PREFIX_WIDTH
+import wire_format
 # from sqlalchemy import create_engine, select
 
 from connexion.middleware import MiddlewarePosition
@@ -18,6 +21,27 @@ with open('config/log_conf_dev.yml', 'r') as f:
 
 logger = logging.getLogger('basicLogger')
 
+# Topic of each event type, and the legacy events topic while it is still read
+EVENT_TYPES = ["energy-consumption", "solar-generation"]
+event_topics = list(dict.fromkeys(app_config['kafka']['topics'][event_type] for event_type in EVENT_TYPES))
+if app_config['kafka'].get('dual_read', False):
+    event_topics.append(app_config['kafka']['events']['topic'])
+
+# Index of the events of the topics, kept up to date by a background consumer per topic
+event_index = EventIndex(
+    f"{app_config['kafka']['events']['hostname']}:{app_config['kafka']['events']['port']}",
+    event_topics,
+    EVENT_TYPES,
+    app_config['datastore']['filename'],
+    app_config['kafka'].get('broker_version', '0.9.0')
+)
+if event_index.load():
+    logger.info(f"Event index restored from snapshot: {event_index.next_offset}")
+
+# Trace lookups ask storage and the anomaly detector while the event is read from Kafka
+http_client = httpx.Client(timeout=app_config['trace']['timeout_s'])
+trace_executor = ThreadPoolExecutor(max_workers=app_config['trace']['workers'], thread_name_prefix="trace")
+
 def get_energy_consumption_event(index):
     """  
     Endpoint to retrieve an event of type 'EnergyConsumption'.  
@@ -33,29 +57,17 @@ def get_solar_generation_event(index):
 def get_event(event_type, index):  
     """  
     Retrieve a specific event from the Kafka queue based on the index and event type. 
-     
+    The index gives the topic, partition and offset of the event, which is then fetched on its own.
     """
     try:  
-        client = KafkaClient(hosts=f"{app_config['kafka']['events']['hostname']}:{app_config['kafka']['events']['port']}")
-        topic = client.topics[app_config['kafka']["events"]["topic"].encode()]
-        consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-        counter = 0  
-        for msg in consumer:  
-            if msg is None:  
-                break  
-
-            message = msg.value.decode("utf-8")  
-            data = json.loads(message) 
-
-            # Filter events by type and match the requested index  
-            if data["type"] == event_type:  
-                if counter == index:  
-                    logger.info(data["payload"])
-                    return jsonify(data["payload"]), 200  
-                counter += 1  
-
-        # If the index is not found  
-        return {"message": f"No message at index {index} for {event_type}!"}, 404  
+        location = event_index.lookup(event_type, index)
+        data = event_index.fetch(*location) if location is not None else None
+        if data is None:
+            # If the index is not found  
+            return {"message": f"No message at index {index} for {event_type}!"}, 404  
+
+        logger.info(data["payload"])
+        return jsonify(data["payload"]), 200  
 
     except Exception as e:  
         logger.error(f"Error retrieving event: {e}")  
@@ -67,25 +79,10 @@ def get_event_stats():
     """  
     logger.info("Retrieving event statistics")
     try:  
-        client = KafkaClient(hosts=f"{app_config['kafka']['events']['hostname']}:{app_config['kafka']['events']['port']}")
-        topic = client.topics[app_config['kafka']["events"]["topic"].encode()]  
-        consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)  
-
-        stats = {"num_energy_consumption": 0, "num_solar_generation": 0}  
-
-        for msg in consumer:
-            if msg is None:  
-                break  
-
-            message = msg.value.decode("utf-8")  
-            data = json.loads(message)  
-
-            # Increment counters based on event type  
-            if data["type"] == "energy-consumption":
-                stats["num_energy_consumption"] += 1
-            elif data["type"] == "solar-generation":
-                stats["num_solar_generation"] += 1
-
+        stats = {
+            "num_energy_consumption": event_index.count("energy-consumption"),
+            "num_solar_generation": event_index.count("solar-generation")
+        }
         logger.info(stats)
         return jsonify(stats), 200
 
@@ -93,20 +90,19 @@ def get_event_stats():
         logger.error(f"Error retrieving stats: {e}")
         return {"message": "Internal server error"}, 500
     
-def get_event_ids(event_type):
+def get_event_ids(event_type, prefix=None, after=0, before=None, since=None):
     """
-    Retrieve all event IDs and trace IDs for a given event type.
+    Retrieve all event IDs and trace IDs for a given event type, optionally only
+    those of the trace IDs starting with a prefix, or from the `after`-th event
+    up to the `before`-th one, or of the events sent since a date/time.
     """
-    logger.info(f"Fetching event IDs and trace IDs for {event_type}")
+    logger.info(f"Fetching event IDs and trace IDs for {event_type} (prefix={prefix}, after={after}, before={before}, since={since})")
     try:
-        event_ids = []
-        events = get_event()
-        for msg in events:
-            message = msg.value.decode("utf-8")
-            data = json.loads(message)
-            if data["type"] == event_type:
-                event_ids.append({"event_id": data["payload"] ["event_id"], "trace_id": data["payload"]["trace_id"]})
-
+        since_seconds = None if since is None else wire_format.datetime_seconds(since)
+    except ValueError:
+        return {"message": f"since is not an ISO 8601 date/time: {since}"}, 400
+    try:
+        event_ids = event_index.ids(event_type, prefix, after, before, since_seconds)
         logger.info(f"Event IDs retrieved successfully for {event_type}: {len(event_ids)} events")
         return jsonify(event_ids), 200
 
@@ -115,18 +111,110 @@ def get_event_ids(event_type):
         return {"error": "Internal server error"}, 500
 
 # New endpoints for fetching event IDs and trace IDs
-def get_energy_consumption_ids():
+def get_energy_consumption_ids(prefix=None, after=0, before=None, since=None):
     """
     Retrieve event IDs and trace IDs for energy-consumption events from Kafka.
     """
-    return get_event_ids("energy-consumption")
+    return get_event_ids("energy-consumption", prefix, after, before, since)
 
 
-def get_solar_generation_ids():
+def get_solar_generation_ids(prefix=None, after=0, before=None, since=None):
     """
     Retrieve event IDs and trace IDs for solar-generation events from Kafka.
     """
-    return get_event_ids("solar-generation")
+    return get_event_ids("solar-generation", prefix, after, before, since)
+
+def get_digests(event_type, prefix="", width=None, before=None, since=None):
+    """
+    Range digests of the trace IDs of an event type: count and hash per trace ID
+    prefix bucket, to compare with the digests of storage without listing IDs.
+    """
+    width = len(prefix) + 1 if width is None else width
+    if not len(prefix) < width <= MAX_PREFIX_WIDTH:
+        return {"message": f"width must be between {len(prefix) + 1} and {MAX_PREFIX_WIDTH}"}, 400
+    try:
+        since_seconds = None if since is None else wire_format.datetime_seconds(since)
+    except ValueError:
+        return {"message": f"since is not an ISO 8601 date/time: {since}"}, 400
+    try:
+        buckets = event_index.digests(event_type, prefix, width, before, since_seconds)
+        return jsonify({
+            "prefix": prefix,
+            "width": width,
+            "buckets": [
+                {"prefix": bucket, "count": count, "digest": f"{digest:016x}"}
+                for bucket, (count, digest) in sorted(buckets.items())
+            ]
+        }), 200
+    except Exception as e:
+        logger.error(f"Error computing digests for {event_type}: {e}")
+        return {"message": "Internal server error"}, 500
+
+def get_stored_trace(trace_id):
+    """Returns: the event of a trace ID stored by storage with its database id, or None"""
+    response = http_client.get(f"{app_config['storage']['url']}/trace/{trace_id}")
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    stored = response.json()
+    return {"event_type": stored["event_type"], "db_id": stored["db_id"], "event": stored["event"]}
+
+def get_trace_anomalies(trace_id):
+    """Returns: the anomalies found for the event of a trace ID"""
+    response = http_client.get(f"{app_config['anomaly_detector']['url']}/anomalies",
+                               params={"trace_id": trace_id, "limit": 10000})
+    if response.status_code == 204:
+        return []
+    response.raise_for_status()
+    return response.json()
+
+def get_trace(trace_id):
+    """
+    Follows the event of a trace ID end to end: its position in the Kafka topic
+    (from the in-memory trace index) and the event read at that offset, its row
+    in storage and its anomalies. Storage and the anomaly detector are asked
+    concurrently with the Kafka fetch; a service that fails is listed in errors.
+    """
+    start = time.time()
+    stored = trace_executor.submit(get_stored_trace, trace_id)
+    anomalies = trace_executor.submit(get_trace_anomalies, trace_id)
+    result = {"trace_id": trace_id, "event_type": None, "queue": None, "db": None, "anomalies": [], "errors": []}
+
+    try:
+        location = event_index.find(trace_id)
+        if location is not None:
+            event_type, index, topic, partition, offset = location
+            data = event_index.fetch(topic, partition, offset)
+            result["event_type"] = event_type
+            result["queue"] = {
+                "index": index,
+                "topic": topic,
+                "partition": partition,
+                "offset": offset,
+                "event": data["payload"] if data is not None else None
+            }
+    except Exception as e:
+        logger.error(f"Error reading the event of trace {trace_id} from Kafka: {e}")
+        result["errors"].append(f"kafka: {e}")
+    for service, future in (("storage", stored), ("anomaly_detector", anomalies)):
+        try:
+            value = future.result()
+        except Exception as e:
+            logger.error(f"Error looking up trace {trace_id} in {service}: {e}")
+            result["errors"].append(f"{service}: {e}")
+            continue
+        if service == "storage":
+            result["db"] = value
+            if value is not None:
+                result["event_type"] = result["event_type"] or value["event_type"]
+        else:
+            result["anomalies"] = value
+
+    result["processing_time_ms"] = int((time.time() - start) * 1000)
+    logger.info(f"Trace {trace_id} looked up in {result['processing_time_ms']}ms")
+    if result["queue"] is None and result["db"] is None and not result["anomalies"] and not result["errors"]:
+        return {"message": f"No event with trace ID {trace_id}"}, 404
+    return jsonify(result), 200
 
 # Create the Connexion app  
 app = connexion.FlaskApp(__name__, specification_dir='')
@@ -144,4 +232,6 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     )
 
 if __name__ == "__main__":  
+    event_index.start(app_config['datastore']['snapshot_interval'])
+    atexit.register(event_index.save)
     app.run(port=8110, host="0.0.0.0")
\ No newline at end of file
@@ -0,0 +1,450 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from array import array
+from datetime import datetime, timezone
+from threading import Thread, Lock
+
+import numpy as np
+from pykafka import KafkaClient
+from pykafka.common import OffsetType
+from pykafka.exceptions import KafkaException
+
+import wire_format
+
+logger = logging.getLogger('basicLogger')
+
+# Bytes of a UUID in the id stores
+UUID_SIZE = 16
+# Longest trace_id prefix of a digest bucket: the hex digits before the first hyphen
+MAX_PREFIX_WIDTH = 8
+# Events appended since the trace_id hashes were last sorted, scanned by trace lookups until merged in
+MAX_UNSORTED = 4096
+
+class EventIndex:
+    """
+    Index of the events in the Kafka topics: maps (event type, ordinal) to the
+    (topic, partition, offset) of the message, and keeps the event id and
+    trace id of every event as 16-byte UUIDs. A background consumer per topic
+    tails it and appends each new message to the compact arrays of its type,
+    so counts and id lists are answered from memory and looking an event up
+    is an array access plus a single fetch at that offset. The index is
+    snapshotted to disk with the next offset of each partition, so a restart
+    resumes from the snapshot instead of offset 0. A 64-bit hash of each
+    trace_id is kept alongside, for the range digests, with the envelope
+    datetime of each event, so id lists and digests can be limited to the
+    events storage still keeps. Trace lookups search a sorted copy of the
+    hashes of each type, with the ordinal of each hash, merging the events
+    appended since into it once there are MAX_UNSORTED of them. Id lists and
+    digests filter and bucket the events with numpy over copies of these
+    arrays.
+
+    Topics are numbered in the order they were first indexed, and a topic no
+    longer tailed keeps its events, so the ordinals of the events do not
+    change when the legacy events topic stops being read.
+    """
+    def __init__(self, hostname, topics, event_types, snapshot_file=None, broker_version="0.9.0"):
+        self.hostname = hostname
+        self.tailed_topics = list(topics)
+        # Every topic with indexed events: the topic of an event is a position in this list
+        self.topics = list(topics)
+        self.broker_version = broker_version
+        self.snapshot_file = snapshot_file
+        self.topic_positions = {event_type: array('b') for event_type in event_types}
+        self.partitions = {event_type: array('i') for event_type in event_types}
+        self.offsets = {event_type: array('q') for event_type in event_types}
+        self.event_ids = {event_type: bytearray() for event_type in event_types}
+        self.trace_ids = {event_type: bytearray() for event_type in event_types}
+        self.trace_hashes = {event_type: array('Q') for event_type in event_types}
+        # Envelope datetime of each event, in seconds since the epoch
+        self.times = {event_type: array('q') for event_type in event_types}
+        self.event_types = list(event_types)
+        # trace_id hashes of the first events of each type in order, and the ordinal of each
+        self.sorted_hashes = {event_type: np.zeros(0, dtype=np.uint64) for event_type in event_types}
+        self.sorted_ordinals = {event_type: np.zeros(0, dtype=np.int64) for event_type in event_types}
+        # (topic, partition) -> next offset to index
+        self.next_offset = {}
+        self.changed = False
+        self.lock = Lock()
+        self.fetch_lock = Lock()
+        self.client_lock = Lock()
+        self.client = None
+        self.readers = {}
+
+    def start(self, snapshot_interval=None):
+        """Starts tailing the topics, and snapshotting the index, in daemon threads"""
+        for topic in self.tailed_topics:
+            t = Thread(target=self.run, args=(topic,), name=f"event-index-{topic}", daemon=True)
+            t.start()
+        if self.snapshot_file is not None and snapshot_interval:
+            t = Thread(target=self.snapshot_loop, args=(snapshot_interval,), name="event-index-snapshot", daemon=True)
+            t.start()
+
+    def connect(self, topic_name):
+        """Infinite loop: will keep trying. Returns: the topic"""
+        while True:
+            logger.debug("Trying to connect to Kafka...")
+            try:
+                with self.client_lock:
+                    if self.client is None:
+                        # LZ4 uses the standard frame format from broker version 0.10.0 on
+                        self.client = KafkaClient(hosts=self.hostname, broker_version=self.broker_version)
+                        logger.info("Kafka client created")
+                    client = self.client
+                return client.topics[str.encode(topic_name)]
+            except KafkaException as e:
+                logger.warning(f"Kafka error when making client: {e}")
+                self.reset_client()
+            # Sleeps for a random amount of time (0.5 to 1.5s)
+            time.sleep(random.randint(500, 1500) / 1000)
+
+    def reset_client(self):
+        with self.client_lock:
+            self.client = None
+            self.readers = {}
+
+    def run(self, topic_name):
+        """Indexes every message of a topic, then each new one as it arrives"""
+        while True:
+            topic = self.connect(topic_name)
+            try:
+                consumer = topic.get_simple_consumer(
+                    auto_offset_reset=OffsetType.EARLIEST,
+                    reset_offset_on_start=True
+                )
+                # Resume after the last message indexed of each partition
+                with self.lock:
+                    resume = {
+                        partition: offset for (name, partition), offset in self.next_offset.items()
+                        if name == topic_name
+                    }
+                if resume:
+                    consumer.reset_offsets([
+                        (topic.partitions[partition], offset - 1)
+                        for partition, offset in resume.items()
+                    ])
+                for msg in consumer:
+                    if msg is not None:
+                        self.add(msg, topic_name)
+            except KafkaException as e:
+                logger.warning(f"Kafka issue in event index consumer of {topic_name}: {e}")
+                self.reset_client()
+
+    def add(self, msg, topic_name):
+        """Appends a message of a topic to the index of its event type"""
+        try:
+            # Binary messages give their ids without being decoded
+            ids = wire_format.decode_ids(msg.value)
+            if ids is None:
+                data = wire_format.decode(msg.value)
+                payload = data.get("payload", {})
+                ids = (data["type"], uuid_bytes(payload.get("uuid")), uuid_bytes(payload.get("trace_id")),
+                       sent_seconds(data.get("datetime")))
+            event_type, event_id, trace_id, sent = ids
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.error(f"Skipping malformed message of {topic_name} at offset {msg.offset}: {e}")
+            with self.lock:
+                self.next_offset[(topic_name, msg.partition_id)] = msg.offset + 1
+            return
+        with self.lock:
+            self.next_offset[(topic_name, msg.partition_id)] = msg.offset + 1
+            self.changed = True
+            if event_type not in self.offsets:
+                return
+            self.topic_positions[event_type].append(self.topics.index(topic_name))
+            self.partitions[event_type].append(msg.partition_id)
+            self.offsets[event_type].append(msg.offset)
+            self.event_ids[event_type] += event_id
+            self.trace_ids[event_type] += trace_id
+            self.trace_hashes[event_type].append(trace_hash(wire_format.format_uuid(trace_id)))
+            self.times[event_type].append(sent)
+
+    def count(self, event_type):
+        with self.lock:
+            return len(self.offsets[event_type])
+
+    def ids(self, event_type, prefix=None, after=0, before=None, since=None):
+        """
+        Returns: the event id and trace id of the events of a type from ordinal
+        `after` up to (excluding) `before`, in topic order, only of the
+        trace_ids starting with `prefix` when it is given, and of the events
+        sent at or after `since` (seconds since the epoch) when it is given
+        """
+        end = None if before is None else before * UUID_SIZE
+        with self.lock:
+            event_ids = bytes(self.event_ids[event_type][after * UUID_SIZE:end])
+            trace_ids = bytes(self.trace_ids[event_type][after * UUID_SIZE:end])
+            times = self.times[event_type][after:before]
+        prefixes = trace_prefixes(trace_ids)
+        matched = prefix_mask(prefixes, prefix or "")
+        if since is not None:
+            matched &= np.frombuffer(times, dtype=np.int64) >= since
+        return [
+            {
+                "event_id": wire_format.format_uuid(event_ids[i:i + UUID_SIZE]),
+                "trace_id": wire_format.format_uuid(trace_ids[i:i + UUID_SIZE])
+            }
+            for i in (np.flatnonzero(matched) * UUID_SIZE).tolist()
+        ]
+
+    def digests(self, event_type, prefix, width, before=None, since=None):
+        """
+        Range digests of the trace_ids of a type starting with `prefix`,
+        bucketed by their first `width` hex digits: the count and the XOR of
+        the trace_id hashes of each bucket, which does not depend on order.
+        Only the events before ordinal `before`, and sent at or after `since`
+        (seconds since the epoch), when they are given.
+        Returns: {bucket prefix: (count, digest)}
+        """
+        with self.lock:
+            trace_ids = bytes(self.trace_ids[event_type][:None if before is None else before * UUID_SIZE])
+            hashes = self.trace_hashes[event_type][:before]
+            times = self.times[event_type][:before]
+        prefixes = trace_prefixes(trace_ids)
+        matched = prefix_mask(prefixes, prefix)
+        if since is not None:
+            matched &= np.frombuffer(times, dtype=np.int64) >= since
+        # Sorted by bucket, each bucket is a run: XOR-reduced from its first index
+        buckets = prefixes[matched] >> (32 - 4 * width)
+        order = np.argsort(buckets, kind='stable')
+        buckets = buckets[order]
+        if not len(buckets):
+            return {}
+        hashes = np.frombuffer(hashes, dtype=np.uint64)[matched][order]
+        keys, starts, counts = np.unique(buckets, return_index=True, return_counts=True)
+        digests = np.bitwise_xor.reduceat(hashes, starts)
+        return {
+            f"{bucket:0{width}x}": (count, digest)
+            for bucket, count, digest in zip(keys.tolist(), counts.tolist(), digests.tolist())
+        }
+
+    def find(self, trace_id):
+        """
+        Returns: (event type, ordinal, topic, partition, offset) of the event
+        of a trace_id, the first one sent of a trace_id sent twice, or None if
+        it is not in the topics
+        """
+        try:
+            key = uuid.UUID(trace_id).bytes
+        except (ValueError, TypeError, AttributeError):
+            return None
+        if key == bytes(UUID_SIZE):
+            return None
+        wanted = np.uint64(trace_hash(wire_format.format_uuid(key)))
+        found = None
+        with self.lock:
+            for event_type in self.event_types:
+                ordinal = self.find_ordinal(event_type, key, wanted)
+                if ordinal is None:
+                    continue
+                if found is None or self.times[event_type][ordinal] < self.times[found[0]][found[1]]:
+                    found = (event_type, ordinal)
+            if found is None:
+                return None
+            event_type, ordinal = found
+            return (event_type, ordinal, self.topics[self.topic_positions[event_type][ordinal]],
+                    self.partitions[event_type][ordinal], self.offsets[event_type][ordinal])
+
+    def find_ordinal(self, event_type, key, wanted):
+        """
+        Searches the sorted hashes of a type, then the ones appended since,
+        for the hash of a trace_id, checking the trace_id of each match against
+        hash collisions. Called with the lock held.
+        Returns: the first ordinal of the trace_id in the type, or None
+        """
+        if len(self.trace_hashes[event_type]) - len(self.sorted_hashes[event_type]) > MAX_UNSORTED:
+            self.sort_hashes(event_type)
+        sorted_hashes = self.sorted_hashes[event_type]
+        start = np.searchsorted(sorted_hashes, wanted, side='left')
+        end = np.searchsorted(sorted_hashes, wanted, side='right')
+        # Equal hashes keep their ordinals in order, before the unsorted ones
+        candidates = self.sorted_ordinals[event_type][start:end].tolist()
+        unsorted = np.frombuffer(self.trace_hashes[event_type][len(sorted_hashes):], dtype=np.uint64)
+        candidates += (len(sorted_hashes) + np.flatnonzero(unsorted == wanted)).tolist()
+        trace_ids = self.trace_ids[event_type]
+        for ordinal in candidates:
+            if trace_ids[ordinal * UUID_SIZE:(ordinal + 1) * UUID_SIZE] == key:
+                return ordinal
+        return None
+
+    def sort_hashes(self, event_type):
+        """
+        Merges the hashes appended since the last sort into the sorted hashes
+        of a type. Sorted on their own first, they make a second run that the
+        stable sort merges in linear time. Called with the lock held.
+        """
+        sorted_hashes = self.sorted_hashes[event_type]
+        appended = np.frombuffer(self.trace_hashes[event_type][len(sorted_hashes):], dtype=np.uint64)
+        appended_order = np.argsort(appended, kind='stable')
+        hashes = np.concatenate((sorted_hashes, appended[appended_order]))
+        ordinals = np.concatenate((self.sorted_ordinals[event_type], len(sorted_hashes) + appended_order))
+        order = np.argsort(hashes, kind='stable')
+        self.sorted_hashes[event_type] = hashes[order]
+        self.sorted_ordinals[event_type] = ordinals[order]
+
+    def lookup(self, event_type, index):
+        """Returns: (topic, partition, offset) of the event, or None if there is no such event"""
+        with self.lock:
+            if index is None or not 0 <= index < len(self.offsets[event_type]):
+                return None
+            return (self.topics[self.topic_positions[event_type][index]],
+                    self.partitions[event_type][index], self.offsets[event_type][index])
+
+    def fetch(self, topic_name, partition, offset):
+        """
+        Reads the single message at an offset, with a long-lived consumer of
+        that partition. Returns: the decoded message, or None if it is gone
+        """
+        with self.fetch_lock:
+            topic = self.connect(topic_name)
+            reader = self.readers.get((topic_name, partition))
+            if reader is None:
+                reader = topic.get_simple_consumer(
+                    partitions=[topic.partitions[partition]],
+                    consumer_timeout_ms=1000
+                )
+                self.readers[(topic_name, partition)] = reader
+            try:
+                # pykafka resumes after the given offset; EARLIEST for the very first one
+                reader.reset_offsets([(topic.partitions[partition], offset - 1 if offset > 0 else OffsetType.EARLIEST)])
+                while True:
+                    msg = reader.consume(block=True)
+                    if msg is None or msg.offset > offset:
+                        return None
+                    if msg.offset == offset:
+                        return wire_format.decode(msg.value)
+            except KafkaException:
+                # Make a new reader on the next fetch
+                self.readers.pop((topic_name, partition), None)
+                raise
+
+    def snapshot_loop(self, interval):
+        """Snapshots the index every `interval` seconds when it changed"""
+        while True:
+            time.sleep(interval)
+            try:
+                self.save()
+            except Exception as e:
+                logger.error(f"Failed to snapshot the event index: {e}")
+
+    def save(self):
+        """Writes the index to the snapshot file, replacing it atomically"""
+        with self.lock:
+            if not self.changed:
+                return
+            next_offset = {}
+            for (topic, partition), offset in self.next_offset.items():
+                next_offset.setdefault(topic, {})[str(partition)] = offset
+            snapshot = {
+                "topics": self.topics,
+                "next_offset": next_offset,
+                "types": {
+                    event_type: {
+                        "topics": encode_array(self.topic_positions[event_type]),
+                        "partitions": encode_array(self.partitions[event_type]),
+                        "offsets": encode_array(self.offsets[event_type]),
+                        "event_ids": base64.b64encode(self.event_ids[event_type]).decode('ascii'),
+                        "trace_ids": base64.b64encode(self.trace_ids[event_type]).decode('ascii'),
+                        "times": encode_array(self.times[event_type])
+                    }
+                    for event_type in self.offsets
+                }
+            }
+            self.changed = False
+        tmp_file = f"{self.snapshot_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_file, self.snapshot_file)
+        logger.debug("Event index snapshot saved")
+
+    def load(self):
+        """
+        Restores the index from the snapshot file, if any. The topics of the
+        snapshot keep their events; tailed topics it does not know are indexed
+        from their first offset. A snapshot of the single events topic (before
+        per-type topics) is read as the events of that topic. A snapshot
+        without the envelope datetimes of the events is not restored, so the
+        topics are indexed again from their first offset to read them.
+        Returns: True (restored), False (no snapshot)
+        """
+        if self.snapshot_file is None or not os.path.exists(self.snapshot_file):
+            return False
+        with open(self.snapshot_file, 'r') as f:
+            snapshot = json.load(f)
+        if any("times" not in stored for stored in snapshot["types"].values()):
+            logger.info("Event index snapshot has no event datetimes, indexing the topics again")
+            return False
+        if "topics" not in snapshot:
+            snapshot["topics"] = [snapshot["topic"]]
+            snapshot["next_offset"] = {snapshot["topic"]: snapshot["next_offset"]}
+        with self.lock:
+            self.topics = snapshot["topics"] + [topic for topic in self.tailed_topics if topic not in snapshot["topics"]]
+            self.next_offset = {
+                (topic, int(partition)): offset
+                for topic, offsets in snapshot["next_offset"].items()
+                for partition, offset in offsets.items()
+            }
+            for event_type in self.offsets:
+                stored = snapshot["types"].get(event_type)
+                if stored is None:
+                    continue
+                self.partitions[event_type] = decode_array('i', stored["partitions"])
+                if "topics" in stored:
+                    self.topic_positions[event_type] = decode_array('b', stored["topics"])
+                else:
+                    self.topic_positions[event_type] = array('b', bytes(len(self.partitions[event_type])))
+                self.offsets[event_type] = decode_array('q', stored["offsets"])
+                self.event_ids[event_type] = bytearray(base64.b64decode(stored["event_ids"]))
+                self.trace_ids[event_type] = bytearray(base64.b64decode(stored["trace_ids"]))
+                self.times[event_type] = decode_array('q', stored["times"])
+                trace_ids = self.trace_ids[event_type]
+                self.trace_hashes[event_type] = array('Q', (
+                    trace_hash(wire_format.format_uuid(trace_ids[i:i + UUID_SIZE]))
+                    for i in range(0, len(trace_ids), UUID_SIZE)
+                ))
+                # Sorted again on the first trace lookup
+                self.sorted_hashes[event_type] = np.zeros(0, dtype=np.uint64)
+                self.sorted_ordinals[event_type] = np.zeros(0, dtype=np.int64)
+        return True
+
+def uuid_bytes(value):
+    """16 bytes of a UUID string, zeros when it is missing or not a UUID"""
+    try:
+        return uuid.UUID(value).bytes
+    except (ValueError, TypeError, AttributeError):
+        logger.warning(f"Not a UUID, stored as the nil UUID: {value!r}")
+        return bytes(UUID_SIZE)
+
+def trace_prefixes(trace_ids):
+    """First 32 bits (8 hex digits) of each 16-byte trace_id, as a numpy array"""
+    return np.frombuffer(trace_ids, dtype='>u4')[::UUID_SIZE // 4].astype(np.uint32)
+
+def prefix_mask(prefixes, prefix):
+    """Mask of the 32-bit trace_id prefixes starting with the hex digits of `prefix`"""
+    if not prefix:
+        return np.ones(len(prefixes), dtype=bool)
+    return prefixes >> (32 - 4 * len(prefix)) == int(prefix, 16)
+
+def sent_seconds(value):
+    """Seconds since the epoch of the envelope datetime of a JSON message, now when it is missing or malformed"""
+    try:
+        return wire_format.datetime_seconds(value)
+    except (ValueError, TypeError):
+        return wire_format.datetime_seconds(datetime.now(timezone.utc).isoformat())
+
+def trace_hash(trace_id):
+    """64-bit hash of a trace_id: the first 16 hex digits of its MD5, as storage computes it in SQL"""
+    return int(hashlib.md5(trace_id.encode('utf-8')).hexdigest()[:16], 16)
+
+def encode_array(values):
+    return base64.b64encode(values.tobytes()).decode('ascii')
+
+def decode_array(typecode, encoded):
+    values = array(typecode)
+    values.frombytes(base64.b64decode(encoded))
+    return values
@@ -0,0 +1,96 @@
+import os
+import sqlite3
+from datetime import datetime, timezone
+from threading import Lock
+
+class AnomalyStore:
+    """
+    Append-only SQLite store of the anomalies found, indexed by event type,
+    event id and trace id. Anomalies are read back in id order with keyset
+    pagination (after_id, limit). An anomaly is stored once per trace id and
+    anomaly type, or per description when it has no trace id (Stopped
+    Reporting), so the events checked again after a replay add nothing.
+    """
+    def __init__(self, filename):
+        dir_name = os.path.dirname(filename)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        self.lock = Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute('''
+                              CREATE TABLE IF NOT EXISTS anomalies (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                event_id TEXT,
+                                trace_id TEXT,
+                                event_type TEXT NOT NULL,
+                                anomaly_type TEXT NOT NULL,
+                                description TEXT NOT NULL,
+                                date_created TEXT NOT NULL
+                              )
+                              ''')
+            self.conn.execute("CREATE INDEX IF NOT EXISTS ix_anomalies_event_type ON anomalies (event_type, id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS ix_anomalies_event_id ON anomalies (event_id)")
+            if not self.has_index("ux_anomalies_trace_id_anomaly_type"):
+                self.remove_duplicates()
+            # Replaced by the unique index, which starts with trace_id
+            self.conn.execute("DROP INDEX IF EXISTS ix_anomalies_trace_id")
+            self.conn.execute('''
+                              CREATE UNIQUE INDEX IF NOT EXISTS ux_anomalies_trace_id_anomaly_type
+                              ON anomalies (trace_id, anomaly_type)
+                              ''')
+            self.conn.execute('''
+                              CREATE UNIQUE INDEX IF NOT EXISTS ux_anomalies_untraced
+                              ON anomalies (anomaly_type, description) WHERE trace_id IS NULL
+                              ''')
+
+    def has_index(self, name):
+        return self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)).fetchone() is not None
+
+    def remove_duplicates(self):
+        """Keeps the first of the anomalies stored again by replays before the unique indexes existed"""
+        self.conn.execute('''
+                          DELETE FROM anomalies WHERE id NOT IN (
+                            SELECT MIN(id) FROM anomalies
+                            GROUP BY anomaly_type, trace_id, CASE WHEN trace_id IS NULL THEN description END
+                          )
+                          ''')
+
+    def add_many(self, anomalies):
+        """Appends the anomalies not stored yet, in one transaction. Returns: number added"""
+        if not anomalies:
+            return 0
+        date_created = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        with self.lock, self.conn:
+            cursor = self.conn.executemany('''
+                                           INSERT OR IGNORE INTO anomalies (event_id, trace_id, event_type, anomaly_type, description, date_created)
+                                           VALUES (?, ?, ?, ?, ?, ?)
+                                           ''', [
+                (a["event_id"], a["trace_id"], a["event_type"], a["anomaly_type"], a["description"], date_created)
+                for a in anomalies
+            ])
+            return cursor.rowcount
+
+    def query(self, event_type=None, after_id=0, limit=100, trace_id=None):
+        """
+        Returns: up to `limit` anomalies with an id greater than after_id, in
+        id order, only of one trace ID when given (an index lookup)
+        """
+        query = "SELECT id, event_id, trace_id, event_type, anomaly_type, description FROM anomalies WHERE id > ?"
+        params = [after_id]
+        if event_type is not None:
+            query += " AND event_type = ?"
+            params.append(event_type)
+        if trace_id is not None:
+            query += " AND trace_id = ?"
+            params.append(trace_id)
+        query += " ORDER BY id LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(query, params)]
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM anomalies").fetchone()[0]
@@ -1,11 +1,17 @@
 import os
 import logging.config
 import yaml
-import json
 import time
+import atexit
+from threading import Thread, Lock
 from flask import Flask, request, jsonify
 import connexion
 from kafka import KafkaConsumer
+from kafka.errors import KafkaError
+
+from anomaly_store import AnomalyStore
+from rules import RuleEngine
+import wire_format
 
 with open('config/app_conf_dev.yml', 'r') as f:
     app_config = yaml.safe_load(f.read())
@@ -22,97 +28,224 @@ logger.info(f"Anomaly thresholds: ENERGY_CONSUMPTION_MAX={ENERGY_CONSUMPTION_MAX
 
 KAFKA_HOST = app_config['kafka']['events']['hostname']
 KAFKA_PORT = app_config['kafka']['events']['port']
-KAFKA_TOPIC = app_config['kafka']['events']['topic']
+# Topic of each event type, and the legacy events topic while it is still read
+KAFKA_TOPICS = app_config['kafka']['topics']
+KAFKA_LEGACY_TOPIC = app_config['kafka']['events']['topic'] if app_config['kafka'].get('dual_read', False) else None
+KAFKA_GROUP = app_config['kafka']['events']['group_id']
+POLL_TIMEOUT_MS = app_config['kafka']['events']['poll_timeout_ms']
+POLL_MAX_RECORDS = app_config['kafka']['events']['max_records']
+# Longest a PUT /update catches up for, under steady ingest
+CATCH_UP_TIMEOUT_S = app_config['kafka']['events'].get('catch_up_timeout_s', 30)
+# Longest wait before polling again after a failure of the detection loop
+MAX_BACKOFF_S = 30
 DATASTORE_FILE = app_config['datastore']['filename']
+SNAPSHOT_INTERVAL = app_config['device_state']['snapshot_interval']
+
+if app_config['device_state']['max_devices'] < POLL_MAX_RECORDS:
+    raise ValueError("device_state.max_devices must be at least kafka.events.max_records")
 
 EVENT_TYPES = {"energy-consumption", "solar-generation"}
 
-def find_anomalies():
-    consumer = KafkaConsumer(
-        KAFKA_TOPIC,
-        bootstrap_servers=f"{KAFKA_HOST}:{KAFKA_PORT}",
-        value_deserializer=lambda m: json.loads(m.decode('utf-8')),
-        auto_offset_reset='earliest',
-        consumer_timeout_ms=2000
-    )
-    anomalies = []
-    record_id = 1
-    for msg in consumer:
-        data = msg.value
-        evtype = data.get('event_type')
-        if evtype == "energy-consumption":
-            val = data.get('consumption')
-            if val is not None and val > ENERGY_CONSUMPTION_MAX:
-                anomaly = {
-                    "event_id": data.get("event_id"),
-                    "trace_id": data.get("trace_id"),
-                    "event_type": "energy-consumption",
-                    "anomaly_type": "Too High",
-                    "description": f"Detected: {val}; too high (threshold {ENERGY_CONSUMPTION_MAX})"
-                }
-                anomalies.append(anomaly)
-                logger.debug(f"Anomaly detected: {anomaly}")
-                record_id += 1
-        elif evtype == "solar-generation":
-            val = data.get('generation')
-            if val is not None and val < SOLAR_GENERATION_MIN:
-                anomaly = {
-                    "event_id": data.get("event_id"),
-                    "trace_id": data.get("trace_id"),
-                    "event_type": "solar-generation",
-                    "anomaly_type": "Too Low",
-                    "description": f"Detected: {val}; too low (threshold {SOLAR_GENERATION_MIN})"
-                }
-                anomalies.append(anomaly)
+# The env thresholds apply to the device classes that do not set their own
+for device_class in app_config['rules']['device_classes'].values():
+    if device_class['event_type'] == "energy-consumption":
+        device_class.setdefault('threshold', {}).setdefault('max', ENERGY_CONSUMPTION_MAX)
+    elif device_class['event_type'] == "solar-generation":
+        device_class.setdefault('threshold', {}).setdefault('min', SOLAR_GENERATION_MIN)
+
+class AnomalyDetector:
+    """
+    Tails the event topics with a committed consumer group: each poll scores
+    the events that arrived since the last one as a batch, appends the
+    anomalies to the store and then commits the offsets, so a restart resumes
+    where the detector stopped instead of rescanning the topic.
+    """
+    def __init__(self, store, engine):
+        self.store = store
+        self.engine = engine
+        self.consumer = None
+        # KafkaConsumer is not thread safe: the background loop and PUT /update share it
+        self.lock = Lock()
+
+    def connect(self):
+        if self.consumer is None:
+            # Only the topics of the event types that have rules
+            topics = list(dict.fromkeys(KAFKA_TOPICS[event_type] for event_type in self.engine.rules))
+            if KAFKA_LEGACY_TOPIC is not None:
+                topics.append(KAFKA_LEGACY_TOPIC)
+            self.consumer = KafkaConsumer(
+                *topics,
+                bootstrap_servers=f"{KAFKA_HOST}:{KAFKA_PORT}",
+                group_id=KAFKA_GROUP,
+                enable_auto_commit=False,
+                auto_offset_reset='earliest'
+            )
+            logger.info(f"Kafka consumer of {topics} created in group {KAFKA_GROUP}")
+        return self.consumer
+
+    def poll(self):
+        """ Checks the next batch of new events. Returns: (events read, new anomalies stored) """
+        with self.lock:
+            consumer = self.connect()
+            records = consumer.poll(timeout_ms=POLL_TIMEOUT_MS, max_records=POLL_MAX_RECORDS)
+            events = 0
+            batch = []
+            for partition_records in records.values():
+                for msg in partition_records:
+                    events += 1
+                    try:
+                        data = wire_format.decode(msg.value)
+                    except ValueError as e:
+                        logger.error(f"Skipping malformed message at offset {msg.offset}: {e}")
+                        continue
+                    if not isinstance(data, dict):
+                        logger.error(f"Skipping message at offset {msg.offset}: not an event object")
+                        continue
+                    batch.append(data)
+            anomalies = self.engine.score(batch) if batch else []
+            if batch:
+                anomalies.extend(self.engine.check_devices())
+            for anomaly in anomalies:
                 logger.debug(f"Anomaly detected: {anomaly}")
-                record_id += 1
-    consumer.close()
-    return anomalies
+            added = 0
+            if events:
+                # Stored before the commit: a crash in between re-checks the
+                # batch, and the anomalies already stored are ignored
+                added = self.store.add_many(anomalies)
+                consumer.commit()
+            return events, added
+
+    def end_offsets(self):
+        """ Returns: the end offset of each partition assigned to the consumer """
+        with self.lock:
+            consumer = self.connect()
+            return consumer.end_offsets(list(consumer.assignment()))
+
+    def reached(self, targets):
+        """ True once the consumer is at or past the target offset of each partition it still owns """
+        with self.lock:
+            consumer = self.connect()
+            assigned = consumer.assignment()
+            return all(consumer.position(tp) >= offset for tp, offset in targets.items() if tp in assigned)
+
+    def catch_up(self):
+        """
+        Polls up to the end offsets the topics had when catch-up started, so
+        the events arriving meanwhile do not keep it going, and for at most
+        CATCH_UP_TIMEOUT_S. Returns: anomalies found
+        """
+        deadline = time.time() + CATCH_UP_TIMEOUT_S
+        # The first poll joins the group, which assigns the partitions
+        _, found = self.poll()
+        targets = self.end_offsets()
+        while not self.reached(targets):
+            if time.time() >= deadline:
+                logger.warning(f"Catch-up stopped after {CATCH_UP_TIMEOUT_S}s before reaching the end offsets")
+                break
+            _, anomalies = self.poll()
+            found += anomalies
+        return found
+
+    def run(self):
+        """
+        Polls until the process exits. A failure other than Kafka (the
+        anomaly store, the device state) is logged and the batch, which was
+        not committed, is read again after a backoff of up to MAX_BACKOFF_S
+        """
+        last_snapshot = time.time()
+        backoff = 1
+        while True:
+            try:
+                self.poll()
+                backoff = 1
+            except KafkaError as e:
+                logger.warning(f"Kafka issue in anomaly detector: {e}")
+                self.reset()
+                time.sleep(1)
+            except Exception:
+                logger.exception(f"Anomaly detection failed, retrying in {backoff}s")
+                # A new consumer resumes from the last commit, before the failed batch
+                self.reset()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF_S)
+            if time.time() - last_snapshot >= SNAPSHOT_INTERVAL:
+                self.snapshot()
+                last_snapshot = time.time()
+
+    def snapshot(self):
+        """Saves the device state so a restart keeps the device statistics"""
+        with self.lock:
+            try:
+                self.engine.save()
+                logger.debug("Device state snapshot saved")
+            except Exception as e:
+                logger.error(f"Failed to snapshot the device state: {e}")
+
+    def reset(self):
+        with self.lock:
+            if self.consumer is not None:
+                try:
+                    self.consumer.close(autocommit=False)
+                except KafkaError:
+                    pass
+                self.consumer = None
+
+    def start(self):
+        t = Thread(target=self.run, name="anomaly-detector", daemon=True)
+        t.start()
+
+anomaly_store = AnomalyStore(DATASTORE_FILE)
+rule_engine = RuleEngine(app_config['rules'], app_config['device_state'])
+restored = rule_engine.load()
+if restored:
+    logger.info(f"Device state restored for {', '.join(restored)}")
+detector = AnomalyDetector(anomaly_store, rule_engine)
 
 def update_anomalies():
     logger.debug("PUT /update called")
     start = time.time()
-    anomalies = find_anomalies()
     try:
-        os.makedirs(os.path.dirname(DATASTORE_FILE), exist_ok=True)
-        with open(DATASTORE_FILE, 'w') as f:
-            json.dump(anomalies, f, indent=2)
-        elapsed_ms = int((time.time() - start) * 1000)
-        logger.info(f"{len(anomalies)} anomalies found and written to datastore in {elapsed_ms}ms")
+        found = detector.catch_up()
+    except KafkaError as e:
+        logger.error(f"Error reading new events: {e}")
+        detector.reset()
+        return jsonify({"message": "Error reading new events"}), 500
     except Exception as e:
         logger.error(f"Error saving anomalies: {e}")
         return jsonify({"message": "Error saving anomalies"}), 500
-    return jsonify({"anomalies_count": len(anomalies)}), 201
+    elapsed_ms = int((time.time() - start) * 1000)
+    logger.info(f"{found} new anomalies found and written to datastore in {elapsed_ms}ms")
+    return jsonify({"anomalies_count": found}), 201
 
-def get_anomalies(event_type=None):
-    logger.debug(f"GET /anomalies received (event_type={event_type})")
+def get_anomalies(event_type=None, trace_id=None, after_id=0, limit=100):
+    logger.debug(f"GET /anomalies received (event_type={event_type}, trace_id={trace_id}, after_id={after_id}, limit={limit})")
     start = time.time()
+    # Filter by event_type if provided
+    if event_type and event_type not in EVENT_TYPES:
+        return jsonify({"message": "Invalid Event Type, must be energy_consumption or solar_generation"}), 400
     try:
-        with open(DATASTORE_FILE, 'r') as f:
-            anomalies = json.load(f)
-    except FileNotFoundError:
-        logger.error("Datastore missing")
-        return jsonify({"message": "Anomaly datastore not found"}), 404
+        anomalies = anomaly_store.query(event_type, after_id, limit, trace_id)
     except Exception as e:
         logger.error(f"Datastore error: {e}")
         return jsonify({"message": "Datastore is corrupted"}), 404
 
-    # Filter by event_type if provided
-    if event_type:
-        if event_type not in EVENT_TYPES:
-            return jsonify({"message": "Invalid Event Type, must be energy_consumption or solar_generation"}), 400
-        filtered = [a for a in anomalies if a['event_type'] == event_type]
-    else:
-        filtered = anomalies
-
     elapsed_ms = int((time.time() - start) * 1000)
     logger.info(f"Anomalies retrieved in {elapsed_ms}ms")
-    logger.debug(f"GET /anomalies returned {len(filtered)} records")
-    if not filtered:
+    logger.debug(f"GET /anomalies returned {len(anomalies)} records")
+    if not anomalies:
         return '', 204
-    return jsonify(filtered), 200
+    headers = {}
+    if len(anomalies) == limit:
+        headers["X-Next-After-Id"] = str(anomalies[-1]["id"])
+    return jsonify(anomalies), 200, headers
+
+def get_device_state():
+    logger.debug("GET /device-state received")
+    return jsonify(rule_engine.memory_usage()), 200
 
 app = connexion.FlaskApp(__name__, specification_dir='')
 app.add_api('anomaly.yml', base_path="/anomaly_detector", strict_validation=True, validate_responses=True)
 if __name__ == "__main__":
-    app.run(port=8130, host='0.0.0.0')
\ No newline at end of file
+    detector.start()
+    atexit.register(detector.snapshot)
+    app.run(port=8130, host='0.0.0.0')
@@ -0,0 +1,165 @@
+import os
+import sys
+
+import numpy as np
+
+# dtype and empty-slot value of each per-device array
+FIELDS = {
+    "count": (np.int64, 0),
+    "mean": (np.float64, 0.0),
+    "m2": (np.float64, 0.0),
+    "ewma": (np.float64, 0.0),
+    "last": (np.float64, np.nan),
+    "last_seen": (np.float64, 0.0),
+    "device_class": (np.int16, 0),
+    # Set once a device has been reported silent, until it reports again
+    "silent": (np.bool_, False),
+}
+
+class DeviceStateStore:
+    """
+    Bounded state of the devices of one event type, in array slots indexed
+    by device row: count, mean and M2 (Welford) of the readings, their EWMA,
+    the last reading, the time it was taken and the device class.
+
+    Times are reading times, and `clock` is the newest reading seen, so
+    eviction and silence are measured in stream time and replaying old
+    events behaves like the live stream did. Devices silent for longer than
+    `ttl` seconds are evicted; when every slot is taken the least recently
+    seen devices make room for new ones.
+    """
+    def __init__(self, max_devices, ttl, capacity=1024):
+        self.max_devices = max_devices
+        self.ttl = ttl
+        self.clock = 0.0
+        self.evictions = 0
+        self.index = {}
+        self.device_ids = []
+        self.free = []
+        self.allocate(min(capacity, max_devices))
+
+    def allocate(self, capacity):
+        """Empty arrays of `capacity` slots"""
+        for name, (dtype, value) in FIELDS.items():
+            setattr(self, name, np.full(capacity, value, dtype=dtype))
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in FIELDS}
+
+    def grow(self, capacity):
+        extra = capacity - len(self.count)
+        for name, (dtype, value) in FIELDS.items():
+            setattr(self, name, np.concatenate([getattr(self, name), np.full(extra, value, dtype=dtype)]))
+
+    def rows(self, device_ids, device_classes):
+        """
+        Row of each device, giving the devices seen for the first time a slot
+        of their class (a dict of device id to class, default 0)
+        """
+        new_devices = [device_id for device_id in dict.fromkeys(device_ids) if device_id not in self.index]
+        if len(new_devices) > len(self.free) + self.max_devices - len(self.device_ids):
+            known = np.array([self.index[device_id] for device_id in dict.fromkeys(device_ids) if device_id in self.index],
+                             dtype=np.int64)
+            self.evict_oldest(len(new_devices) - len(self.free) - (self.max_devices - len(self.device_ids)), known)
+        for device_id in new_devices:
+            if self.free:
+                row = self.free.pop()
+                self.device_ids[row] = device_id
+            else:
+                row = len(self.device_ids)
+                self.device_ids.append(device_id)
+            self.index[device_id] = row
+        capacity = len(self.count)
+        if len(self.device_ids) > capacity:
+            while capacity < len(self.device_ids):
+                capacity *= 2
+            self.grow(min(capacity, self.max_devices))
+        rows = np.array([self.index[device_id] for device_id in device_ids], dtype=np.int64)
+        for device_id in new_devices:
+            self.device_class[self.index[device_id]] = device_classes.get(device_id, 0)
+        return rows
+
+    def used(self):
+        """Mask of the slots holding a device"""
+        used = np.zeros(len(self.count), dtype=bool)
+        used[:len(self.device_ids)] = True
+        used[self.free] = False
+        return used
+
+    def evict_oldest(self, n, keep):
+        """Evicts the `n` least recently seen devices, except the rows in `keep`"""
+        last_seen = np.where(self.used(), self.last_seen, np.inf)
+        last_seen[keep] = np.inf
+        if n > np.isfinite(last_seen).sum():
+            raise ValueError(f"{n} devices to evict but only {np.isfinite(last_seen).sum()} can be: raise max_devices")
+        self.evict(np.argpartition(last_seen, n - 1)[:n])
+
+    def expire(self):
+        """Evicts the devices silent for longer than the TTL. Returns: number evicted"""
+        expired = np.flatnonzero(self.used() & (self.last_seen < self.clock - self.ttl))
+        self.evict(expired)
+        return len(expired)
+
+    def evict(self, rows):
+        for row in rows:
+            del self.index[self.device_ids[row]]
+            self.device_ids[row] = None
+            self.free.append(int(row))
+        for name, (dtype, value) in FIELDS.items():
+            getattr(self, name)[rows] = value
+        self.evictions += len(rows)
+
+    def silent_devices(self, silent_after):
+        """
+        Devices that stopped reporting: not seen for `silent_after[class]`
+        seconds of stream time, and not already reported.
+        Returns: list of (device id, last seen)
+        """
+        rows = np.flatnonzero(self.used() & ~self.silent
+                              & (self.last_seen < self.clock - silent_after[self.device_class]))
+        self.silent[rows] = True
+        return [(self.device_ids[row], float(self.last_seen[row])) for row in rows]
+
+    def memory_usage(self):
+        """Returns: device and slot counts, and the bytes held by the arrays and the device index"""
+        array_bytes = sum(values.nbytes for values in self.arrays().values())
+        index_bytes = (sys.getsizeof(self.index) + sys.getsizeof(self.device_ids)
+                       + sum(sys.getsizeof(device_id) for device_id in self.index))
+        return {
+            "devices": len(self.index),
+            "slots": len(self.count),
+            "max_devices": self.max_devices,
+            "evictions": self.evictions,
+            "array_bytes": array_bytes,
+            "index_bytes": index_bytes
+        }
+
+    def save(self, filename):
+        """Snapshots the store, replacing the file atomically"""
+        arrays = dict(self.arrays())
+        arrays["device_ids"] = np.array([device_id or "" for device_id in self.device_ids], dtype=str)
+        arrays["clock"] = np.array(self.clock)
+        arrays["evictions"] = np.array(self.evictions)
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_filename, filename)
+
+    def load(self, filename):
+        """
+        Restores a snapshot, dropping the oldest devices if it holds more than
+        max_devices. Returns: True (restored), False (no snapshot)
+        """
+        if not os.path.exists(filename):
+            return False
+        with np.load(filename) as snapshot:
+            for name in FIELDS:
+                setattr(self, name, snapshot[name])
+            self.device_ids = [str(device_id) or None for device_id in snapshot["device_ids"]]
+            self.clock = float(snapshot["clock"])
+            self.evictions = int(snapshot["evictions"])
+        self.index = {device_id: row for row, device_id in enumerate(self.device_ids) if device_id is not None}
+        self.free = [row for row, device_id in enumerate(self.device_ids) if device_id is None]
+        if len(self.index) > self.max_devices:
+            self.evict_oldest(len(self.index) - self.max_devices, np.array([], dtype=np.int64))
+        return True
@@ -0,0 +1,245 @@
+import logging
+from datetime import datetime, timezone
+
+import numpy as np
+
+from device_state import DeviceStateStore
+
+logger = logging.getLogger('basicLogger')
+
+# Reading checked by the rules, and the second reading of the event, per event type
+EVENT_FIELDS = {
+    "energy-consumption": ("energy_consumed", "voltage"),
+    "solar-generation": ("power_generated", "temperature"),
+}
+
+class EventTypeRules:
+    """
+    The rules of one event type, applied to a whole batch of its events at
+    once. Every rule parameter is an array over the device classes of the
+    event type, indexed by the class of each event's device; a parameter
+    missing from a class is NaN, which no comparison passes, so the rule is
+    off for that class.
+    """
+    def __init__(self, event_type, classes, device_classes, max_devices, ttl):
+        self.event_type = event_type
+        self.value_key, self.secondary_key = EVENT_FIELDS[event_type]
+        self.class_names = list(classes)
+        self.device_classes = {
+            device_id: self.class_names.index(name)
+            for device_id, name in device_classes.items() if name in classes
+        }
+        self.state = DeviceStateStore(max_devices, ttl)
+
+        def param(rule, key):
+            return np.array([float(params.get(rule, {}).get(key, np.nan)) for params in classes.values()])
+
+        self.z_threshold = param('z_score', 'threshold')
+        self.z_min_count = param('z_score', 'min_count')
+        self.ewma_alpha = param('ewma', 'alpha')
+        self.ewma_sigma = param('ewma', 'sigma')
+        self.ewma_min_count = param('ewma', 'min_count')
+        self.zero_epsilon = param('drop_to_zero', 'epsilon')
+        self.zero_min_previous = param('drop_to_zero', 'min_previous')
+        self.value_max = param('threshold', 'max')
+        self.value_min = param('threshold', 'min')
+        self.voltage_min = param('voltage', 'min')
+        self.voltage_max = param('voltage', 'max')
+        self.hot_temperature = param('temperature', 'hot')
+        self.hot_min_generation = param('temperature', 'min_generation')
+        self.silent_after = param('stopped_reporting', 'after')
+
+    def score(self, events):
+        """Scores decoded events of this type. Returns: the anomalies found"""
+        device_ids, values, secondary, times, ids = [], [], [], [], []
+        for data in events:
+            payload = data.get("payload", {})
+            try:
+                reading = (payload["device_id"], float(payload[self.value_key]), float(payload[self.secondary_key]),
+                           datetime.fromisoformat(payload["timestamp"]).timestamp())
+            except (KeyError, ValueError, TypeError) as e:
+                logger.error(f"Skipping malformed {self.event_type} event: {e}")
+                continue
+            device_ids.append(reading[0])
+            values.append(reading[1])
+            secondary.append(reading[2])
+            times.append(reading[3])
+            ids.append((payload.get("uuid"), payload.get("trace_id")))
+        if not device_ids:
+            return []
+
+        state = self.state
+        rows = state.rows(device_ids, self.device_classes)
+        classes = state.device_class[rows].astype(np.int64)
+        # Sorted by device then time, so the events of a device are contiguous and in order
+        order = np.lexsort((np.array(times), rows))
+        rows, classes = rows[order], classes[order]
+        x = np.array(values)[order]
+        secondary = np.array(secondary)[order]
+        times = np.array(times)[order]
+        starts = np.r_[True, rows[1:] != rows[:-1]]
+        group = np.cumsum(starts) - 1
+        group_rows = rows[starts]
+        position = np.arange(len(rows)) - np.flatnonzero(starts)[group]
+
+        # Statistics of each device before this batch
+        count = state.count[rows]
+        mean = state.mean[rows]
+        std = np.sqrt(np.divide(state.m2[rows], count - 1, out=np.zeros(len(rows)), where=count > 1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = np.abs(x - mean) / std
+        z_score = (count >= self.z_min_count[classes]) & (std > 0) & (z > self.z_threshold[classes])
+
+        ewma = self.ewma(x, classes, group, group_rows, position, starts)
+        drift = ((count >= self.ewma_min_count[classes]) & (std > 0)
+                 & (np.abs(ewma - mean) > self.ewma_sigma[classes] * std))
+
+        previous = np.r_[np.nan, x[:-1]]
+        previous[starts] = state.last[group_rows]
+        drop = (x <= self.zero_epsilon[classes]) & (previous >= self.zero_min_previous[classes])
+
+        too_high = x > self.value_max[classes]
+        too_low = x < self.value_min[classes]
+        voltage = (secondary < self.voltage_min[classes]) | (secondary > self.voltage_max[classes])
+        hot = (secondary >= self.hot_temperature[classes]) & (x < self.hot_min_generation[classes])
+
+        self.update_state(x, times, ewma, group, group_rows, starts)
+
+        ids = [ids[i] for i in order]
+        anomalies = []
+        def report(mask, anomaly_type, describe):
+            for i in np.flatnonzero(mask):
+                event_id, trace_id = ids[i]
+                anomalies.append({
+                    "event_id": event_id,
+                    "trace_id": trace_id,
+                    "event_type": self.event_type,
+                    "anomaly_type": anomaly_type,
+                    "description": describe(i)
+                })
+        c = classes
+        report(too_high, "Too High", lambda i: f"Detected: {x[i]}; too high (threshold {self.value_max[c[i]]})")
+        report(too_low, "Too Low", lambda i: f"Detected: {x[i]}; too low (threshold {self.value_min[c[i]]})")
+        report(z_score, "Z-Score", lambda i: f"Detected: {x[i]}; z-score {z[i]:.2f} above {self.z_threshold[c[i]]} (mean {mean[i]:.3f}, std {std[i]:.3f})")
+        report(drift, "EWMA Drift", lambda i: f"Detected: EWMA {ewma[i]:.3f} drifted from mean {mean[i]:.3f} by more than {self.ewma_sigma[c[i]]} std")
+        report(drop, "Drop To Zero", lambda i: f"Detected: {x[i]}; dropped to zero from {previous[i]}")
+        report(voltage, "Voltage Out Of Band", lambda i: f"Detected: {secondary[i]}V; outside [{self.voltage_min[c[i]]}, {self.voltage_max[c[i]]}]")
+        report(hot, "Temperature Mismatch", lambda i: f"Detected: {x[i]} generated at {secondary[i]}C; below {self.hot_min_generation[c[i]]} above {self.hot_temperature[c[i]]}C")
+        return anomalies
+
+    def ewma(self, x, classes, group, group_rows, position, starts):
+        """
+        EWMA after each event, ewma_p = alpha * x_p + (1 - alpha) * ewma_p-1,
+        recursed one position at a time over every device of the batch at
+        once: a step is one array operation whatever the number of devices.
+        NaN for the classes without an ewma rule, whose EWMA is not kept.
+        """
+        alpha = self.ewma_alpha[classes]
+        on = ~np.isnan(alpha)
+        result = np.full(len(x), np.nan)
+        if not on.any():
+            return result
+        previous = self.state.ewma[group_rows]
+        # A device seen for the first time, or without an EWMA yet, starts from its first reading
+        current = np.where((self.state.count[group_rows] > 0) & ~np.isnan(previous), previous, x[starts])
+        # Events ordered by their position within their device, the events of a step are contiguous
+        by_position = np.argsort(position, kind='stable')
+        bounds = np.r_[0, np.cumsum(np.bincount(position))]
+        for p in range(len(bounds) - 1):
+            selected = by_position[bounds[p]:bounds[p + 1]]
+            selected = selected[on[selected]]
+            g = group[selected]
+            current[g] = alpha[selected] * x[selected] + (1 - alpha[selected]) * current[g]
+            result[selected] = current[g]
+        return result
+
+    def update_state(self, x, times, ewma, group, group_rows, starts):
+        """Merges the batch into the running statistics (Chan et al. parallel variance)"""
+        state = self.state
+        n_b = np.bincount(group).astype(np.float64)
+        mean_b = np.bincount(group, weights=x) / n_b
+        m2_b = np.bincount(group, weights=(x - mean_b[group]) ** 2)
+        n_a = state.count[group_rows].astype(np.float64)
+        mean_a = state.mean[group_rows]
+        n = n_a + n_b
+        delta = mean_b - mean_a
+        state.mean[group_rows] = mean_a + delta * n_b / n
+        state.m2[group_rows] = state.m2[group_rows] + m2_b + delta ** 2 * n_a * n_b / n
+        state.count[group_rows] = n.astype(np.int64)
+        last = np.r_[starts[1:], True]
+        state.ewma[group_rows] = ewma[last]
+        state.last[group_rows] = x[last]
+        state.last_seen[group_rows] = times[last]
+        state.silent[group_rows] = False
+        state.clock = max(state.clock, times.max())
+
+    def check_devices(self):
+        """
+        Reports the devices that stopped reporting, then evicts the ones
+        silent for longer than the TTL. Returns: the anomalies found
+        """
+        anomalies = [{
+            "event_id": None,
+            "trace_id": None,
+            "event_type": self.event_type,
+            "anomaly_type": "Stopped Reporting",
+            "description": f"Device {device_id} last reported at "
+                           f"{datetime.fromtimestamp(last_seen, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')}"
+        } for device_id, last_seen in self.state.silent_devices(self.silent_after)]
+        expired = self.state.expire()
+        if expired:
+            logger.info(f"Evicted {expired} silent {self.event_type} devices")
+        return anomalies
+
+class RuleEngine:
+    """
+    Scores batches of decoded events with the rules of their event type.
+    Rule parameters are configured per device class; a device uses the class
+    given in `devices`, or the first class of its event type.
+    """
+    def __init__(self, rules_config, state_config):
+        device_classes = rules_config.get('devices') or {}
+        self.state_filename = state_config['filename']
+        self.rules = {}
+        for event_type in EVENT_FIELDS:
+            classes = {
+                name: params for name, params in rules_config['device_classes'].items()
+                if params['event_type'] == event_type
+            }
+            if classes:
+                self.rules[event_type] = EventTypeRules(event_type, classes, device_classes,
+                                                        state_config['max_devices'], state_config['ttl_seconds'])
+
+    def score(self, events):
+        """Returns: the anomalies of a batch of decoded events"""
+        by_type = {}
+        for data in events:
+            by_type.setdefault(data.get("type"), []).append(data)
+        anomalies = []
+        for event_type, batch in by_type.items():
+            rules = self.rules.get(event_type)
+            if rules is not None:
+                anomalies.extend(rules.score(batch))
+        return anomalies
+
+    def check_devices(self):
+        """Returns: the anomalies of the devices that stopped reporting"""
+        anomalies = []
+        for rules in self.rules.values():
+            anomalies.extend(rules.check_devices())
+        return anomalies
+
+    def memory_usage(self):
+        return {event_type: rules.state.memory_usage() for event_type, rules in self.rules.items()}
+
+    def save(self):
+        """Snapshots the device state of every event type"""
+        for event_type, rules in self.rules.items():
+            rules.state.save(self.state_filename.format(event_type=event_type))
+
+    def load(self):
+        """Restores the device state snapshots. Returns: the event types restored"""
+        return [
+            event_type for event_type, rules in self.rules.items()
+            if rules.state.load(self.state_filename.format(event_type=event_type))
+        ]
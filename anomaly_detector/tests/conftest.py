@@ -0,0 +1,9 @@
+"""
+Puts the anomaly detector modules on the import path; the rules are tested
+on their own, without the Kafka consumer of the app
+"""
+import os
+import sys
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR)
@@ -0,0 +1,78 @@
+import uuid
+import warnings
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from rules import EventTypeRules
+
+START = datetime(2025, 1, 9, 12)
+
+def make_rules(alpha=None):
+    params = {"event_type": "energy-consumption"}
+    if alpha is not None:
+        params["ewma"] = {"alpha": alpha, "sigma": 3, "min_count": 10}
+    return EventTypeRules("energy-consumption", {"meter": params}, {}, max_devices=100, ttl=86400)
+
+def make_events(readings):
+    """Events of (device_id, value) readings, one second apart"""
+    return [{
+        "type": "energy-consumption",
+        "payload": {
+            "device_id": device_id,
+            "energy_consumed": value,
+            "voltage": 230.0,
+            "timestamp": (START + timedelta(seconds=i)).isoformat(),
+            "uuid": str(uuid.uuid4()),
+            "trace_id": str(uuid.uuid4())
+        }
+    } for i, (device_id, value) in enumerate(readings)]
+
+def recursive_ewma(values, alpha):
+    ewma = values[0]
+    for value in values:
+        ewma = alpha * value + (1 - alpha) * ewma
+    return ewma
+
+def stored_ewma(rules, device_id):
+    return rules.state.ewma[rules.state.index[device_id]]
+
+@pytest.mark.parametrize("alpha", [0.3, 0.95, 0.999])
+def test_ewma_matches_the_recursion(alpha):
+    rng = np.random.default_rng(1)
+    readings = [("a", float(v)) for v in rng.uniform(0, 50, 200)] + [("b", 1.0), ("b", 2.0), ("b", 3.0)]
+    readings += [("c", float(v)) for v in rng.uniform(0, 50, 300)]
+    rules = make_rules(alpha)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        rules.score(make_events(readings))
+
+    for device_id in "abc":
+        values = [value for device, value in readings if device == device_id]
+        assert stored_ewma(rules, device_id) == pytest.approx(recursive_ewma(values, alpha))
+
+def test_ewma_of_a_quiet_device_after_a_busy_one():
+    rules = make_rules(0.3)
+    rules.score(make_events([("a", 10.0)] * 200 + [("b", 1.0), ("b", 2.0), ("b", 3.0)]))
+
+    assert stored_ewma(rules, "b") == pytest.approx(1.81)
+
+def test_ewma_carries_over_batches():
+    values = [float(v) for v in range(1, 21)]
+    rules = make_rules(0.2)
+    rules.score(make_events([("a", value) for value in values[:7]]))
+    rules.score(make_events([("a", value) for value in values[7:]]))
+
+    assert stored_ewma(rules, "a") == pytest.approx(recursive_ewma(values, 0.2))
+
+def test_ewma_is_not_kept_without_its_rule():
+    rules = make_rules()
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        anomalies = rules.score(make_events([("a", float(v)) for v in range(300)]))
+
+    assert np.isnan(stored_ewma(rules, "a"))
+    assert not [anomaly for anomaly in anomalies if anomaly["anomaly_type"] == "EWMA Drift"]
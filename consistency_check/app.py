@@ -1,8 +1,13 @@
 from flask import jsonify
-import httpx, json, os, logging.config, yaml, connexion, requests
-from datetime import datetime, timezone
+import asyncio, json, os, logging.config, yaml, connexion, sqlite3
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
 import time
 
+from diff import EventDiff
+from history import CheckHistory
+from http_client import ServiceClient
+
 # Load configuration
 with open('config/app_conf_dev.yml', 'r') as f:
     app_config = yaml.safe_load(f.read())
@@ -14,102 +19,351 @@ with open('config/log_conf_dev.yml', 'r') as f:
 
 logger = logging.getLogger('basicLogger')
 
-def request(method, url):
-    event_data = None
-    response = httpx.request(method, url)
-    if response.status_code != 200:
-        logger.error(f"Request for {url} events failed: {response.status_code}")
-    else:
-        event_data = json.loads(response.content.decode("utf-8"))
-        logger.info(f"Request for {url} was successful")
-    return event_data
+# One pooled client for every check: calls are made concurrently on its event loop
+http_config = app_config['http']
+client = ServiceClient(
+    http_config['timeout_s'],
+    http_config['connect_timeout_s'],
+    http_config['retries'],
+    http_config['retry_backoff_s'],
+    http_config['max_connections'],
+    http_config['concurrency']
+)
 
-def update_consistency_check():
-    """Perform consistency checks for event counts and IDs across services."""
-    start_time = time.time()
-    logger.info("Starting consistency check...")
+# Range digests: buckets of trace_id prefixes, recursed into while the two sides differ
+START_WIDTH = app_config['reconcile']['start_width']
+LEAF_SIZE = app_config['reconcile']['leaf_size']
+# Only the events of the last WINDOW_DAYS days are reconciled: storage drops older ones
+WINDOW_DAYS = app_config['reconcile']['window_days']
+MAX_PREFIX_WIDTH = 8
+EVENT_IDS_PATHS = {"analyzer": "event_ids", "storage": "event-ids"}
+EVENT_TYPES = ("energy-consumption", "solar-generation")
+
+# Count keys of each service, per event type
+QUEUE_COUNT_KEYS = {"energy-consumption": "num_energy_consumption", "solar-generation": "num_solar_generation"}
+PROCESSING_COUNT_KEYS = {"energy-consumption": "num_energy_events", "solar-generation": "num_solar_events"}
+DB_COUNT_KEYS = {"energy-consumption": "energy_consumption", "solar-generation": "solar_generation"}
 
+# Incremental checks: a full one every FULL_INTERVAL_HOURS, and storage ids
+# re-read DB_ID_OVERLAP ids below the watermark
+FULL_INTERVAL_HOURS = app_config['incremental']['full_interval_hours']
+DB_ID_OVERLAP = app_config['incremental']['db_id_overlap']
+# Unmatched events are only reported missing once unmatched for SETTLE_S seconds:
+# before that they can still be on their way from Kafka to storage
+SETTLE_S = app_config['incremental']['settle_s']
+
+# History of the runs, and the state the next incremental run starts from
+history = CheckHistory(app_config['datastore']['filename'])
+
+async def gather_or_cancel(*coroutines):
+    """Like asyncio.gather, but cancels the other calls as soon as one fails"""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
     try:
-        # Fetch counts and IDs from services
-        processing_stats = request("GET", f"{app_config['processing']['url']}/stats") or {}
-        analyzer_stats = request("GET", f"{app_config['analyzer']['url']}/stats") or {}
-        analyzer_energy_consumption_ids = request("GET", f"{app_config['analyzer']['url']}/event_ids/energy-consumption") or []
-        analyzer_solar_generation_ids = request("GET", f"{app_config['analyzer']['url']}/event_ids/solar-generation") or []
-        storage_stats = request("GET", f"{app_config['storage']['url']}/count") or {}
-        storage_energy_consumption_ids = request("GET", f"{app_config['storage']['url']}/event_ids/energy-consumption") or []
-        storage_solar_generation_ids = request("GET", f"{app_config['storage']['url']}/event_ids/solar-generation") or []
-
-        logger.info("Successfully fetched stats from services.")
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error during HTTP request to services: {e}")
-        return {"message": "Error fetching data from services"}, 500
-    except json.JSONDecodeError as e:
-        logger.error(f"Error decoding JSON response from services: {e}")
-        return {"message": "Error parsing JSON from services"}, 500
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
 
-    # process counts
-    queue_counts = {
-        "energy-consumption": analyzer_stats.get("num_energy_consumption", 0),
-        "solar-generation": analyzer_stats.get("num_solar_generation", 0)
+async def no_ids():
+    return []
+
+async def fetch_digests(service, event_type, latencies, **params):
+    """Returns: {bucket prefix: (count, digest)} of a service"""
+    data = await client.get_json(
+        service, f"{app_config[service]['url']}/digests/{event_type}?{urlencode(params)}", latencies)
+    return {bucket["prefix"]: (bucket["count"], bucket["digest"]) for bucket in data["buckets"]}
+
+async def fetch_ids(service, event_type, latencies, **params):
+    return await client.get_json(
+        service, f"{app_config[service]['url']}/{EVENT_IDS_PATHS[service]}/{event_type}?{urlencode(params)}", latencies)
+
+async def reconcile(event_type, diff, report, latencies, heads, since, prefix="", width=START_WIDTH):
+    """
+    Compares the digests of the queue (analyzer) and the database (storage)
+    for the trace_id buckets under a prefix, up to the heads read when the
+    run started, of the events sent since a date/time on both sides.
+    Matching buckets are skipped; a differing bucket is recursed into, one
+    more hex digit at a time, until it holds at most LEAF_SIZE events, then
+    its IDs are fetched and diffed. The two sides, and the differing
+    buckets, are fetched concurrently.
+    """
+    queue_head = {"before": heads["queue"][event_type], "since": since}
+    db_head = {"up_to_id": heads["db"][event_type], "since": since}
+    queue, db = await gather_or_cancel(
+        fetch_digests("analyzer", event_type, latencies, prefix=prefix, width=width, **queue_head),
+        fetch_digests("storage", event_type, latencies, prefix=prefix, width=width, **db_head)
+    )
+    report["requests"] += 2
+
+    async def compare_ids(bucket, queue_count, db_count):
+        # Both sides are added together, so a failed call leaves no false misses
+        queue_ids, db_ids = await gather_or_cancel(
+            fetch_ids("analyzer", event_type, latencies, prefix=bucket, **queue_head) if queue_count else no_ids(),
+            fetch_ids("storage", event_type, latencies, prefix=bucket, **db_head) if db_count else no_ids()
+        )
+        report["requests"] += bool(queue_count) + bool(db_count)
+        report["buckets_fetched"] += 1
+        report["ids_fetched"] += len(queue_ids) + len(db_ids)
+        diff.add("queue", queue_ids, event_type)
+        diff.add("db", db_ids, event_type)
+
+    tasks = []
+    for bucket in sorted(queue.keys() | db.keys()):
+        queue_bucket = queue.get(bucket, (0, None))
+        db_bucket = db.get(bucket, (0, None))
+        if queue_bucket == db_bucket:
+            report["buckets_matched"] += 1
+        elif queue_bucket[0] + db_bucket[0] <= LEAF_SIZE or width == MAX_PREFIX_WIDTH:
+            tasks.append(compare_ids(bucket, queue_bucket[0], db_bucket[0]))
+        else:
+            tasks.append(reconcile(event_type, diff, report, latencies, heads, since, bucket, width + 1))
+    await gather_or_cancel(*tasks)
+
+async def gather_named(calls):
+    """
+    Runs named calls concurrently. Returns: the result of each call, None when
+    it failed, and the errors
+    """
+    results = dict(zip(calls, await asyncio.gather(*calls.values(), return_exceptions=True)))
+    errors = []
+    for name, result in results.items():
+        if isinstance(result, Exception):
+            logger.error(f"Consistency check of {name} failed: {result}")
+            errors.append(f"{name}: {result}")
+            results[name] = None
+    return results, errors
+
+def stats_calls(latencies):
+    return {
+        "processing": client.get_json("processing", f"{app_config['processing']['url']}/stats", latencies),
+        "analyzer": client.get_json("analyzer", f"{app_config['analyzer']['url']}/stats", latencies),
+        "storage": client.get_json("storage", f"{app_config['storage']['url']}/count", latencies),
+    }
+
+def queue_heads(analyzer_stats):
+    return {event_type: analyzer_stats[key] for event_type, key in QUEUE_COUNT_KEYS.items()}
+
+def db_heads(storage_stats):
+    return {event_type: storage_stats[f"{key}_last_id"] for event_type, key in DB_COUNT_KEYS.items()}
+
+async def full_check(diff, report, latencies):
+    """
+    Reconciles everything up to the heads of both sides, read first: the
+    analyzer event counts and the highest storage ids, within the last
+    WINDOW_DAYS days. The next incremental run starts from those heads.
+    Returns: (stats, new state, errors)
+    """
+    stats, errors = await gather_named(stats_calls(latencies))
+    if stats["analyzer"] is None or stats["storage"] is None:
+        return stats, None, errors
+    heads = {"queue": queue_heads(stats["analyzer"]), "db": db_heads(stats["storage"])}
+    since = (datetime.now(timezone.utc) - timedelta(days=WINDOW_DAYS)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    calls = {}
+    for event_type in EVENT_TYPES:
+        calls[event_type] = reconcile(event_type, diff, report, latencies, heads, since)
+        # Rows just below the head may still be committing: the next run re-reads them
+        calls[f"{event_type} recent ids"] = fetch_ids(
+            "storage", event_type, latencies, after_id=max(heads["db"][event_type] - DB_ID_OVERLAP, 0),
+            up_to_id=heads["db"][event_type])
+    results, reconcile_errors = await gather_named(calls)
+    errors += reconcile_errors
+    if reconcile_errors:
+        return stats, None, errors
+    state = {
+        "last_full": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        "watermarks": heads,
+        "recent_db_ids": {
+            event_type: [int(event["event_id"]) for event in results[f"{event_type} recent ids"]]
+            for event_type in EVENT_TYPES
+        }
     }
-    processing_count = {
-        "energy-consumption": processing_stats.get("num_energy_consumption", 0),
-        "solar-generation": processing_stats.get("num_solar_generation", 0)
+    return stats, state, errors
+
+async def incremental_check(diff, report, latencies, state):
+    """
+    Checks only the events past the watermarks of the last run, together with
+    the events that run left unmatched. Storage ids are re-read from
+    DB_ID_OVERLAP ids below the watermark, skipping the ones already checked,
+    so rows committed out of id order are not missed. A side that fails keeps
+    its watermark and is caught up on the next run.
+    Returns: (stats, new state, errors)
+    """
+    watermarks = state["watermarks"]
+    recent_db_ids = {event_type: set(ids) for event_type, ids in state["recent_db_ids"].items()}
+    calls = stats_calls(latencies)
+    for event_type in EVENT_TYPES:
+        calls[f"{event_type} queue ids"] = fetch_ids(
+            "analyzer", event_type, latencies, after=watermarks["queue"][event_type])
+        calls[f"{event_type} db ids"] = fetch_ids(
+            "storage", event_type, latencies, after_id=max(watermarks["db"][event_type] - DB_ID_OVERLAP, 0))
+    results, errors = await gather_named(calls)
+    if len(errors) == len(calls):
+        return results, None, errors
+
+    # Events left unmatched by the last run are compared again, with the new ones
+    carried = {side: {} for side in EventDiff.SIDES}
+    for side in EventDiff.SIDES:
+        for event in state["pending"][side]:
+            carried[side].setdefault(event["event_type"], {})[event["trace_id"]] = event
+    for side in EventDiff.SIDES:
+        for event_type, events in carried[side].items():
+            diff.add(side, list(events.values()), event_type)
+
+    new_state = {
+        "last_full": state["last_full"],
+        "watermarks": {side: dict(marks) for side, marks in watermarks.items()},
+        "recent_db_ids": {event_type: sorted(ids) for event_type, ids in recent_db_ids.items()}
     }
+    for event_type in EVENT_TYPES:
+        queue_ids = results[f"{event_type} queue ids"]
+        if queue_ids is not None:
+            carried_queue = carried["queue"].get(event_type, {})
+            diff.add("queue", [event for event in queue_ids if event["trace_id"] not in carried_queue], event_type)
+            new_state["watermarks"]["queue"][event_type] += len(queue_ids)
+            report["ids_fetched"] += len(queue_ids)
+        db_ids = results[f"{event_type} db ids"]
+        if db_ids is not None:
+            carried_db = carried["db"].get(event_type, {})
+            checked = recent_db_ids.get(event_type, set())
+            new_ids = [event for event in db_ids if int(event["event_id"]) not in checked]
+            diff.add("db", [event for event in new_ids if event["trace_id"] not in carried_db], event_type)
+            watermark = max([watermarks["db"][event_type]] + [int(event["event_id"]) for event in db_ids])
+            new_state["watermarks"]["db"][event_type] = watermark
+            new_state["recent_db_ids"][event_type] = sorted(
+                event_id for event_id in checked | {int(event["event_id"]) for event in new_ids}
+                if event_id > watermark - DB_ID_OVERLAP)
+            report["ids_fetched"] += len(db_ids)
+        report["requests"] += 2
+    stats = {name: results[name] for name in ("processing", "analyzer", "storage")}
+    return stats, new_state, errors
+
+def is_full_due(state, full):
+    if full or state is None:
+        return True
+    last_full = datetime.strptime(state["last_full"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - last_full).total_seconds() >= FULL_INTERVAL_HOURS * 3600
+
+def settle(events, previous, now):
+    """
+    Splits the unmatched events of a side into the ones unmatched for at
+    least SETTLE_S seconds, reported missing, and the ones that may still be
+    in flight, only kept pending. Each keeps the time it was first found
+    unmatched (pending events saved without one were unmatched a run ago).
+    Returns: (missing, in flight)
+    """
+    first_seen = {event["trace_id"]: event.get("first_seen", 0) for event in previous}
+    missing, in_flight = [], []
+    for event in events:
+        event = {**event, "first_seen": first_seen.get(event["trace_id"], now)}
+        (missing if now - event["first_seen"] >= SETTLE_S else in_flight).append(event)
+    return missing, in_flight
+
+def type_counts(events):
+    counts = {}
+    for event in events:
+        counts[event["event_type"]] = counts.get(event["event_type"], 0) + 1
+    return counts
 
-    # Compare
-    analyzer_events_ids = analyzer_energy_consumption_ids + analyzer_solar_generation_ids
-    storage_events_ids = storage_energy_consumption_ids + storage_solar_generation_ids
-    missing_in_db = [event for event in analyzer_events_ids if event not in storage_events_ids]
-    missing_in_queue = [event for event in storage_events_ids if event not in analyzer_events_ids]
+def update_consistency_check(full=False):
+    """
+    Perform a consistency check for event counts and IDs across services: an
+    incremental one from the watermarks of the last run, or a full one when
+    asked, on the first run and every FULL_INTERVAL_HOURS.
+    """
+    start_time = time.time()
+    state = history.state()
+    mode = "full" if is_full_due(state, full) else "incremental"
+    logger.info(f"Starting {mode} consistency check...")
+
+    # Compare on trace_id: event ids differ between the queue (uuid) and the database (row id)
+    diff = EventDiff()
+    reconciliation = {"requests": 0, "buckets_matched": 0, "buckets_fetched": 0, "ids_fetched": 0}
+    # Slowest call of each service
+    latencies = {}
+    if mode == "full":
+        stats, new_state, errors = client.run(full_check(diff, reconciliation, latencies))
+    else:
+        stats, new_state, errors = client.run(incremental_check(diff, reconciliation, latencies, state))
+    if new_state is None:
+        # No usable result: the next run starts from the same state
+        logger.error(f"The {mode} consistency check failed: {errors}")
+        return {"message": "Error fetching data from services"}, 500
+    processing_stats = stats["processing"] or {}
+    analyzer_stats = stats["analyzer"] or {}
+    storage_stats = stats["storage"] or {}
+    logger.info(f"Fetched data from services ({len(errors)} failed)")
+
+    # process counts
+    queue_counts = {event_type: analyzer_stats.get(key, 0) for event_type, key in QUEUE_COUNT_KEYS.items()}
+    processing_count = {event_type: processing_stats.get(key, 0) for event_type, key in PROCESSING_COUNT_KEYS.items()}
+    db_counts = {event_type: storage_stats.get(f"{key}_count", 0) for event_type, key in DB_COUNT_KEYS.items()}
+
+    # Every unmatched event stays pending, only the settled ones are reported
+    previous = (state or {}).get("pending", {"queue": [], "db": []})
+    now = int(time.time())
+    missing_in_db, in_flight_queue = settle(diff.missing("db"), previous["queue"], now)
+    missing_in_queue, in_flight_db = settle(diff.missing("queue"), previous["db"], now)
+    new_state["pending"] = {"queue": missing_in_db + in_flight_queue, "db": missing_in_queue + in_flight_db}
+    summary = diff.summary()
+    summary.update(missing_in_db=type_counts(missing_in_db), missing_in_queue=type_counts(missing_in_queue),
+                   in_flight={"queue": type_counts(in_flight_queue), "db": type_counts(in_flight_db)})
 
-    # Save results to JSON file
     last_updated = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
     results = {
         "last_updated": last_updated,
+        "mode": mode,
         "counts": {
             "processing": processing_count,
             "queue": queue_counts,
-            "db": storage_stats,
+            "db": db_counts,
         },
+        "watermarks": new_state["watermarks"],
+        "summary": summary,
+        "reconciliation": reconciliation,
         "missing_in_db": missing_in_db,
         "missing_in_queue": missing_in_queue,
+        "type_mismatches": diff.type_mismatches,
+        "errors": errors,
     }
 
     try:
-        # Ensure directory exists BEFORE writing  
-        data_file = app_config['datastore']['filename']
-        dir_name = os.path.dirname(data_file)
-        if dir_name:
-            os.makedirs(dir_name, exist_ok=True)
-
-        with open(data_file, 'w') as f:
-            json.dump(results, f, indent=4)
-            logger.info("Results successfully saved to datastore.")
-    except IOError as e:
+        history.add_run(results, new_state)
+        logger.info("Results successfully saved to datastore.")
+    except sqlite3.Error as e:
         logger.error(f"Error writing to datastore: {e}")
         return {"message": "Error saving results to datastore"}, 500
 
     processing_time = int((time.time() - start_time) * 1000)
     logger.info(
-        f"Consistency check completed | processing_time_ms={processing_time} | missing_in_db={len(missing_in_db)} | missing_in_queue={len(missing_in_queue)}"
+        f"Consistency check completed | mode={mode} | processing_time_ms={processing_time} | dependencies_ms={latencies} | missing_in_db={len(missing_in_db)} | missing_in_queue={len(missing_in_queue)} | type_mismatch={len(diff.type_mismatches)} | ids_fetched={reconciliation['ids_fetched']}"
     )
 
-    return {"processing_time_ms": processing_time}, 200
+    return {"processing_time_ms": processing_time, "mode": mode, "dependencies_ms": latencies, "errors": errors}, 200
 
-def get_checks():
-    """Fetch the most recent consistency check results."""
+def get_checks(since=None, limit=100):
+    """
+    Fetch the most recent consistency check results, or a summary of every run
+    since a time to follow the drift.
+    """
     try:
-        with open(app_config['datastore']['filename'], 'r') as f:
-            results = json.load(f)
-            logger.debug(results)
-        return results, 200
-    except FileNotFoundError:
+        if since is not None:
+            since = datetime.fromisoformat(since)
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            since = since.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+            return {"runs": history.runs_since(since, limit)}, 200
+        results = history.latest()
+    except ValueError:
+        return {"message": "Invalid since timestamp"}, 400
+    except sqlite3.Error as e:
+        logger.error(f"Error reading from datastore: {e}")
+        return {"message": "Error reading results from datastore"}, 500
+    if results is None:
         logger.warning("No consistency checks have been run yet.")
         return {"message": "No consistency checks found"}, 404
-    except json.JSONDecodeError as e:
-        logger.error(f"Error reading JSON from datastore: {e}")
-        return {"message": "Error reading results from datastore"}, 500
+    logger.debug(results)
+    return results, 200
 
 # Create the Connexion app
 app = connexion.FlaskApp(__name__, specification_dir='')
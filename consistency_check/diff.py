@@ -0,0 +1,66 @@
+class EventDiff:
+    """
+    Diff of the events of the queue and of the database, keyed on trace_id.
+    Both sides can be fed in chunks, in any order: an event whose trace_id is
+    already pending on the other side is matched and dropped, so only the
+    unmatched events (and the matched trace_ids, to count duplicates) are
+    kept. Once both sides are complete, the pending events are the ones
+    missing from the other side.
+    """
+    SIDES = ("queue", "db")
+
+    def __init__(self):
+        # trace_id -> event still unmatched, per side
+        self.pending = {side: {} for side in self.SIDES}
+        self.counts = {side: {} for side in self.SIDES}
+        self.duplicates = {side: 0 for side in self.SIDES}
+        self.matched = 0
+        self.type_mismatches = []
+        # trace_ids already matched, to tell a duplicate from a miss
+        self.seen = set()
+
+    def add(self, side, events, event_type):
+        """Adds a chunk of events of one type ({event_id, trace_id} dicts) to a side"""
+        other = self.pending["db" if side == "queue" else "queue"]
+        pending = self.pending[side]
+        counts = self.counts[side]
+        counts[event_type] = counts.get(event_type, 0) + len(events)
+        for event in events:
+            trace_id = event["trace_id"]
+            match = other.pop(trace_id, None)
+            if match is None:
+                if trace_id in pending or trace_id in self.seen:
+                    self.duplicates[side] += 1
+                else:
+                    pending[trace_id] = (event["event_id"], event_type)
+                continue
+            self.matched += 1
+            self.seen.add(trace_id)
+            if match[1] != event_type:
+                queue_type, db_type = (event_type, match[1]) if side == "queue" else (match[1], event_type)
+                self.type_mismatches.append({"trace_id": trace_id, "queue_type": queue_type, "db_type": db_type})
+
+    def missing(self, side):
+        """Events of the other side that `side` does not have"""
+        other = self.pending["db" if side == "queue" else "queue"]
+        return [
+            {"event_id": event_id, "trace_id": trace_id, "event_type": event_type}
+            for trace_id, (event_id, event_type) in other.items()
+        ]
+
+    def summary(self):
+        """Returns: counts of events per side and type, matches and every kind of mismatch"""
+        missing = {side: {} for side in self.SIDES}
+        for side in self.SIDES:
+            other = self.pending["db" if side == "queue" else "queue"]
+            for _, event_type in other.values():
+                missing[side][event_type] = missing[side].get(event_type, 0) + 1
+        return {
+            "queue": self.counts["queue"],
+            "db": self.counts["db"],
+            "matched": self.matched,
+            "missing_in_db": missing["db"],
+            "missing_in_queue": missing["queue"],
+            "type_mismatch": len(self.type_mismatches),
+            "duplicates": self.duplicates
+        }
@@ -0,0 +1,80 @@
+import json
+import os
+import sqlite3
+from threading import Lock
+
+class CheckHistory:
+    """
+    Append-only SQLite history of the consistency check runs, indexed by
+    time, and the state the next incremental run starts from (watermarks and
+    the events not matched yet).
+    """
+    def __init__(self, filename):
+        dir_name = os.path.dirname(filename)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        self.lock = Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute('''
+                              CREATE TABLE IF NOT EXISTS checks (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                last_updated TEXT NOT NULL,
+                                mode TEXT NOT NULL,
+                                missing_in_db INTEGER NOT NULL,
+                                missing_in_queue INTEGER NOT NULL,
+                                type_mismatch INTEGER NOT NULL,
+                                results TEXT NOT NULL
+                              )
+                              ''')
+            self.conn.execute("CREATE INDEX IF NOT EXISTS ix_checks_last_updated ON checks (last_updated)")
+            self.conn.execute('''
+                              CREATE TABLE IF NOT EXISTS state (
+                                id INTEGER PRIMARY KEY CHECK (id = 1),
+                                value TEXT NOT NULL
+                              )
+                              ''')
+
+    def add_run(self, results, state):
+        """Appends the results of a run and saves the state it leaves, in one transaction"""
+        with self.lock, self.conn:
+            self.conn.execute('''
+                              INSERT INTO checks (last_updated, mode, missing_in_db, missing_in_queue, type_mismatch, results)
+                              VALUES (?, ?, ?, ?, ?, ?)
+                              ''', (results["last_updated"], results["mode"], len(results["missing_in_db"]),
+                                    len(results["missing_in_queue"]), len(results["type_mismatches"]), json.dumps(results)))
+            self.conn.execute("INSERT OR REPLACE INTO state (id, value) VALUES (1, ?)", (json.dumps(state),))
+
+    def latest(self):
+        """Returns: the results of the last run, or None"""
+        with self.lock:
+            row = self.conn.execute("SELECT results FROM checks ORDER BY id DESC LIMIT 1").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def runs_since(self, since, limit):
+        """Returns: a summary of up to `limit` runs since a time (ISO 8601 UTC), oldest first"""
+        with self.lock:
+            rows = self.conn.execute('''
+                                     SELECT last_updated, mode, missing_in_db, missing_in_queue, type_mismatch, results
+                                     FROM checks WHERE last_updated >= ? ORDER BY last_updated LIMIT ?
+                                     ''', (since, limit)).fetchall()
+        runs = []
+        for last_updated, mode, missing_in_db, missing_in_queue, type_mismatch, results in rows:
+            results = json.loads(results)
+            runs.append({
+                "last_updated": last_updated,
+                "mode": mode,
+                "missing_in_db": missing_in_db,
+                "missing_in_queue": missing_in_queue,
+                "type_mismatch": type_mismatch,
+                "counts": results["counts"],
+                "errors": results.get("errors", [])
+            })
+        return runs
+
+    def state(self):
+        """Returns: the state left by the last run, or None before the first one"""
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM state WHERE id = 1").fetchone()
+        return json.loads(row[0]) if row else None
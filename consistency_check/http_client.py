@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import time
+from threading import Thread
+
+import httpx
+
+logger = logging.getLogger('basicLogger')
+
+class ServiceError(Exception):
+    """A service did not return the data needed for the check"""
+
+class ServiceClient:
+    """
+    One pooled httpx.AsyncClient shared by every check, on an event loop
+    running in a daemon thread, so the (synchronous) request handlers can
+    fan their calls out concurrently. Every call has a timeout and is
+    retried with a backoff on connection errors, timeouts and 5xx answers;
+    at most `concurrency` calls are in flight at once.
+    """
+    def __init__(self, timeout, connect_timeout, retries, backoff, max_connections, concurrency):
+        self.retries = retries
+        self.backoff = backoff
+        self.loop = asyncio.new_event_loop()
+        t = Thread(target=self.loop.run_forever, name="http-client", daemon=True)
+        t.start()
+
+        async def setup():
+            self.semaphore = asyncio.Semaphore(concurrency)
+            return httpx.AsyncClient(
+                timeout=httpx.Timeout(timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+            )
+        self.client = self.run(setup())
+
+    def run(self, coroutine):
+        """Runs a coroutine on the client's loop and waits for its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def get_json(self, service, url, latencies):
+        """
+        GETs a URL of a service and decodes its JSON body. The latency of the
+        slowest successful attempt of each service is kept in `latencies`.
+        Raises: ServiceError once the retries are exhausted
+        """
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            start = time.perf_counter()
+            try:
+                async with self.semaphore:
+                    response = await self.client.get(url)
+            except httpx.HTTPError as e:
+                error = f"Request for {url} failed: {e!r}"
+                logger.warning(f"{error} (attempt {attempt + 1})")
+                continue
+            elapsed_ms = int((time.perf_counter() - start) * 1000)
+            if response.status_code >= 500:
+                error = f"Request for {url} failed: {response.status_code}"
+                logger.warning(f"{error} (attempt {attempt + 1})")
+                continue
+            if response.status_code != 200:
+                raise ServiceError(f"Request for {url} failed: {response.status_code}")
+            latencies[service] = max(latencies.get(service, 0), elapsed_ms)
+            logger.debug(f"Request for {url} was successful in {elapsed_ms}ms")
+            try:
+                return response.json()
+            except ValueError as e:
+                raise ServiceError(f"Invalid JSON from {url}: {e}")
+        raise ServiceError(error)
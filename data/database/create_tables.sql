@@ -1,19 +1,70 @@
+-- Partitioned by day of date_created: the storage service splits p_future
+-- into the daily partitions of the coming days when it starts (partitions.py)
 CREATE TABLE IF NOT EXISTS energy_consumption (  
-            id INT AUTO_INCREMENT PRIMARY KEY,   
+            id INT AUTO_INCREMENT,   
             device_id VARCHAR(250) NOT NULL,   
-            timestamp VARCHAR(100) NOT NULL,   
+            timestamp DATETIME NOT NULL,   
             energy_consumed FLOAT NOT NULL,   
             voltage FLOAT NOT NULL,   
-            date_created VARCHAR(100) NOT NULL,
-            trace_id VARCHAR(250) NOT NULL
+            date_created DATETIME NOT NULL,
+            trace_id VARCHAR(250) NOT NULL,
+            INDEX ix_energy_consumption_date_created (date_created),
+            INDEX ix_energy_consumption_device_id_timestamp (device_id, timestamp),
+            PRIMARY KEY (id, date_created),
+            UNIQUE INDEX ux_energy_consumption_trace_id_date_created (trace_id, date_created)
+          )
+          PARTITION BY RANGE (TO_DAYS(date_created)) (
+            PARTITION p_future VALUES LESS THAN MAXVALUE
           );
 
 CREATE TABLE IF NOT EXISTS solar_generation (  
-            id INT AUTO_INCREMENT PRIMARY KEY,   
+            id INT AUTO_INCREMENT,   
             device_id VARCHAR(250) NOT NULL,   
-            timestamp VARCHAR(100) NOT NULL,   
+            timestamp DATETIME NOT NULL,   
             power_generated FLOAT NOT NULL,   
             temperature FLOAT NOT NULL,   
-            date_created VARCHAR(100) NOT NULL,
-            trace_id VARCHAR(250) NOT NULL  
-          );
\ No newline at end of file
+            date_created DATETIME NOT NULL,
+            trace_id VARCHAR(250) NOT NULL,
+            INDEX ix_solar_generation_date_created (date_created),
+            INDEX ix_solar_generation_device_id_timestamp (device_id, timestamp),
+            PRIMARY KEY (id, date_created),
+            UNIQUE INDEX ux_solar_generation_trace_id_date_created (trace_id, date_created)
+          )
+          PARTITION BY RANGE (TO_DAYS(date_created)) (
+            PARTITION p_future VALUES LESS THAN MAXVALUE
+          );
+
+-- Hourly per-device summaries of the partitions dropped by the retention job
+CREATE TABLE IF NOT EXISTS energy_consumption_hourly (
+    device_id VARCHAR(250) NOT NULL,
+    hour DATETIME NOT NULL,
+    count INT NOT NULL,
+    energy_consumed_min FLOAT NOT NULL,
+    energy_consumed_max FLOAT NOT NULL,
+    energy_consumed_sum DOUBLE NOT NULL,
+    voltage_min FLOAT NOT NULL,
+    voltage_max FLOAT NOT NULL,
+    voltage_sum DOUBLE NOT NULL,
+    PRIMARY KEY (device_id, hour)
+);
+
+CREATE TABLE IF NOT EXISTS solar_generation_hourly (
+    device_id VARCHAR(250) NOT NULL,
+    hour DATETIME NOT NULL,
+    count INT NOT NULL,
+    power_generated_min FLOAT NOT NULL,
+    power_generated_max FLOAT NOT NULL,
+    power_generated_sum DOUBLE NOT NULL,
+    temperature_min FLOAT NOT NULL,
+    temperature_max FLOAT NOT NULL,
+    temperature_sum DOUBLE NOT NULL,
+    PRIMARY KEY (device_id, hour)
+);
+
+CREATE TABLE IF NOT EXISTS rollup_log (
+    table_name VARCHAR(64) NOT NULL,
+    partition_name VARCHAR(64) NOT NULL,
+    row_count INT NOT NULL,
+    date_created DATETIME NOT NULL,
+    PRIMARY KEY (table_name, partition_name)
+);
@@ -1,7 +1,11 @@
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request, Response
 from apscheduler.schedulers.background import BackgroundScheduler
 import requests, json, logging.config, yaml, os, connexion, httpx
-from datetime import datetime
+from datetime import datetime, timezone
+from threading import Lock
+from rolling_stats import RollingStats
+import hashlib, atexit, time
+from collections import deque
 
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
@@ -28,106 +32,240 @@ scheduler_interval = app_config['scheduler']['interval']
 energy_consumption_url = app_config['eventstores']['energy_consumption']['url']
 solar_generation_url = app_config['eventstores']['solar_generation']['url']
 
+# Seconds after which the rows below a storage head id are taken as committed
+settle_s = app_config['scheduler']['settle_s']
+
+# Per-device, time-bucketed statistics, restored from their last checkpoint
+rolling_stats_config = app_config['rolling_stats']
+rolling_stats = RollingStats(rolling_stats_config['resolutions'])
+if rolling_stats.load(rolling_stats_config['filename']):
+    logger.info(f"Rolling statistics restored for {len(rolling_stats.device_ids)} devices")
+
+def default_stats():
+    """Statistics before any event was processed."""
+    return {
+        "num_energy_events": 0,
+        "max_energy_consumed": 0,
+        "num_solar_events": 0,
+        "max_power_generated": 0,
+        "last_energy_id": 0,
+        "last_solar_id": 0,
+        "last_updated": "1970-01-01T00:00:00Z"
+    }
+
 def load_stats():
     """Load statistics from the JSON file."""
     if not os.path.exists(stats_file):
-        return {
-            "num_energy_events": 0,
-            "max_energy_consumed": 0,
-            "num_solar_events": 0,
-            "max_power_generated": 0,
-            "last_updated": "1970-01-01T00:00:00Z"
-        }
+        return default_stats()
     with open(stats_file, 'r') as f:
-        return json.load(f)
+        stats = json.load(f)
+    # Files written before the id watermarks existed: count those events again
+    # from the first id, otherwise they would be counted twice
+    defaults = default_stats()
+    if "last_energy_id" not in stats:
+        stats.update(num_energy_events=0, max_energy_consumed=0, last_energy_id=0)
+    if "last_solar_id" not in stats:
+        stats.update(num_solar_events=0, max_power_generated=0, last_solar_id=0)
+    return {**defaults, **stats}
 
 def save_stats(stats):
-    """Save statistics to the JSON file."""
-    with open(stats_file, 'w') as f:
-        json.dump(stats, f, indent=4)
+    """Save statistics to the JSON file, replacing it atomically so readers never see a partial file."""
+    tmp_file = f"{stats_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(stats, f, separators=(',', ':'))
+    os.replace(tmp_file, stats_file)
 
-from datetime import datetime, timezone
+class StatsCache:
+    """
+    The statistics served by GET /stats, kept in memory with their
+    serialized body and ETag so a GET does no disk I/O. populate_stats
+    publishes new statistics here and the checkpoint job saves them to disk.
+    """
+    def __init__(self, stats):
+        self.lock = Lock()
+        self.dirty = False
+        self.publish(stats, dirty=False)
+
+    def publish(self, stats, dirty=True):
+        body = json.dumps(stats).encode('utf-8')
+        with self.lock:
+            self.stats = stats
+            self.body = body
+            self.etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            self.dirty = self.dirty or dirty
+
+    def snapshot(self):
+        """Returns: (copy of the statistics, serialized body, ETag)"""
+        with self.lock:
+            return dict(self.stats), self.body, self.etag
+
+    def checkpoint(self):
+        """Saves the statistics if they changed since the last checkpoint"""
+        with self.lock:
+            if not self.dirty:
+                return
+            stats = self.stats
+            self.dirty = False
+        try:
+            save_stats(stats)
+        except Exception:
+            with self.lock:
+                self.dirty = True
+            raise
+
+class CommitHorizon:
+    """
+    Storage id up to which every row of a table has committed. Storage
+    commits its batches out of id order, so rows below the highest id it
+    reports can still be committing, and a watermark moved past them would
+    skip them for good. A head id reported at least settle_s seconds ago is
+    taken as committed: the rows below it were inserted by then.
+    """
+    def __init__(self, settle_s):
+        self.settle_s = settle_s
+        # (monotonic time, head id) of the heads not settled yet
+        self.heads = deque()
+        self.settled = 0
+
+    def observe(self, head_id):
+        self.heads.append((time.monotonic(), head_id))
+
+    def horizon(self):
+        """Returns: the highest head id reported at least settle_s seconds ago, 0 before any"""
+        now = time.monotonic()
+        while self.heads and now - self.heads[0][0] >= self.settle_s:
+            self.settled = max(self.settled, self.heads.popleft()[1])
+        return self.settled
+
+stats_horizons = {"energy": CommitHorizon(settle_s), "solar": CommitHorizon(settle_s)}
+rolling_horizons = {"energy": CommitHorizon(settle_s), "solar": CommitHorizon(settle_s)}
 
 def populate_stats():
     logger.info("Processing started")
 
-    # Load existing stats
-    try:
-        stats = load_stats()
-    except Exception as e:
-        logger.error("Failed to load statistics: %s", str(e))
-        stats = {
-            "num_energy_events": 0,
-            "max_energy_consumed": 0,
-            "num_solar_events": 0,
-            "max_power_generated": 0,
-            "last_updated": "1970-01-01T00:00:00Z"
-        }
-
-    # Construct default timestamps
-    last_updated = stats.get('last_updated')
-    end_timestamp = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
-
-    logger.info(f"Fetching events from {last_updated} to {end_timestamp}")
-
-    # Process energy consumption and solar generation events
-    for event, url_key in [("energy", "energy_consumption"), ("solar", "solar_generation")]:
+    # Start from the statistics in memory
+    stats, _, _ = stats_cache.snapshot()
+
+    # Each event type is aggregated by storage from its id high-watermark up
+    # to its commit horizon, so a tick only costs the events stored since the
+    # previous one, and none still committing is skipped
+    for event, url, value_key, count_key, max_key in [
+        ("energy", energy_consumption_url, "energy_consumed", "num_energy_events", "max_energy_consumed"),
+        ("solar", solar_generation_url, "power_generated", "num_solar_events", "max_power_generated")
+    ]:
+        last_id_key = f"last_{event}_id"
         try:
-            response = httpx.get(app_config['eventstores'][url_key]['url'], params={
-                "start_timestamp": last_updated,
-                "end_timestamp": end_timestamp
-            })
+            up_to_id = max(stats_horizons[event].horizon(), stats[last_id_key])
+            logger.info(f"Aggregating {event} events after id {stats[last_id_key]} up to id {up_to_id}")
+            response = httpx.get(url, params={"after_id": stats[last_id_key], "up_to_id": up_to_id})
 
             if response.status_code != 200:
                 logger.error(f"Failed to fetch {event} events: Status {response.status_code}")
                 continue
 
-            events = response.json()
-            logger.info(f"Received {len(events)} {event} events")
-
-            if event == "energy":
-                # Increment the number of energy events
-                stats['num_energy_events'] += len(events)
+            aggregate = response.json()
+            stats_horizons[event].observe(aggregate['head_id'])
+            logger.info(f"Received {aggregate['count']} {event} events")
 
-                # Update the maximum energy consumed
-                max_energy = max([e['energy_consumed'] for e in events], default=0)
-                stats['max_energy_consumed'] = max(stats['max_energy_consumed'], max_energy)
+            # Increment the number of events
+            stats[count_key] += aggregate['count']
 
-            elif event == "solar":
-                # Increment the number of solar events
-                stats['num_solar_events'] += len(events)
+            # Update the maximum value
+            maximum = aggregate[value_key]['max']
+            if maximum is not None:
+                stats[max_key] = max(stats[max_key], maximum)
 
-                # Update the maximum power generated
-                max_power = max([s['power_generated'] for s in events], default=0)
-                stats['max_power_generated'] = max(stats['max_power_generated'], max_power)
+            # Move the watermark past the aggregated events
+            stats[last_id_key] = aggregate['last_id']
 
         except Exception as e:
             logger.error(f"Error processing {event} events: {str(e)}")
             continue
 
-    # Update last_updated timestamp and save stats
-    stats['last_updated'] = end_timestamp
+    # Update last_updated timestamp and publish stats, the checkpoint job saves them
+    stats['last_updated'] = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    stats_cache.publish(stats)
+    logger.info("Statistics updated successfully")
+
+    logger.info("Processing completed")
+
+def populate_rolling_stats():
+    """
+    Feeds the rolling statistics with the per-device, per-bucket aggregates
+    of the new events, up to the commit horizon as populate_stats does.
+    """
+    for event, url, value_key in [
+        ("energy", energy_consumption_url, "energy_consumed"),
+        ("solar", solar_generation_url, "power_generated")
+    ]:
+        try:
+            response = httpx.get(url, params={
+                "after_id": rolling_stats.last_ids[event],
+                "up_to_id": max(rolling_horizons[event].horizon(), rolling_stats.last_ids[event]),
+                "group_by_device": "true",
+                "bucket": rolling_stats_config['source_bucket']
+            })
+            if response.status_code != 200:
+                logger.error(f"Failed to fetch {event} aggregates: Status {response.status_code}")
+                continue
+            aggregate = response.json()
+            rolling_horizons[event].observe(aggregate['head_id'])
+            rolling_stats.add_aggregate(event, aggregate, value_key)
+            logger.info(f"Rolling statistics updated with {aggregate['count']} {event} events")
+        except Exception as e:
+            logger.error(f"Error updating rolling statistics with {event} events: {str(e)}")
+
+def checkpoint_stats():
+    """Saves the statistics in memory to disk."""
     try:
-        save_stats(stats)  # Save the updated stats
-        logger.info("Statistics updated successfully")
+        stats_cache.checkpoint()
     except Exception as e:
         logger.error("Failed to save statistics: %s", str(e))
+    try:
+        rolling_stats.save(rolling_stats_config['filename'])
+    except Exception as e:
+        logger.error("Failed to checkpoint rolling statistics: %s", str(e))
+    logger.debug("Statistics checkpointed")
 
-    logger.info("Processing completed")
+# Statistics in memory, loaded once from the last checkpoint
+try:
+    stats_cache = StatsCache(load_stats())
+except Exception as e:
+    logger.error("Failed to load statistics: %s", str(e))
+    stats_cache = StatsCache(default_stats())
+cache_max_age = app_config['scheduler']['interval']
+
+def get_stats(device_id=None, resolution=None, buckets=None):
+    if device_id is not None or resolution is not None:
+        return get_rolling_stats(device_id, resolution or "hour", buckets)
 
-def get_stats():
     logger.info("Fetching statistics")
-    stats = load_stats()
-    if not stats:
-        logger.error("Statistics do not exist")
-        return jsonify({"error": "No statistics available"}), 404
-    logger.debug("Statistics fetched: %s", stats)
+    _, body, etag = stats_cache.snapshot()
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"max-age={cache_max_age}, must-revalidate"
+    }
+    if request.headers.get("If-None-Match") == etag:
+        logger.info("Statistics not modified")
+        return Response(status=304, headers=headers)
     logger.info("Statistics fetched")
-    return jsonify(stats), 200
+    return Response(body, status=200, mimetype="application/json", headers=headers)
+
+def get_rolling_stats(device_id, resolution, buckets):
+    """Per-bucket statistics of one device, or of every device when device_id is not given."""
+    logger.info(f"Fetching {resolution} statistics for {device_id or 'all devices'}")
+    if resolution not in rolling_stats.buffers:
+        return jsonify({"error": f"Unknown resolution {resolution}"}), 400
+    result = rolling_stats.query(resolution, buckets or rolling_stats.buffers[resolution].slots, device_id)
+    if result is None:
+        return jsonify({"error": f"No statistics for device {device_id}"}), 404
+    return jsonify(result), 200
 
 def init_scheduler():
     sched = BackgroundScheduler(daemon=True)
     sched.add_job(populate_stats, 'interval', seconds=app_config['scheduler']['interval'])
+    sched.add_job(populate_rolling_stats, 'interval', seconds=app_config['scheduler']['interval'])
+    sched.add_job(checkpoint_stats, 'interval', seconds=app_config['scheduler']['checkpoint_interval'])
     sched.start()
 
 # Create the Connexion app
@@ -146,4 +284,5 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     )
 if __name__ == "__main__":
     init_scheduler()
+    atexit.register(checkpoint_stats)
     app.run(port=8100, host="0.0.0.0")
\ No newline at end of file
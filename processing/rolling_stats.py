@@ -0,0 +1,216 @@
+import os
+from datetime import datetime, timezone
+from threading import Lock
+
+import numpy as np
+
+# Event types tracked, in the order of the first axis of every buffer
+EVENT_TYPES = ("energy", "solar")
+
+class RingBuffers:
+    """
+    Ring buffers of one resolution (e.g. hour) for every device.
+    Each statistic is an array of shape (event type, device, slot): bucket `b`
+    (seconds since epoch // width) lives in slot `b % slots`, and
+    slot_bucket records which bucket a slot currently holds. A newer bucket
+    takes over the slot of the bucket `slots` periods older than itself.
+    """
+    def __init__(self, width, slots, capacity):
+        self.width = width
+        self.slots = slots
+        self.slot_bucket = np.full(slots, -1, dtype=np.int64)
+        shape = (len(EVENT_TYPES), capacity, slots)
+        self.count = np.zeros(shape, dtype=np.int32)
+        self.sum = np.zeros(shape, dtype=np.float64)
+        self.min = np.full(shape, np.inf, dtype=np.float32)
+        self.max = np.full(shape, -np.inf, dtype=np.float32)
+
+    def grow(self, capacity):
+        """Makes room for `capacity` devices"""
+        extra = capacity - self.count.shape[1]
+        if extra <= 0:
+            return
+        shape = (len(EVENT_TYPES), extra, self.slots)
+        self.count = np.concatenate([self.count, np.zeros(shape, dtype=np.int32)], axis=1)
+        self.sum = np.concatenate([self.sum, np.zeros(shape, dtype=np.float64)], axis=1)
+        self.min = np.concatenate([self.min, np.full(shape, np.inf, dtype=np.float32)], axis=1)
+        self.max = np.concatenate([self.max, np.full(shape, -np.inf, dtype=np.float32)], axis=1)
+
+    def add(self, type_index, rows, epochs, counts, sums, mins, maxs):
+        """Merges per-device partial aggregates stamped with their bucket start time"""
+        buckets = epochs // self.width
+        newest = max(buckets.max(), self.slot_bucket.max())
+        # Buckets that already left the window are dropped
+        keep = buckets > newest - self.slots
+        if not keep.all():
+            rows, buckets, counts, sums, mins, maxs = (a[keep] for a in (rows, buckets, counts, sums, mins, maxs))
+        slots = buckets % self.slots
+        for bucket in np.unique(buckets):
+            slot = bucket % self.slots
+            if self.slot_bucket[slot] < bucket:
+                # The slot still holds an expired bucket: reset it for every device
+                self.count[:, :, slot] = 0
+                self.sum[:, :, slot] = 0
+                self.min[:, :, slot] = np.inf
+                self.max[:, :, slot] = -np.inf
+                self.slot_bucket[slot] = bucket
+        np.add.at(self.count[type_index], (rows, slots), counts)
+        np.add.at(self.sum[type_index], (rows, slots), sums)
+        np.minimum.at(self.min[type_index], (rows, slots), mins)
+        np.maximum.at(self.max[type_index], (rows, slots), maxs)
+
+    def window(self, buckets, row=None, devices=0):
+        """
+        Statistics of the last `buckets` buckets, newest first, for one device
+        row or summed over the first `devices` rows (the whole fleet).
+        Returns: (bucket ids, valid mask, count, sum, min, max), the last four
+        of shape (event type, bucket)
+        """
+        newest = self.slot_bucket.max()
+        bucket_ids = newest - np.arange(min(buckets, self.slots))
+        slots = bucket_ids % self.slots
+        valid = (self.slot_bucket[slots] == bucket_ids) & (bucket_ids >= 0)
+        if row is not None:
+            return (bucket_ids, valid, self.count[:, row, slots], self.sum[:, row, slots],
+                    self.min[:, row, slots], self.max[:, row, slots])
+        return (bucket_ids, valid,
+                self.count[:, :devices, slots].sum(axis=1),
+                self.sum[:, :devices, slots].sum(axis=1),
+                self.min[:, :devices, slots].min(axis=1, initial=np.inf),
+                self.max[:, :devices, slots].max(axis=1, initial=-np.inf))
+
+class RollingStats:
+    """
+    Incrementally updated statistics of energy consumption and power
+    generation per device and per time bucket, for every configured
+    resolution. It is fed with the per-device, per-bucket aggregates of the
+    new events returned by storage, and remembers the id watermark of each
+    event type so a restart resumes from its checkpoint.
+    """
+    def __init__(self, resolutions, capacity=1024):
+        self.lock = Lock()
+        self.resolutions = resolutions
+        self.device_index = {}
+        self.device_ids = []
+        self.last_ids = {event_type: 0 for event_type in EVENT_TYPES}
+        self.buffers = {
+            name: RingBuffers(resolution['seconds'], resolution['buckets'], capacity)
+            for name, resolution in resolutions.items()
+        }
+
+    def device_rows(self, device_ids):
+        """Row of each device, adding the devices seen for the first time"""
+        rows = np.empty(len(device_ids), dtype=np.int64)
+        for i, device_id in enumerate(device_ids):
+            row = self.device_index.get(device_id)
+            if row is None:
+                row = len(self.device_ids)
+                self.device_index[device_id] = row
+                self.device_ids.append(device_id)
+            rows[i] = row
+        capacity = next(iter(self.buffers.values())).count.shape[1]
+        if len(self.device_ids) > capacity:
+            while capacity < len(self.device_ids):
+                capacity *= 2
+            for buffers in self.buffers.values():
+                buffers.grow(capacity)
+        return rows
+
+    def add_aggregate(self, event_type, aggregate, value_key):
+        """
+        Merges a storage aggregate grouped by device_id and bucket, and moves
+        the watermark of the event type to its last_id
+        """
+        groups = aggregate.get("groups", [])
+        with self.lock:
+            if groups:
+                rows = self.device_rows([group["device_id"] for group in groups])
+                epochs = np.array([parse_bucket(group["bucket"]) for group in groups], dtype=np.int64)
+                counts = np.array([group["count"] for group in groups], dtype=np.int32)
+                sums = np.array([group[value_key]["sum"] for group in groups], dtype=np.float64)
+                mins = np.array([group[value_key]["min"] for group in groups], dtype=np.float32)
+                maxs = np.array([group[value_key]["max"] for group in groups], dtype=np.float32)
+                type_index = EVENT_TYPES.index(event_type)
+                for buffers in self.buffers.values():
+                    buffers.add(type_index, rows, epochs, counts, sums, mins, maxs)
+            self.last_ids[event_type] = aggregate["last_id"]
+
+    def query(self, resolution, buckets, device_id=None):
+        """
+        Statistics of the last `buckets` buckets of a resolution, newest first,
+        for one device or for the whole fleet when device_id is None.
+        Returns: None when the device is unknown
+        """
+        with self.lock:
+            buffers = self.buffers[resolution]
+            if device_id is not None:
+                row = self.device_index.get(device_id)
+                if row is None:
+                    return None
+                window = buffers.window(buckets, row=row)
+            else:
+                window = buffers.window(buckets, devices=len(self.device_ids))
+        bucket_ids, valid, count, total, minimum, maximum = window
+        results = []
+        for i in np.flatnonzero(valid):
+            bucket = {"bucket": format_bucket(int(bucket_ids[i]) * buffers.width)}
+            for t, event_type in enumerate(EVENT_TYPES):
+                n = int(count[t, i])
+                bucket[event_type] = {
+                    "count": n,
+                    "sum": float(total[t, i]),
+                    "mean": float(total[t, i]) / n if n else None,
+                    "min": float(minimum[t, i]) if n else None,
+                    "max": float(maximum[t, i]) if n else None
+                }
+            bucket["net_energy"] = bucket["solar"]["sum"] - bucket["energy"]["sum"]
+            results.append(bucket)
+        return {"resolution": resolution, "device_id": device_id, "buckets": results}
+
+    def save(self, filename):
+        """Checkpoints the buffers and watermarks, replacing the file atomically"""
+        with self.lock:
+            arrays = {
+                "device_ids": np.array(self.device_ids, dtype=str),
+                "last_ids": np.array([self.last_ids[event_type] for event_type in EVENT_TYPES], dtype=np.int64)
+            }
+            for name, buffers in self.buffers.items():
+                arrays[f"{name}_slot_bucket"] = buffers.slot_bucket
+                arrays[f"{name}_count"] = buffers.count
+                arrays[f"{name}_sum"] = buffers.sum
+                arrays[f"{name}_min"] = buffers.min
+                arrays[f"{name}_max"] = buffers.max
+            tmp_filename = f"{filename}.tmp"
+            with open(tmp_filename, 'wb') as f:
+                np.savez(f, **arrays)
+        os.replace(tmp_filename, filename)
+
+    def load(self, filename):
+        """
+        Restores a checkpoint written with the same resolutions.
+        Returns: True (restored), False (no usable checkpoint)
+        """
+        if not os.path.exists(filename):
+            return False
+        with np.load(filename) as checkpoint:
+            for name, buffers in self.buffers.items():
+                if checkpoint[f"{name}_slot_bucket"].shape != buffers.slot_bucket.shape:
+                    return False
+            with self.lock:
+                self.device_ids = [str(device_id) for device_id in checkpoint["device_ids"]]
+                self.device_index = {device_id: row for row, device_id in enumerate(self.device_ids)}
+                self.last_ids = dict(zip(EVENT_TYPES, (int(last_id) for last_id in checkpoint["last_ids"])))
+                for name, buffers in self.buffers.items():
+                    buffers.slot_bucket = checkpoint[f"{name}_slot_bucket"]
+                    buffers.count = checkpoint[f"{name}_count"]
+                    buffers.sum = checkpoint[f"{name}_sum"]
+                    buffers.min = checkpoint[f"{name}_min"]
+                    buffers.max = checkpoint[f"{name}_max"]
+        return True
+
+def parse_bucket(bucket):
+    """Seconds since epoch of a bucket start such as 2025-01-09T12:00:00Z"""
+    return int(datetime.strptime(bucket, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp())
+
+def format_bucket(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
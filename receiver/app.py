@@ -1,9 +1,17 @@
 import connexion, yaml, logging, logging.config, json, httpx, uuid, random  
 from connexion import NoContent 
-from datetime import datetime
+from connexion.datastructures import MediaTypeDict
+from connexion.validators import VALIDATOR_MAP, AbstractRequestBodyValidator
+from datetime import datetime, timezone
+from jsonschema import Draft4Validator, FormatChecker
 from pykafka import KafkaClient
+from pykafka.common import CompressionType
 from pykafka.exceptions import KafkaException
-import time
+from pykafka.partitioners import hashing_partitioner
+from queue import Empty
+from threading import Lock
+import time, atexit
+import wire_format
 
 # MAX_EVENTS = 5  
 # EVENT_FILE = "events.json"
@@ -17,14 +25,26 @@ with open('config/log_conf_dev.yml', 'r') as f:
     
 logger = logging.getLogger('basicLogger')
 
+# Codecs pykafka can produce with (it has no zstd)
+COMPRESSION_TYPES = {
+    "none": CompressionType.NONE,
+    "gzip": CompressionType.GZIP,
+    "snappy": CompressionType.SNAPPY,
+    "lz4": CompressionType.LZ4
+}
+
 class KafkaWrapper:
-    """ Kafka wrapper for producer """
-    def __init__(self, hostname, topic):
+    """ Kafka wrapper for a long-lived, shared async producer of a topic """
+    def __init__(self, hostname, topic, producer_config=None, broker_version="0.9.0"):
         self.hostname = hostname
         self.topic = topic
+        self.producer_config = producer_config or {}
+        self.broker_version = broker_version
         self.client = None
         self.producer = None
+        self.lock = Lock()
         self.connect()
+        atexit.register(self.stop)
 
     def connect(self):
         """Infinite loop: will keep trying"""
@@ -44,7 +64,8 @@ class KafkaWrapper:
         if self.client is not None:
             return True
         try:
-            self.client = KafkaClient(hosts=self.hostname)
+            # LZ4 uses the standard frame format from broker version 0.10.0 on
+            self.client = KafkaClient(hosts=self.hostname, broker_version=self.broker_version)
             logger.info("Kafka client created")
             return True
         except KafkaException as e:
@@ -56,7 +77,9 @@ class KafkaWrapper:
 
     def make_producer(self):
         """
-        Runs once, makes a producer and sets it on the instance.
+        Runs once, makes an async producer and sets it on the instance.
+        Messages are queued and sent in batches once `min_queued_messages`
+        are waiting or `linger_ms` has elapsed, whichever comes first.
         Returns: True (success), False (failure)
         """
         if self.producer is not None:
@@ -65,8 +88,19 @@ class KafkaWrapper:
             return False
         try:
             topic = self.client.topics[str.encode(self.topic)]
-            self.producer = topic.get_sync_producer()
+            self.producer = topic.get_producer(
+                sync=False,
+                # Keyed by device_id so the events of a device keep their order
+                partitioner=hashing_partitioner,
+                linger_ms=self.producer_config.get('linger_ms', 50),
+                min_queued_messages=self.producer_config.get('min_queued_messages', 500),
+                max_queued_messages=self.producer_config.get('max_queued_messages', 100000),
+                block_on_queue_full=True,
+                delivery_reports=self.producer_config.get('delivery_reports', True),
+                compression=COMPRESSION_TYPES[self.producer_config.get('compression', 'none')]
+            )
             logger.info("Kafka producer created")
+            return True
         except KafkaException as e:
             msg = f"Make error when making producer: {e}"
             logger.warning(msg)
@@ -74,50 +108,248 @@ class KafkaWrapper:
             self.producer = None
             return False
 
-kafka_wrapper = KafkaWrapper(f"{app_config['kafka']['events']['hostname']}:{app_config['kafka']['events']['port']}", app_config['kafka']['events']['topic'])
+    def reconnect(self, producer):
+        """
+        Drops the broken producer and connects again. Only the first thread
+        that notices a given broken producer rebuilds it.
+        """
+        with self.lock:
+            if self.producer is not producer:
+                return
+            try:
+                producer.stop()
+            except Exception as e:
+                logger.debug(f"Error stopping broken producer: {e}")
+            self.client = None
+            self.producer = None
+            self.connect()
 
-def receive_energy_consumption_event(body):
+    def produce(self, message, partition_key):
+        """
+        Queues an encoded message on the shared producer, reconnecting
+        and retrying if the broker went away.
+        """
+        while True:
+            if self.producer is None:
+                with self.lock:
+                    if self.producer is None:
+                        self.connect()
+            producer = self.producer
+            try:
+                producer.produce(message, partition_key=partition_key)
+                break
+            except KafkaException as e:
+                logger.warning(f"Kafka issue in producer: {e}")
+                self.reconnect(producer)
+        self.drain_delivery_reports(producer)
+
+    def produce_batch(self, messages):
+        """
+        Queues a list of (encoded message, partition key) back to back so the
+        async producer sends them to the broker together in one produce request.
+        """
+        queued = 0
+        while queued < len(messages):
+            if self.producer is None:
+                with self.lock:
+                    if self.producer is None:
+                        self.connect()
+            producer = self.producer
+            try:
+                # Resume from the first message the broken producer did not take
+                for message, partition_key in messages[queued:]:
+                    producer.produce(message, partition_key=partition_key)
+                    queued += 1
+            except KafkaException as e:
+                logger.warning(f"Kafka issue in producer: {e}")
+                self.reconnect(producer)
+        self.drain_delivery_reports(producer)
+
+    def drain_delivery_reports(self, producer):
+        """
+        Logs the delivery reports that are ready for the calling thread.
+        pykafka keeps one report queue per producing thread, so each request
+        thread drains its own queue without blocking.
+        """
+        if not self.producer_config.get('delivery_reports', True):
+            return
+        while True:
+            try:
+                message, exc = producer.get_delivery_report(block=False)
+            except Empty:
+                break
+            if exc is not None:
+                logger.error(f"Failed to deliver message {message.value[:100]}: {exc}")
+            else:
+                logger.debug(f"Delivered message to partition {message.partition_id} at offset {message.offset}")
+
+    def stop(self):
+        """Flushes queued messages and stops the producer"""
+        if self.producer is not None:
+            logger.info("Flushing and stopping Kafka producer")
+            self.producer.stop()
+            self.producer = None
+
+# Schemas used to validate each event of a batch, keyed by event type
+with open('openapi.yml', 'r') as f:
+    api_spec = yaml.safe_load(f.read())
+event_validators = {
+    "energy-consumption": Draft4Validator(api_spec['components']['schemas']['EnergyConsumptionEvent'], format_checker=FormatChecker()),
+    "solar-generation": Draft4Validator(api_spec['components']['schemas']['SolarGenerationEvent'], format_checker=FormatChecker())
+}
+MAX_BATCH_EVENTS = app_config.get('batch', {}).get('max_events', 1000)
+# Format of the produced messages (see wire_format); consumers read both
+MESSAGE_FORMAT = app_config['kafka'].get('producer', {}).get('format', 'json')
+if MESSAGE_FORMAT not in wire_format.FORMATS:
+    raise ValueError(f"kafka.producer.format must be one of {wire_format.FORMATS}, not {MESSAGE_FORMAT!r}")
+
+COMPRESSION = app_config['kafka'].get('producer', {}).get('compression', 'none')
+if COMPRESSION not in COMPRESSION_TYPES:
+    raise ValueError(f"kafka.producer.compression must be one of {sorted(COMPRESSION_TYPES)}, not {COMPRESSION!r}")
+
+# Topic each event type is produced to: its own topic, or the legacy events topic
+if app_config['kafka'].get('per_type_topics', False):
+    EVENT_TOPICS = app_config['kafka']['topics']
+else:
+    EVENT_TOPICS = {event_type: app_config['kafka']['events']['topic'] for event_type in event_validators}
+# One producer per topic
+kafka_wrappers = {
+    topic: KafkaWrapper(
+        f"{app_config['kafka']['events']['hostname']}:{app_config['kafka']['events']['port']}",
+        topic,
+        app_config['kafka'].get('producer'),
+        app_config['kafka'].get('broker_version', '0.9.0')
+    )
+    for topic in set(EVENT_TOPICS.values())
+}
+
+def producer_of(event_type):
+    """ The wrapper of the topic an event type is produced to """
+    return kafka_wrappers[EVENT_TOPICS[event_type]]
+
+def build_message(event_type, body):
+    """ Tags the event with its ids and wraps it in the message envelope """
     # Generate trace_id and uuid for the event
     body["trace_id"] = str(uuid.uuid4())
     body["uuid"] = str(uuid.uuid4())
-    # uses the configuration values to connect to Kafka and select the “events” topic
-    client = KafkaClient(hosts=f"{app_config['kafka']['events']['hostname']}:{app_config['kafka']['events']['port']}")
-    topic = client.topics[str.encode(app_config['kafka']['events']['topic'])]
-    producer = topic.get_sync_producer()
-    # JSON message
-    msg = {
-            "type": "energy-consumption",
-            "datetime": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-            "payload": body
+    return {
+        "type": event_type,
+        # UTC, without an offset: storage keeps it as the naive date_created of the event
+        "datetime": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"),
+        "payload": body
     }
-    # The event is serialized to JSON and encoded as UTF-8 before being sent. A log statement is recorded 
-    msg_str = json.dumps(msg)
-    producer.produce(msg_str.encode('utf-8'))
+
+def encode_message(msg):
+    """ Serializes a message envelope in the configured wire format """
+    return wire_format.encode(msg, MESSAGE_FORMAT)
+
+def partition_key(msg):
+    """ Messages are keyed by device_id so a device always lands on the same partition """
+    return msg["payload"]["device_id"].encode('utf-8')
+
+def receive_energy_consumption_event(body):
+    msg = build_message("energy-consumption", body)
+    # The event is serialized in the configured wire format before being queued on the
+    # shared producer. A log statement is recorded
+    producer_of("energy-consumption").produce(encode_message(msg), partition_key(msg))
     logger.info(f"Produced energy-consumption event with trace_id {body['trace_id']}")
     return NoContent, 201 # returns and HTTP 201 response 
 
 def receive_solar_generation_event(body):  
-    # Generate trace_id and uuid for the event
-    body["trace_id"] = str(uuid.uuid4())
-    body["uuid"] = str(uuid.uuid4())
-    
-    client = KafkaClient(hosts=f"{app_config['kafka']['events']['hostname']}:{app_config['kafka']['events']['port']}")
-    topic = client.topics[str.encode(app_config['kafka']['events']['topic'])]
-    producer = topic.get_sync_producer()
-    msg = {
-            "type": "solar-generation",
-            "datetime": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-            "payload": body
-    }
-    msg_str = json.dumps(msg)
-    producer.produce(msg_str.encode('utf-8'))
+    msg = build_message("solar-generation", body)
+    producer_of("solar-generation").produce(encode_message(msg), partition_key(msg))
     logger.info(f"Produced solar-generation event with trace_id {body['trace_id']}")
     return NoContent, 201
+
+def parse_batch(body):
+    """
+    Returns the list of items in a batch body, which is either a JSON array
+    or NDJSON (one JSON event per line)
+    """
+    if isinstance(body, list):
+        return body
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    items = []
+    for line in body.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            items.append(json.loads(line))
+        except json.JSONDecodeError as e:
+            # Keep the position so the per-item results still line up
+            items.append({"_error": f"Invalid JSON: {e.msg}"})
+    return items
+
+def validate_batch_item(item):
+    """
+    Validates one batch item against the schema of its event type.
+    Returns: a list of error messages, empty when the item is valid
+    """
+    if not isinstance(item, dict):
+        return ["Item must be an object"]
+    if "_error" in item:
+        return [item["_error"]]
+    validator = event_validators.get(item.get("type"))
+    if validator is None:
+        return [f"Unknown event type {item.get('type')!r}, must be one of {sorted(event_validators)}"]
+    payload = item.get("payload")
+    if not isinstance(payload, dict):
+        return ["Item payload must be an object"]
+    return [error.message for error in validator.iter_errors(payload)]
+
+def receive_event_batch(body):
+    """
+    Validates every event in the batch, tags the valid ones with a trace_id
+    and queues them on the producer of their topic, one batch per topic.
+    """
+    items = parse_batch(body)
+    if len(items) > MAX_BATCH_EVENTS:
+        return {"message": f"Batch has {len(items)} events, the limit is {MAX_BATCH_EVENTS}"}, 413
+
+    results = []
+    messages = {}
+    for index, item in enumerate(items):
+        errors = validate_batch_item(item)
+        if errors:
+            results.append({"index": index, "status": 400, "errors": errors})
+            continue
+        msg = build_message(item["type"], item["payload"])
+        messages.setdefault(EVENT_TOPICS[item["type"]], []).append((encode_message(msg), partition_key(msg)))
+        results.append({"index": index, "status": 201, "trace_id": msg["payload"]["trace_id"]})
+
+    for topic, topic_messages in messages.items():
+        kafka_wrappers[topic].produce_batch(topic_messages)
+
+    accepted = sum(len(topic_messages) for topic_messages in messages.values())
+    rejected = len(results) - accepted
+    logger.info(f"Produced batch of {accepted} events ({rejected} rejected)")
+
+    if accepted == 0:
+        status = 400
+    elif rejected == 0:
+        status = 201
+    else:
+        status = 207
+    return {"accepted": accepted, "rejected": rejected, "results": results}, status
    
+class RawBodyValidator(AbstractRequestBodyValidator):
+    """
+    Lets an NDJSON batch through as raw bytes: the JSON body validator would
+    parse it as one document and reject every batch of more than one line.
+    receive_event_batch validates each line on its own.
+    """
+    async def wrap_receive(self, receive, *, scope):
+        return receive, scope
+
+BODY_VALIDATORS = MediaTypeDict({**VALIDATOR_MAP["body"], "application/x-ndjson": RawBodyValidator})
+
 # Create the Connexion app  
 app = connexion.FlaskApp(__name__, specification_dir='')  
 # app.add_api("openapi.yml", strict_validation=True, validate_responses=True)
-app.add_api("openapi.yml", base_path="/receiver", strict_validation=True, validate_responses=True)
+app.add_api("openapi.yml", base_path="/receiver", strict_validation=True, validate_responses=True,
+            validator_map={"body": BODY_VALIDATORS})
 
 if __name__ == "__main__":  
     app.run(port=8080, host="0.0.0.0")
\ No newline at end of file
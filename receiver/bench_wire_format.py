@@ -0,0 +1,75 @@
+"""
+Benchmark of the Kafka message formats: bytes per event, and encode and
+decode throughput of the JSON envelope against the binary one
+(wire_format.py), on `--events` generated events of both types arriving
+at `--rate` events per second. Also times reading only the type, ids and datetime
+of each message, as the analyzer index does, and checks that every binary
+message decodes back to the event it encodes. `--rate 1` gives every
+event its own second, the worst case of the cached date formatting.
+
+    python bench_wire_format.py [--events 200000] [--rate 100]
+"""
+import argparse
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import wire_format
+
+def generate(n, rate):
+    """Returns: n message envelopes as the receiver builds them, `rate` per second"""
+    devices = [str(uuid.uuid4()) for _ in range(1000)]
+    start = datetime(2025, 2, 23, 12, 0, 0)
+    messages = []
+    for i in range(n):
+        timestamp = (start + timedelta(seconds=i // rate)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        if i % 2:
+            event_type = "solar-generation"
+            payload = {"device_id": random.choice(devices), "timestamp": timestamp,
+                       "power_generated": round(random.uniform(0, 10), 3), "temperature": round(random.uniform(-10, 60), 1)}
+        else:
+            event_type = "energy-consumption"
+            payload = {"device_id": random.choice(devices), "timestamp": timestamp,
+                       "energy_consumed": round(random.uniform(0, 50), 3), "voltage": round(random.uniform(220, 240), 1)}
+        payload["trace_id"] = str(uuid.uuid4())
+        payload["uuid"] = str(uuid.uuid4())
+        messages.append({"type": event_type, "datetime": timestamp[:-1], "payload": payload})
+    return messages
+
+def bench(messages, format):
+    start = time.perf_counter()
+    encoded = [wire_format.encode(msg, format) for msg in messages]
+    encode_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    decoded = [wire_format.decode(value) for value in encoded]
+    decode_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for value in encoded:
+        ids = wire_format.decode_ids(value)
+        if ids is None:
+            data = wire_format.decode(value)
+            ids = (data["type"], uuid.UUID(data["payload"]["uuid"]).bytes, uuid.UUID(data["payload"]["trace_id"]).bytes,
+                   wire_format.datetime_seconds(data["datetime"]))
+    ids_seconds = time.perf_counter() - start
+    return encoded, decoded, encode_seconds, decode_seconds, ids_seconds
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Compare the JSON and binary Kafka message formats")
+    arg_parser.add_argument("--events", type=int, default=200000, help="events encoded and decoded")
+    arg_parser.add_argument("--rate", type=int, default=100, help="events per second of the envelope datetime")
+    args = arg_parser.parse_args()
+
+    messages = generate(args.events, args.rate)
+    print(f"{'format':<8} {'bytes/event':>12} {'encode/s':>12} {'decode/s':>12} {'ids/s':>12}")
+    for format in wire_format.FORMATS:
+        encoded, decoded, encode_seconds, decode_seconds, ids_seconds = bench(messages, format)
+        if format == "binary":
+            assert all(value[0] == wire_format.MAGIC for value in encoded), "some events fell back to JSON"
+        assert decoded == messages, f"{format} messages do not decode to the events they encode"
+        size = sum(len(value) for value in encoded) / len(encoded)
+        print(f"{format:<8} {size:>12.1f} {len(messages) / encode_seconds:>12,.0f} "
+              f"{len(messages) / decode_seconds:>12,.0f} {len(messages) / ids_seconds:>12,.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Imports the receiver app against the configuration of config/receiver,
+with its log files in a temporary directory and an in-memory Kafka client
+that records the produced messages instead of connecting to a broker.
+"""
+import os
+import shutil
+import sys
+import tempfile
+from queue import Empty
+
+import pykafka
+import pytest
+import yaml
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_DIR = os.path.join(os.path.dirname(SERVICE_DIR), "config", "receiver")
+
+class FakeProducer:
+    def __init__(self, produced):
+        self.produced = produced
+
+    def produce(self, message, partition_key=None):
+        self.produced.append((message, partition_key))
+
+    def get_delivery_report(self, block=False):
+        raise Empty()
+
+    def stop(self):
+        pass
+
+class FakeTopic:
+    def __init__(self):
+        self.produced = []
+
+    def get_producer(self, **kwargs):
+        return FakeProducer(self.produced)
+
+class FakeTopics(dict):
+    def __missing__(self, name):
+        topic = self[name] = FakeTopic()
+        return topic
+
+class FakeKafkaClient:
+    topics = FakeTopics()
+
+    def __init__(self, hosts=None, broker_version=None):
+        pass
+
+def load_app():
+    work_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(work_dir, "config"))
+    shutil.copy(os.path.join(CONFIG_DIR, "app_conf_dev.yml"), os.path.join(work_dir, "config"))
+    with open(os.path.join(CONFIG_DIR, "log_conf_dev.yml")) as f:
+        log_config = yaml.safe_load(f)
+    for handler in log_config["handlers"].values():
+        if "filename" in handler:
+            handler["filename"] = os.path.join(work_dir, os.path.basename(handler["filename"]))
+    # Only to the log files: the console stream is closed before the atexit handlers log
+    for logger_config in [log_config["root"], *log_config.get("loggers", {}).values()]:
+        logger_config["handlers"] = [name for name in logger_config["handlers"] if name != "console"]
+    with open(os.path.join(work_dir, "config", "log_conf_dev.yml"), "w") as f:
+        yaml.safe_dump(log_config, f)
+    os.symlink(os.path.join(SERVICE_DIR, "openapi.yml"), os.path.join(work_dir, "openapi.yml"))
+
+    pykafka.KafkaClient = FakeKafkaClient
+    sys.path.insert(0, SERVICE_DIR)
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        import app
+    finally:
+        os.chdir(cwd)
+    return app
+
+receiver_app = load_app()
+
+@pytest.fixture
+def client():
+    return receiver_app.app.test_client()
+
+@pytest.fixture
+def produced():
+    for topic in FakeKafkaClient.topics.values():
+        topic.produced.clear()
+    return FakeKafkaClient.topics
@@ -0,0 +1,32 @@
+import json
+
+import wire_format
+
+def event(i):
+    return {
+        "type": "energy-consumption",
+        "payload": {
+            "device_id": "123e4567-e89b-12d3-a456-426614174000",
+            "timestamp": f"2025-01-09T12:00:{i:02d}Z",
+            "energy_consumed": 5.2 + i,
+            "voltage": 230.5
+        }
+    }
+
+def test_ndjson_batch_is_split_into_lines(client, produced):
+    lines = [json.dumps(event(i)) for i in range(3)] + ["{not json"]
+    response = client.post("/receiver/events/batch", content="\n".join(lines) + "\n",
+                           headers={"Content-Type": "application/x-ndjson"})
+
+    assert response.status_code == 207
+    result = response.json()
+    assert (result["accepted"], result["rejected"]) == (3, 1)
+    assert [item["status"] for item in result["results"]] == [201, 201, 201, 400]
+    messages = [wire_format.decode(message) for message, _ in produced[b"energy_consumption"].produced]
+    assert [msg["payload"]["energy_consumed"] for msg in messages] == [5.2, 6.2, 7.2]
+
+def test_json_batch(client, produced):
+    response = client.post("/receiver/events/batch", json=[event(0), event(1)])
+
+    assert response.status_code == 201
+    assert response.json()["accepted"] == 2
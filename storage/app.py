@@ -5,20 +5,30 @@ import os
 
 import connexion, yaml, logging, logging.config, json, os
 from connexion import NoContent
+from connexion.datastructures import MediaTypeDict
+from connexion.validators import VALIDATOR_MAP, AbstractResponseBodyValidator
 
+import wire_format
+import partitions
+import read_path
 from base import Base
 from energy_consumption import EnergyConsumption
 from solar_generation import SolarGeneration
-from flask import jsonify
+from flask import jsonify, Response
 from pykafka import KafkaClient
 from pykafka.common import OffsetType
 from pykafka.exceptions import KafkaException
 
-from threading import Thread
+from threading import Thread, Event
 from dateutil import parser
 import random
 import time
-from sqlalchemy import create_engine, select, func
+import datetime
+import math
+import atexit
+from sqlalchemy import create_engine, select, func, cast
+from sqlalchemy.dialects.mysql import BIGINT, insert as mysql_insert
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
 from sqlalchemy.orm import sessionmaker
 
 # Load the configuration from app_conf.yml  
@@ -55,18 +65,70 @@ engine = create_engine(
 Base.metadata.bind = engine
 DBSession = sessionmaker(bind=engine)
 
+# Micro-batching of the Kafka consumer: a batch is written once it holds
+# max_messages events or its first event has waited max_wait_ms
+BATCH_MAX_MESSAGES = app_config['batch']['max_messages']
+BATCH_MAX_WAIT_MS = app_config['batch']['max_wait_ms']
+# Offsets of the stored batches are committed at most this often
+COMMIT_INTERVAL_MS = app_config['batch']['commit_interval_ms']
+
+# Pool of consumer workers, each one a member of the consumer group of its topic
+CONSUMER_WORKERS = app_config['consumers']['workers']
+CONSUMER_GROUP = app_config['consumers']['group']
+# Topic of each event type, and the legacy events topic while it is still read
+CONSUMED_TOPICS = list(dict.fromkeys(app_config['kafka']['topics'].values()))
+if app_config['kafka'].get('dual_read', False):
+    CONSUMED_TOPICS.append(app_config['kafka']['events']['topic'])
+BROKER_VERSION = app_config['kafka'].get('broker_version', '0.9.0')
+consumer_workers = []
+consumers_stop_event = Event()
+
+# Value columns aggregated for each table, and how event timestamps are bucketed
+AGGREGATE_COLUMNS = {
+    EnergyConsumption: (EnergyConsumption.energy_consumed, EnergyConsumption.voltage),
+    SolarGeneration: (SolarGeneration.power_generated, SolarGeneration.temperature)
+}
+# Table of each event type, and the longest trace_id prefix of a digest
+# bucket: the hex digits before the first hyphen
+DIGEST_MODELS = {
+    "energy-consumption": EnergyConsumption,
+    "solar-generation": SolarGeneration
+}
+MAX_PREFIX_WIDTH = 8
+BUCKET_FORMATS = {
+    "minute": "%Y-%m-%dT%H:%i:00Z",
+    "hour": "%Y-%m-%dT%H:00:00Z",
+    "day": "%Y-%m-%dT00:00:00Z"
+}
+PERCENTILE_PRECISION = app_config['aggregates']['percentile_precision']
+
+# Daily partitions of the event tables, and the retention of the raw readings
+partitions_config = app_config['partitions']
+partition_maintainer = partitions.PartitionMaintainer(
+    engine,
+    [model.__tablename__ for model in DIGEST_MODELS.values()],
+    partitions_config['days_ahead'],
+    partitions_config['retention_days'],
+    partitions_config['interval_s'],
+    consumers_stop_event
+)
+
+# Rows fetched from the server-side cursor per chunk of an NDJSON response
+STREAM_CHUNK_ROWS = app_config['events_query']['stream_chunk_rows']
+
 class KafkaWrapper:
-    """ Kafka wrapper for consumer """
-    def __init__(self, hostname, topic):
+    """ Kafka wrapper for a member of the storage consumer group """
+    def __init__(self, hostname, topic, stop_event):
         self.hostname = hostname
         self.topic = topic
+        self.stop_event = stop_event
         self.client = None
         self.consumer = None
         self.connect()
 
     def connect(self):
-        """Infinite loop: will keep trying"""
-        while True:
+        """Infinite loop: will keep trying until connected or stopped"""
+        while not self.stop_event.is_set():
             logger.debug("Trying to connect to Kafka...")
             if self.make_client():
                 if self.make_consumer():
@@ -82,7 +144,7 @@ class KafkaWrapper:
         if self.client is not None:
             return True
         try:
-            self.client = KafkaClient(hosts=self.hostname)
+            self.client = KafkaClient(hosts=self.hostname, broker_version=BROKER_VERSION)
             logger.info("Kafka client created!")
             return True
         except KafkaException as e:
@@ -94,7 +156,9 @@ class KafkaWrapper:
 
     def make_consumer(self):
         """
-        Runs once, makes a consumer and sets it on the instance.
+        Runs once, makes a balanced consumer and sets it on the instance.
+        The group coordinator spreads the topic partitions over every member
+        of the group, across the workers of all storage replicas.
         Returns: True (success), False (failure)
         """
         if self.consumer is not None:
@@ -103,12 +167,21 @@ class KafkaWrapper:
             return False
         try:
             topic = self.client.topics[str.encode(self.topic)]
-            self.consumer = topic.get_simple_consumer(
-                consumer_group=b'event_group',
+            # Only reads new messages (uncommitted messages) when the service
+            # re-starts. Offsets are committed by the worker after each batch,
+            # and consume() gives up after max_wait_ms so a partial batch is
+            # still flushed.
+            self.consumer = topic.get_balanced_consumer(
+                consumer_group=str.encode(CONSUMER_GROUP),
+                managed=True,
+                auto_commit_enable=False,
                 reset_offset_on_start=False,
-                auto_offset_reset=OffsetType.LATEST
+                auto_offset_reset=OffsetType.LATEST,
+                consumer_timeout_ms=BATCH_MAX_WAIT_MS,
+                post_rebalance_callback=self.on_rebalance
             )
             logger.info("Kafka consumer created")
+            return True
         except KafkaException as e:
             msg = f"Make error when making consumer: {e}"
             logger.warning(msg)
@@ -116,14 +189,24 @@ class KafkaWrapper:
             self.consumer = None
             return False
 
+    def on_rebalance(self, consumer, old_partition_offsets, new_partition_offsets):
+        """Logs the partitions owned by this member after a rebalance"""
+        partitions = sorted(partition.id for partition in new_partition_offsets)
+        logger.info(f"Consumer group rebalanced, now owning partitions {partitions}")
+        # Keep the committed offsets
+        return None
+
     def messages(self):
-        """Generator method that catches exceptions in the consumer loop"""
+        """
+        Generator method that catches exceptions in the consumer loop.
+        Yields None when no message arrived within max_wait_ms, and
+        returns once the stop event is set.
+        """
         if self.consumer is None:
             self.connect()
-        while True:
+        while not self.stop_event.is_set():
             try:
-                for msg in self.consumer:
-                    yield msg
+                yield self.consumer.consume(block=True)
             except KafkaException as e:
                 msg = f"Kafka issue in consumer: {e}"
                 logger.warning(msg)
@@ -131,159 +214,440 @@ class KafkaWrapper:
                 self.consumer = None
                 self.connect()
 
-kafka_wrapper = KafkaWrapper(f"{app_config['kafka']['events']['hostname']}:{app_config['kafka']['events']['port']}", app_config['kafka']['events']['topic'])
-
-def process_messages():
-    """ Process event messages """
-    # Connect to Kafka
-    kafka_host = f"{app_config['kafka']['events']['hostname']}:{app_config['kafka']['events']['port']}"
-    client = KafkaClient(hosts=kafka_host)
-    topic = client.topics[str.encode(app_config['kafka']['events']['topic'])]
-
-    # Create a consume on a consumer group, that only reads new messages
-    # (uncommitted messages) when the service re-starts (i.e., it doesn't
-    # read all the old messages from the history in the message queue).
-    consumer = topic.get_simple_consumer(
-        consumer_group=b'event_group',
-        reset_offset_on_start=False,
-        auto_offset_reset=OffsetType.LATEST
-    )
-    # This is a blocking loop - it will wait for new messages
-    for msg in consumer:
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        logger.info("consummed message: %s" % msg)
-
-        payload = msg["payload"]
-
-        # Process based on the event type
-        if msg["type"] == "energy-consumption":
-            receive_energy_consumption_event(payload)
-        elif msg["type"] == "solar-generation":
-            receive_solar_generation_event(payload)
-
-        # Commit the new message as being read
-        consumer.commit_offsets()
-
-def get_energy_consumption_event(start_timestamp, end_timestamp):
-    """ Get solar generation events filtered by timestamps """
-    try:
-        # start = datetime.datetime.fromisoformat(start_timestamp)
-        # end = datetime.datetime.fromisoformat(end_timestamp)
-        start = parser.parse(start_timestamp)
-        end = parser.parse(end_timestamp)
-    except ValueError:
-        logger.error("Invalid timestamp format")
-        return {"error": "Invalid timestamp format"}, 400
+    def commit_offsets(self):
+        """Commits the offsets of the messages consumed so far"""
+        if self.consumer is None:
+            return
+        try:
+            self.consumer.commit_offsets()
+        except KafkaException as e:
+            # The batch is already stored, its messages will be consumed
+            # again by whoever owns the partitions next
+            logger.warning(f"Kafka issue when committing offsets: {e}")
 
-    session = DBSession()
+    def stop(self):
+        """Leaves the consumer group"""
+        if self.consumer is not None:
+            self.consumer.stop()
+            self.consumer = None
+
+class ConsumerWorker(Thread):
+    """
+    Consumer group member that stores the events of the partitions of a
+    topic it owns through its own database connection. A partition is only
+    ever owned by one member, and the receiver keys messages by device_id,
+    so the events of a device are stored in order.
+    """
+    def __init__(self, topic, worker_id, stop_event):
+        super().__init__(name=f"consumer-{topic}-{worker_id}", daemon=True)
+        self.topic = topic
+        self.stop_event = stop_event
+
+    def run(self):
+        kafka_wrapper = KafkaWrapper(f"{app_config['kafka']['events']['hostname']}:{app_config['kafka']['events']['port']}", self.topic, self.stop_event)
+        connection = engine.connect()
+        batch = []
+        deadline = None
+        # Inserts are idempotent, so offsets are only committed every
+        # commit_interval_ms: a replay after a crash stores nothing twice
+        uncommitted = False
+        next_commit = time.monotonic() + COMMIT_INTERVAL_MS / 1000
+        try:
+            # This is a blocking loop - it will wait for new messages
+            for msg in kafka_wrapper.messages():
+                if msg is not None:
+                    batch.append(msg)
+                    if deadline is None:
+                        deadline = time.monotonic() + BATCH_MAX_WAIT_MS / 1000
+                if batch and (len(batch) >= BATCH_MAX_MESSAGES or time.monotonic() >= deadline):
+                    store_batch(connection, batch)
+                    uncommitted = True
+                    batch = []
+                    deadline = None
+                # Every message consumed is stored when the batch is empty
+                if uncommitted and not batch and time.monotonic() >= next_commit:
+                    kafka_wrapper.commit_offsets()
+                    uncommitted = False
+                    next_commit = time.monotonic() + COMMIT_INTERVAL_MS / 1000
+            # Clean shutdown: flush what was consumed before leaving the group
+            if batch:
+                store_batch(connection, batch)
+                uncommitted = True
+            if uncommitted:
+                kafka_wrapper.commit_offsets()
+        finally:
+            kafka_wrapper.stop()
+            connection.close()
+            logger.info(f"{self.name} stopped")
+
+def parse_event_timestamp(value):
+    """
+    Parses an ISO 8601 timestamp, of an event or of a query bound, into a
+    naive UTC datetime for a DATETIME column
+    """
+    timestamp = parser.isoparse(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+def envelope_datetime(data, default):
+    """
+    Date/time the receiver sent an event at, the date_created of its row: a
+    replayed message gets the same one, and so the same partition and the
+    same (trace_id, date_created) unique key
+    """
     try:
-        # Query energy consumption events within the given time range
-        statement = select(EnergyConsumption).where(
-            EnergyConsumption.date_created >= start,
-            EnergyConsumption.date_created < end
-        )
-        results = [
-            result.to_dict()
-            for result in session.execute(statement).scalars().all()
-        ]
-        logger.info("Found %d energy consumption readings (start: %s, end: %s)", len(results), start, end)
-        return jsonify(results), 200
-    except Exception as e:
-        logger.error("Error querying energy consumption events: %s", str(e))
-        return {"error": "Internal server error"}, 500
-    finally:
-        session.close()
+        return datetime.datetime.fromisoformat(data["datetime"]).replace(microsecond=0)
+    except (KeyError, ValueError, TypeError):
+        return default
+
+def build_rows(messages):
+    """
+    Decodes a batch of Kafka messages into rows for each table.
+    Returns: (energy consumption rows, solar generation rows)
+    """
+    energy_rows = []
+    solar_rows = []
+    now = partitions.utc_now().replace(microsecond=0)
+    for msg in messages:
+        try:
+            data = wire_format.decode(msg.value)
+            payload = data["payload"]
+            date_created = envelope_datetime(data, now)
+            # Process based on the event type
+            if data["type"] == "energy-consumption":
+                energy_rows.append({
+                    "device_id": payload["device_id"],
+                    "timestamp": parse_event_timestamp(payload["timestamp"]),
+                    "energy_consumed": payload["energy_consumed"],
+                    "voltage": payload["voltage"],
+                    "date_created": date_created,
+                    "trace_id": payload["trace_id"]
+                })
+            elif data["type"] == "solar-generation":
+                solar_rows.append({
+                    "device_id": payload["device_id"],
+                    "timestamp": parse_event_timestamp(payload["timestamp"]),
+                    "power_generated": payload["power_generated"],
+                    "temperature": payload["temperature"],
+                    "date_created": date_created,
+                    "trace_id": payload["trace_id"]
+                })
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Skipping malformed message at offset {msg.offset}: {e}")
+    return energy_rows, solar_rows
+
+def idempotent_insert(model):
+    """
+    INSERT that leaves the row already stored with the same trace_id and
+    date_created (unique index) as it is, so a replayed message is not stored twice. Unlike
+    INSERT IGNORE it still fails on any other error.
+    """
+    statement = mysql_insert(model)
+    return statement.on_duplicate_key_update(trace_id=statement.inserted.trace_id)
+
+def insert_rows(connection, energy_rows, solar_rows):
+    """ Multi-row idempotent INSERT of each table in the connection's transaction """
+    if energy_rows:
+        connection.execute(idempotent_insert(EnergyConsumption), energy_rows)
+    if solar_rows:
+        connection.execute(idempotent_insert(SolarGeneration), solar_rows)
+
+def store_batch(connection, messages):
+    """
+    Stores a batch of messages into the database in one transaction.
+    Retries while the database is unreachable, and falls back to one row
+    per transaction when the batch holds a row the database rejects.
+    """
+    energy_rows, solar_rows = build_rows(messages)
+    while True:
+        try:
+            insert_rows(connection, energy_rows, solar_rows)
+            connection.commit()
+            logger.info(f"Stored batch of {len(energy_rows)} energy consumption and {len(solar_rows)} solar generation events")
+            return
+        except OperationalError as e:
+            logger.warning(f"Database unavailable, retrying batch: {e}")
+            connection.rollback()
+            time.sleep(random.randint(500, 1500) / 1000)
+        except SQLAlchemyError as e:
+            logger.error(f"Error storing batch, storing its events one by one: {e}")
+            connection.rollback()
+            store_rows_one_by_one(connection, energy_rows, solar_rows)
+            return
+
+def store_rows_one_by_one(connection, energy_rows, solar_rows):
+    """ Stores each row in its own transaction, skipping the rejected ones """
+    rows = [(row, [row], []) for row in energy_rows] + [(row, [], [row]) for row in solar_rows]
+    for row, energy, solar in rows:
+        try:
+            insert_rows(connection, energy, solar)
+            connection.commit()
+        except SQLAlchemyError as e:
+            logger.error(f"Error storing event with trace_id {row['trace_id']}: {e}")
+            connection.rollback()
 
-def get_solar_generation_event(start_timestamp, end_timestamp):
+def get_energy_consumption_event(start_timestamp, end_timestamp, after_id=0, limit=None, format="json", fields=None):
+    """ Get energy consumption events filtered by timestamps """
+    return get_events(EnergyConsumption, "energy consumption", start_timestamp, end_timestamp, after_id, limit, format, fields)
+
+def get_solar_generation_event(start_timestamp, end_timestamp, after_id=0, limit=None, format="json", fields=None):
     """ Get solar generation events filtered by timestamps """
+    return get_events(SolarGeneration, "solar generation", start_timestamp, end_timestamp, after_id, limit, format, fields)
+
+def get_events(model, event_name, start_timestamp, end_timestamp, after_id, limit, format, fields):
+    """
+    Get the events of a table filtered by timestamps, ordered by id, with
+    only the fields asked for (all by default). Rows are read as tuples and
+    serialized straight to JSON (read_path.py), without ORM objects.
+    Pages are selected with the keyset (after_id, limit): the X-Next-After-Id
+    response header holds the after_id of the next page when the page is full.
+    With format=ndjson the rows are streamed from a server-side cursor instead,
+    one JSON object per line, so memory stays flat whatever the window.
+    """
     try:
         # Parse timestamps to datetime objects
-        # start = datetime.datetime.fromisoformat(start_timestamp)
-        # end = datetime.datetime.fromisoformat(end_timestamp)
-        start = parser.parse(start_timestamp)
-        end = parser.parse(end_timestamp)
+        start = parse_event_timestamp(start_timestamp)
+        end = parse_event_timestamp(end_timestamp)
     except ValueError:
         logger.error("Invalid timestamp format")
         return {"error": "Invalid timestamp format"}, 400
 
+    # Query events within the given time range, after the cursor
+    names = read_path.field_names(model, fields)
+    statement = read_path.select_fields(model, names).where(
+        model.date_created >= start,
+        model.date_created < end,
+        model.id > after_id
+    ).order_by(model.id)
+    if limit is not None:
+        statement = statement.limit(limit)
+
+    if format == "ndjson":
+        logger.info("Streaming %s readings (start: %s, end: %s, after_id: %s)", event_name, start, end, after_id)
+        return Response(stream_events(statement, names, event_name), mimetype="application/x-ndjson")
+
     session = DBSession()
     try:
-        # Query solar generation events within the given range
-        statement = select(SolarGeneration).where(
-            SolarGeneration.date_created >= start,
-            SolarGeneration.date_created < end
-        )
-        results = [
-            result.to_dict()
-            for result in session.execute(statement).scalars().all()
-        ]
-        logger.info("Found %d solar generation readings (start: %s, end: %s)", len(results), start, end)
-        return jsonify(results), 200
+        rows = session.execute(statement).all()
+        logger.info("Found %d %s readings (start: %s, end: %s, after_id: %s)", len(rows), event_name, start, end, after_id)
+        headers = {}
+        if limit is not None and len(rows) == limit:
+            # The id selected after the fields
+            headers["X-Next-After-Id"] = str(rows[-1][-1])
+        return Response(read_path.dumps_rows(names, rows), mimetype="application/json", headers=headers)
     except Exception as e:
-        logger.error("Error querying solar generation events: %s", str(e))
+        logger.error("Error querying %s events: %s", event_name, str(e))
         return {"error": "Internal server error"}, 500
     finally:
         session.close()
 
-def receive_energy_consumption_event(event):
-    """Store an energy consumption event into the database."""
-    logger.debug(f"finally")
+def stream_events(statement, names, event_name):
+    """
+    Yields the rows of the statement as NDJSON, one chunk of lines at a time.
+    yield_per makes the driver use a server-side cursor, so only one chunk
+    of rows is ever held in memory.
+    """
     session = DBSession()
+    count = 0
     try:
-        ec = EnergyConsumption(
-            event["device_id"],
-            event["timestamp"],
-            event["energy_consumed"],
-            event["voltage"],
-            event["trace_id"]
-        )
-        session.add(ec)
-        session.commit()
-        logger.info(f"Stored Energy Consumption event with trace_id {event['trace_id']}")
+        result = session.execute(statement.execution_options(yield_per=STREAM_CHUNK_ROWS))
+        for rows in result.partitions():
+            count += len(rows)
+            yield read_path.dumps_lines(names, rows)
+        logger.info("Streamed %d %s readings", count, event_name)
     except Exception as e:
-        logger.error(f"Error storing Energy Consumption event: {e}")
-        session.rollback()
+        # The status line is already sent, the client sees a truncated stream
+        logger.error("Error streaming %s events after %d rows: %s", event_name, count, str(e))
     finally:
         session.close()
 
-def receive_solar_generation_event(event):
-    logger.info(event)
-    """Store a solar generation event into the database."""
+def get_energy_consumption_aggregate(after_id=0, up_to_id=None, start_timestamp=None, end_timestamp=None,
+                                     group_by_device=False, bucket=None, percentiles=None):
+    """ Get aggregates of the energy consumption events over an id range or time window """
+    return get_aggregate(EnergyConsumption, "energy consumption", after_id, up_to_id, start_timestamp, end_timestamp,
+                         group_by_device, bucket, percentiles)
+
+def get_solar_generation_aggregate(after_id=0, up_to_id=None, start_timestamp=None, end_timestamp=None,
+                                   group_by_device=False, bucket=None, percentiles=None):
+    """ Get aggregates of the solar generation events over an id range or time window """
+    return get_aggregate(SolarGeneration, "solar generation", after_id, up_to_id, start_timestamp, end_timestamp,
+                         group_by_device, bucket, percentiles)
+
+def get_aggregate(model, event_name, after_id, up_to_id, start_timestamp, end_timestamp,
+                  group_by_device, bucket, percentiles):
+    """
+    Aggregates the events in the database with a single GROUP BY query:
+    count, min, max, sum and avg of each value column, per device and/or per
+    time bucket of the event timestamp when asked. Percentiles are estimated
+    from a histogram of the values rounded to percentile_precision decimals,
+    also counted by the database. Totals over every group are merged from
+    the groups. last_id is the watermark for the next call, and head_id the
+    highest id stored, which rows still committing may be below.
+    """
+    filters = [model.id > after_id]
+    if up_to_id is not None:
+        filters.append(model.id <= up_to_id)
+    try:
+        # Parse timestamps to datetime objects
+        if start_timestamp is not None:
+            filters.append(model.date_created >= parse_event_timestamp(start_timestamp))
+        if end_timestamp is not None:
+            filters.append(model.date_created < parse_event_timestamp(end_timestamp))
+    except ValueError:
+        logger.error("Invalid timestamp format")
+        return {"error": "Invalid timestamp format"}, 400
+
+    columns = AGGREGATE_COLUMNS[model]
+    group_columns = []
+    if group_by_device:
+        group_columns.append(model.device_id.label("device_id"))
+    if bucket is not None:
+        group_columns.append(func.date_format(model.timestamp, BUCKET_FORMATS[bucket]).label("bucket"))
+
+    metrics = [func.count(model.id), func.max(model.id)]
+    for column in columns:
+        metrics += [func.min(column), func.max(column), func.sum(column), func.avg(column)]
+
     session = DBSession()
     try:
-        sg = SolarGeneration(
-            event["device_id"],
-            event["timestamp"],
-            event["power_generated"],
-            event["temperature"],
-            event["trace_id"]
-        )
-        session.add(sg)
-        session.commit()
-        logger.info(f"Stored Solar Generation event with trace_id {event['trace_id']}")
+        if start_timestamp is None:
+            filters += ids_after_filters(session, model, after_id)
+        statement = select(*group_columns, *metrics).where(*filters)
+        if group_columns:
+            statement = statement.group_by(*group_columns)
+        groups = {}
+        for row in session.execute(statement):
+            key = tuple(row[:len(group_columns)])
+            count, last_id = row[len(group_columns):len(group_columns) + 2]
+            if count == 0:
+                continue
+            group = {name.key: value for name, value in zip(group_columns, key)}
+            group.update(count=count, last_id=last_id)
+            values = row[len(group_columns) + 2:]
+            for i, column in enumerate(columns):
+                minimum, maximum, total, average = values[i * 4:i * 4 + 4]
+                group[column.key] = {"min": minimum, "max": maximum, "sum": total, "avg": float(average)}
+            groups[key] = group
+
+        histograms = {}
+        if percentiles:
+            for column in columns:
+                histograms[column.key] = histogram(session, model, column, filters, group_columns)
+
+        result = merge_groups(list(groups.values()), columns)
+        result["after_id"] = after_id
+        result["last_id"] = result.pop("last_id", None) or after_id
+        result["head_id"] = session.execute(select(func.max(model.id))).scalar() or 0
+        if percentiles:
+            for column in columns:
+                merged = {}
+                for key, group in groups.items():
+                    group_histogram = histograms[column.key].get(key, {})
+                    group[column.key]["percentiles"] = estimate_percentiles(group_histogram, percentiles)
+                    for value, count in group_histogram.items():
+                        merged[value] = merged.get(value, 0) + count
+                result[column.key]["percentiles"] = estimate_percentiles(merged, percentiles)
+        if group_columns:
+            result["groups"] = list(groups.values())
+
+        logger.info("Aggregated %d %s events in %d groups (after id %s)", result["count"], event_name, len(groups), after_id)
+        return jsonify(result), 200
     except Exception as e:
-        logger.error(f"Error storing Solar Generation event: {e}")
-        session.rollback()
+        logger.error("Error aggregating %s events: %s", event_name, str(e))
+        return {"error": "Internal server error"}, 500
     finally:
         session.close()
 
+def ids_after_filters(session, model, after_id):
+    """
+    date_created lower bound of the rows with an id greater than after_id,
+    so a query past a watermark only reads the partitions that hold them
+    """
+    if not after_id:
+        return []
+    since = partitions.first_day_with_ids_after(session.connection(), model.__tablename__, after_id)
+    return [model.date_created >= since] if since is not None else []
+
+def histogram(session, model, column, filters, group_columns):
+    """
+    Counts the rounded values of a column per group in the database.
+    Returns: {group key: {rounded value: count}}
+    """
+    value = func.round(column, PERCENTILE_PRECISION).label("value")
+    statement = select(*group_columns, value, func.count(model.id)) \
+        .where(*filters) \
+        .group_by(*group_columns, value)
+    histograms = {}
+    for row in session.execute(statement):
+        key = tuple(row[:len(group_columns)])
+        histograms.setdefault(key, {})[row[-2]] = row[-1]
+    return histograms
+
+def estimate_percentiles(values, percentiles):
+    """ Nearest-rank percentiles of a {value: count} histogram """
+    total = sum(values.values())
+    estimates = {}
+    if total == 0:
+        return estimates
+    ordered = sorted(values.items())
+    for percentile in percentiles:
+        rank = max(1, math.ceil(percentile / 100 * total))
+        seen = 0
+        for value, count in ordered:
+            seen += count
+            if seen >= rank:
+                break
+        estimates[f"p{percentile:g}"] = value
+    return estimates
+
+def merge_groups(groups, columns):
+    """ Totals of the groups of an aggregate """
+    result = {"count": sum(group["count"] for group in groups)}
+    if groups:
+        result["last_id"] = max(group["last_id"] for group in groups)
+    for column in columns:
+        stats = [group[column.key] for group in groups]
+        total = sum(stat["sum"] for stat in stats)
+        result[column.key] = {
+            "min": min((stat["min"] for stat in stats), default=None),
+            "max": max((stat["max"] for stat in stats), default=None),
+            "sum": total,
+            "avg": total / result["count"] if result["count"] else None
+        }
+    return result
+
 def setup_kafka_thread():
-    """ Create threads to consume messages from multiple topics """
-    t = Thread(target=process_messages)
-    t.setDaemon(True)
-    t.start()
+    """ Start the pool of consumer workers of each topic """
+    for topic in CONSUMED_TOPICS:
+        for worker_id in range(CONSUMER_WORKERS):
+            worker = ConsumerWorker(topic, worker_id, consumers_stop_event)
+            worker.start()
+            consumer_workers.append(worker)
+    logger.info(f"Started {len(consumer_workers)} consumer workers for topics {CONSUMED_TOPICS}")
+    atexit.register(stop_kafka_threads)
+
+def stop_kafka_threads():
+    """ Let the consumer workers flush their batch and leave the group """
+    logger.info("Stopping consumer workers")
+    consumers_stop_event.set()
+    for worker in consumer_workers:
+        worker.join(timeout=BATCH_MAX_WAIT_MS / 1000 + 10)
 
 def get_count():
     logger.info("get_count")
     session = DBSession()
     try:
-        energy_consumption_count = session.query(func.count(EnergyConsumption.id)).scalar()  
-        solar_generation_count = session.query(func.count(SolarGeneration.id)).scalar()
+        energy_consumption_count, energy_consumption_last_id = session.execute(
+            select(func.count(EnergyConsumption.id), func.max(EnergyConsumption.id))).one()
+        solar_generation_count, solar_generation_last_id = session.execute(
+            select(func.count(SolarGeneration.id), func.max(SolarGeneration.id))).one()
 
         result = {
             "energy_consumption_count": energy_consumption_count,
-            "solar_generation_count": solar_generation_count
+            "solar_generation_count": solar_generation_count,
+            "energy_consumption_last_id": energy_consumption_last_id or 0,
+            "solar_generation_last_id": solar_generation_last_id or 0
         }
         logger.info("Count of events: %s", result)
         return jsonify(result), 200
@@ -291,48 +655,123 @@ def get_count():
     except Exception as e:
         logger.error("Error counting energy consumption events: %s", str(e))
         return {"error": "Internal server error"}, 500
+    finally:
+        session.close()
 
-def get_energy_consumption_event_ids():
+def get_energy_consumption_event_ids(prefix=None, after_id=None, up_to_id=None, since=None):
     """ Get all energy consumption event IDs """
+    return get_event_ids(EnergyConsumption, "energy consumption", prefix, after_id, up_to_id, since)
+
+def get_solar_generation_event_ids(prefix=None, after_id=None, up_to_id=None, since=None):
+    """ Get all solar generation event IDs """
+    return get_event_ids(SolarGeneration, "solar generation", prefix, after_id, up_to_id, since)
+
+def get_event_ids(model, event_name, prefix, after_id, up_to_id, since=None):
+    """
+    Event IDs and trace IDs of a table, only of the trace IDs starting with
+    prefix, or of the rows with an id greater than after_id (in id order) and
+    at most up_to_id, or with a date_created at or after since, when given
+    """
     session = DBSession()
     try:
-        statement = select(EnergyConsumption.id, EnergyConsumption.trace_id)
+        statement = select(model.id, model.trace_id)
+        if after_id is not None:
+            statement = statement.where(model.id > after_id, *ids_after_filters(session, model, after_id)).order_by(model.id)
+        if up_to_id is not None:
+            statement = statement.where(model.id <= up_to_id)
+        if since is not None:
+            statement = statement.where(model.date_created >= parse_event_timestamp(since))
+        if prefix:
+            # A range scan of the unique trace_id index
+            statement = statement.where(model.trace_id.like(f"{prefix}%"))
         results = session.execute(statement).all()
         ids = [
             {"event_id": str(row[0]), "trace_id": str(row[1])}
             for row in results
         ]
-        logger.info("Found %d energy consumption event IDs", len(ids))
+        logger.info("Found %d %s event IDs", len(ids), event_name)
         return jsonify(ids), 200
     except Exception as e:
-        logger.error("Error querying energy consumption event IDs: %s", str(e))
+        logger.error("Error querying %s event IDs: %s", event_name, str(e))
         return {"error": "Internal server error"}, 500
     finally:
         session.close()
 
-def get_solar_generation_event_ids():
-    """ Get all solar generation event IDs """
+def get_digests(event_type, prefix="", width=None, up_to_id=None, since=None):
+    """
+    Range digests of the trace IDs of a table: per bucket of the first `width`
+    hex digits of the trace IDs starting with prefix, the count and the XOR of
+    a 64-bit hash of each trace ID (the first 16 hex digits of its MD5), all
+    computed by the database. Only the rows with an id of at most up_to_id,
+    and with a date_created at or after since, when given.
+    """
+    model = DIGEST_MODELS[event_type]
+    width = len(prefix) + 1 if width is None else width
+    if not len(prefix) < width <= MAX_PREFIX_WIDTH:
+        return {"message": f"width must be between {len(prefix) + 1} and {MAX_PREFIX_WIDTH}"}, 400
+
+    bucket = func.left(model.trace_id, width).label("bucket")
+    trace_hash = cast(func.conv(func.left(func.md5(model.trace_id), 16), 16, 10), BIGINT(unsigned=True))
+    statement = select(bucket, func.count(model.id), func.bit_xor(trace_hash)).group_by(bucket).order_by(bucket)
+    if prefix:
+        statement = statement.where(model.trace_id.like(f"{prefix}%"))
+    if up_to_id is not None:
+        statement = statement.where(model.id <= up_to_id)
+    if since is not None:
+        statement = statement.where(model.date_created >= parse_event_timestamp(since))
+
+    session = DBSession()
+    try:
+        buckets = [
+            {"prefix": row[0], "count": row[1], "digest": f"{int(row[2]):016x}"}
+            for row in session.execute(statement)
+        ]
+        logger.info("Computed %d digests of %s trace IDs under prefix '%s'", len(buckets), event_type, prefix)
+        return jsonify({"prefix": prefix, "width": width, "buckets": buckets}), 200
+    except Exception as e:
+        logger.error("Error computing %s digests: %s", event_type, str(e))
+        return {"message": "Internal server error"}, 500
+    finally:
+        session.close()
+
+def get_trace(trace_id):
+    """
+    The event of a trace ID with its database id, found with the unique
+    (trace_id, date_created) index of each table
+    """
     session = DBSession()
     try:
-        statement = select(SolarGeneration.id, SolarGeneration.trace_id)  
-        results = session.execute(statement).all()  
-        ids = [  
-            {"event_id": str(row[0]), "trace_id": str(row[1])}  
-            for row in results  
-        ]  
-        logger.info("Found %d solar generation event IDs", len(ids))  
-        return jsonify(ids), 200  
-    except Exception as e:  
-        logger.error("Error querying solar generation event IDs: %s", str(e))  
-        return {"error": "Internal server error"}, 500  
-    finally:  
+        for event_type, model in DIGEST_MODELS.items():
+            row = session.execute(select(model).where(model.trace_id == trace_id).order_by(model.id)).scalars().first()
+            if row is not None:
+                event = row.to_dict()
+                logger.info("Found %s event %s for trace ID %s", event_type, row.id, trace_id)
+                return jsonify({"trace_id": trace_id, "event_type": event_type, "db_id": row.id, "event": event}), 200
+        logger.info("No event for trace ID %s", trace_id)
+        return {"message": f"No event with trace ID {trace_id}"}, 404
+    except Exception as e:
+        logger.error("Error looking up trace ID %s: %s", trace_id, str(e))
+        return {"message": "Internal server error"}, 500
+    finally:
         session.close()
-        
+
 # Create the Connexion app
+class StreamResponseBodyValidator(AbstractResponseBodyValidator):
+    """
+    Passes an NDJSON stream through unvalidated: the JSON response validator
+    would buffer the whole stream, then fail to parse it as one document
+    """
+    def wrap_send(self, send):
+        return send
+
+RESPONSE_VALIDATORS = MediaTypeDict({**VALIDATOR_MAP["response"], "application/x-ndjson": StreamResponseBodyValidator})
+
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yml", base_path="/storage", strict_validation=True, validate_responses=True)
+app.add_api("openapi.yml", base_path="/storage", strict_validation=True, validate_responses=True,
+            validator_map={"response": RESPONSE_VALIDATORS})
 
 if __name__ == "__main__":
     # Run the consumer in a separate thread
     setup_kafka_thread()
+    partition_maintainer.start()
     app.run(port=8090, host="0.0.0.0")
\ No newline at end of file
@@ -0,0 +1,159 @@
+"""
+Benchmark of the range queries of the storage service, comparing the old
+schema (VARCHAR dates, no indexes) with the migrated one (DATETIME columns
+and indexes). It creates two scratch tables in the storage database, fills
+them with generated readings and times the queries run by processing polls
+and device lookups. Usage (from the storage container or directory):
+
+    python bench_range_query.py --rows 20000000 [--runs 20] [--keep]
+
+Filling tens of millions of rows takes a while; pass --keep to reuse the
+tables on the next run.
+"""
+from dotenv import load_dotenv
+# Load environment variables from .env file
+load_dotenv()
+
+import argparse
+import random
+import statistics
+import time
+import uuid
+
+from migrate_tables import connect
+
+OLD_TABLE = "bench_energy_consumption_varchar"
+NEW_TABLE = "bench_energy_consumption_indexed"
+SEED_ROWS = 10000
+DEVICES = 1000
+DAYS = 30
+
+def create_tables(c):
+    c.execute(f'''
+              CREATE TABLE IF NOT EXISTS {NEW_TABLE} (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                device_id VARCHAR(250) NOT NULL,
+                timestamp DATETIME NOT NULL,
+                energy_consumed FLOAT NOT NULL,
+                voltage FLOAT NOT NULL,
+                date_created DATETIME NOT NULL,
+                trace_id VARCHAR(250) NOT NULL,
+                INDEX ix_bench_date_created (date_created),
+                INDEX ix_bench_device_id_timestamp (device_id, timestamp),
+                UNIQUE INDEX ux_bench_trace_id (trace_id)
+              )
+              ''')
+    c.execute(f'''
+              CREATE TABLE IF NOT EXISTS {OLD_TABLE} (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                device_id VARCHAR(250) NOT NULL,
+                timestamp VARCHAR(100) NOT NULL,
+                energy_consumed FLOAT NOT NULL,
+                voltage FLOAT NOT NULL,
+                date_created VARCHAR(100) NOT NULL,
+                trace_id VARCHAR(250) NOT NULL
+              )
+              ''')
+
+def fill_tables(conn, c, rows, devices):
+    """
+    Inserts SEED_ROWS generated readings spread over DAYS days, then doubles
+    the indexed table with INSERT ... SELECT (shifting the copies by a random
+    number of seconds) until it holds `rows` rows, and copies it into the
+    VARCHAR table.
+    """
+    c.execute(f"SELECT COUNT(*) FROM {NEW_TABLE}")
+    count = c.fetchone()[0]
+    if count >= rows:
+        print(f"Reusing {count} rows")
+        return
+    start = time.time()
+    if count == 0:
+        now = int(time.time())
+        values = []
+        for _ in range(SEED_ROWS):
+            created = now - random.randint(0, DAYS * 86400)
+            values.append((random.choice(devices), created - random.randint(0, 5), random.uniform(0, 100),
+                           random.uniform(200, 250), created, str(uuid.uuid4())))
+        c.executemany(f'''
+                      INSERT INTO {NEW_TABLE} (device_id, timestamp, energy_consumed, voltage, date_created, trace_id)
+                      VALUES (%s, FROM_UNIXTIME(%s), %s, %s, FROM_UNIXTIME(%s), %s)
+                      ''', values)
+        conn.commit()
+        count = SEED_ROWS
+    while count < rows:
+        c.execute(f'''
+                  INSERT INTO {NEW_TABLE} (device_id, timestamp, energy_consumed, voltage, date_created, trace_id)
+                  SELECT device_id,
+                         timestamp - INTERVAL FLOOR(RAND() * 86400 * {DAYS}) SECOND,
+                         energy_consumed, voltage,
+                         date_created - INTERVAL FLOOR(RAND() * 86400 * {DAYS}) SECOND,
+                         UUID()
+                  FROM {NEW_TABLE} LIMIT %s
+                  ''', (rows - count,))
+        conn.commit()
+        count += c.rowcount
+        print(f"{count} rows ({time.time() - start:.0f}s)")
+    c.execute(f"TRUNCATE TABLE {OLD_TABLE}")
+    c.execute(f'''
+              INSERT INTO {OLD_TABLE} (id, device_id, timestamp, energy_consumed, voltage, date_created, trace_id)
+              SELECT id, device_id, DATE_FORMAT(timestamp, '%Y-%m-%dT%H:%i:%sZ'),
+                     energy_consumed, voltage, DATE_FORMAT(date_created, '%Y-%m-%d %H:%i:%s.000000'), trace_id
+              FROM {NEW_TABLE}
+              ''')
+    conn.commit()
+    print(f"Filled both tables in {time.time() - start:.0f}s")
+
+def time_query(c, query, params_list):
+    """ Runs the query once per parameter tuple and returns (p50, p95, max) in ms """
+    latencies = []
+    for params in params_list:
+        start = time.perf_counter()
+        c.execute(query, params)
+        c.fetchall()
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.95) - 1], latencies[-1]
+
+def run(runs, c, devices):
+    now = int(time.time())
+    # A processing poll: the last few seconds of date_created
+    windows = [(now - offset - 5, now - offset) for offset in random.sample(range(0, DAYS * 86400), runs)]
+    device_windows = [(random.choice(devices), start - 3600, start) for start, _ in windows]
+    # The VARCHAR table is compared as strings, in the format each column was stored in
+    queries = [
+        ("date_created range (5s window)",
+         "SELECT * FROM {table} WHERE date_created >= {start} AND date_created < {end}",
+         "%%Y-%%m-%%d %%H:%%i:%%s", windows),
+        ("device_id + timestamp range (1h)",
+         "SELECT * FROM {table} WHERE device_id = %s AND timestamp >= {start} AND timestamp < {end}",
+         "%%Y-%%m-%%dT%%H:%%i:%%sZ", device_windows),
+    ]
+    print(f"{'query':<36}{'schema':<10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for name, query, varchar_format, params in queries:
+        varchar_bound = f"DATE_FORMAT(FROM_UNIXTIME(%s), '{varchar_format}')"
+        for schema, table, bound in [
+            ("varchar", OLD_TABLE, varchar_bound),
+            ("indexed", NEW_TABLE, "FROM_UNIXTIME(%s)"),
+        ]:
+            p50, p95, worst = time_query(c, query.format(table=table, start=bound, end=bound), params)
+            print(f"{name:<36}{schema:<10}{p50:>10.1f}{p95:>10.1f}{worst:>10.1f}")
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmark storage range queries before and after the index migration")
+    arg_parser.add_argument("--rows", type=int, default=20000000, help="rows in each scratch table")
+    arg_parser.add_argument("--runs", type=int, default=20, help="queries timed per case")
+    arg_parser.add_argument("--keep", action="store_true", help="keep the scratch tables after the run")
+    args = arg_parser.parse_args()
+
+    random.seed(42)
+    devices = [str(uuid.UUID(int=random.getrandbits(128))) for _ in range(DEVICES)]
+    conn = connect()
+    c = conn.cursor()
+    create_tables(c)
+    fill_tables(conn, c, args.rows, devices)
+    run(args.runs, c, devices)
+    if not args.keep:
+        c.execute(f"DROP TABLE {OLD_TABLE}")
+        c.execute(f"DROP TABLE {NEW_TABLE}")
+    conn.close()
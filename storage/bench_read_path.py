@@ -0,0 +1,101 @@
+"""
+Benchmark of the event range queries of the storage service in rows per
+second: the ORM path (model instances, to_dict() and jsonify) against the
+Core read path (row tuples serialized by orjson, read_path.py), with every
+field and with a projection. The rows are generated into an in-memory
+SQLite table, so the database side is the same for both and the numbers
+show the Python side the read path removes.
+
+    python bench_read_path.py [--rows 200000] [--runs 5]
+"""
+import argparse
+import datetime
+import random
+import time
+import uuid
+
+from flask import Flask
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.orm import Session
+
+import read_path
+from energy_consumption import EnergyConsumption
+
+PROJECTION = ("id", "timestamp", "energy_consumed")
+
+def fill_table(engine, rows):
+    """ Creates the energy_consumption table without its MySQL partitioning and fills it """
+    start = datetime.datetime(2025, 2, 23)
+    devices = [str(uuid.uuid4()) for _ in range(1000)]
+    with engine.begin() as connection:
+        connection.execute(text('''
+                                CREATE TABLE energy_consumption (
+                                  id INTEGER NOT NULL,
+                                  device_id VARCHAR(250) NOT NULL,
+                                  timestamp DATETIME NOT NULL,
+                                  energy_consumed FLOAT NOT NULL,
+                                  voltage FLOAT NOT NULL,
+                                  date_created DATETIME NOT NULL,
+                                  trace_id VARCHAR(250) NOT NULL,
+                                  PRIMARY KEY (id, date_created)
+                                )
+                                '''))
+        connection.execute(EnergyConsumption.__table__.insert(), [
+            {
+                "id": i + 1,
+                "device_id": random.choice(devices),
+                "timestamp": start + datetime.timedelta(seconds=i),
+                "energy_consumed": round(random.uniform(0, 50), 3),
+                "voltage": round(random.uniform(220, 240), 1),
+                "date_created": start + datetime.timedelta(seconds=i + 1),
+                "trace_id": str(uuid.uuid4())
+            }
+            for i in range(rows)
+        ])
+
+def orm_path(session, json_app):
+    """ The handler before the read path: select(model), to_dict(), jsonify """
+    results = [row.to_dict() for row in session.execute(select(EnergyConsumption).order_by(EnergyConsumption.id)).scalars().all()]
+    return json_app.json.dumps(results).encode("utf-8")
+
+def core_path(session, fields=None):
+    names = read_path.field_names(EnergyConsumption, fields)
+    rows = session.execute(read_path.select_fields(EnergyConsumption, names).order_by(EnergyConsumption.id)).all()
+    return read_path.dumps_rows(names, rows)
+
+def best_rate(rows, runs, query):
+    """ Rows per second of the fastest run, and the size of the response """
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        body = query()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return rows / best, len(body)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Compare the ORM and Core read paths of the storage range queries")
+    arg_parser.add_argument("--rows", type=int, default=200000, help="rows in the queried window")
+    arg_parser.add_argument("--runs", type=int, default=5, help="runs of each path, the fastest one counts")
+    args = arg_parser.parse_args()
+
+    engine = create_engine("sqlite://")
+    fill_table(engine, args.rows)
+    json_app = Flask(__name__)
+    paths = [
+        ("orm + jsonify", lambda: orm_path(session, json_app)),
+        ("core + orjson", lambda: core_path(session)),
+        (f"core, {','.join(PROJECTION)}", lambda: core_path(session, PROJECTION)),
+    ]
+    print(f"{'path':<40} {'rows/s':>12} {'bytes/row':>10}")
+    with Session(engine) as session, json_app.app_context():
+        baseline = None
+        for name, query in paths:
+            rate, size = best_rate(args.rows, args.runs, query)
+            baseline = baseline or rate
+            print(f"{name:<40} {rate:>12,.0f} {size / args.rows:>10.1f}  x{rate / baseline:.1f}")
+            # Objects of a run would otherwise be held by the identity map of the next one
+            session.expunge_all()
+
+if __name__ == "__main__":
+    main()
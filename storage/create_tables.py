@@ -33,6 +33,9 @@
 # conn.close()
 
 import MySQLdb  
+from partitions import ROLLUP_LOG_DDL, summary_table_ddl
+
+TABLES = ["energy_consumption", "solar_generation"]
 
 # Connect to the MySQL database  
 conn = MySQLdb.connect(  
@@ -45,29 +48,50 @@ conn = MySQLdb.connect(
 # Create a cursor object to execute SQL commands  
 c = conn.cursor()  
 
+# Partitioned by day of date_created: the storage service splits p_future
+# into the daily partitions of the coming days when it starts
 c.execute('''  
           CREATE TABLE IF NOT EXISTS energy_consumption (  
-            id INT AUTO_INCREMENT PRIMARY KEY,   
+            id INT AUTO_INCREMENT,   
             device_id VARCHAR(250) NOT NULL,   
-            timestamp VARCHAR(100) NOT NULL,   
+            timestamp DATETIME NOT NULL,   
             energy_consumed FLOAT NOT NULL,   
             voltage FLOAT NOT NULL,   
-            date_created VARCHAR(100) NOT NULL,
-            trace_id VARCHAR(250) NOT NULL
+            date_created DATETIME NOT NULL,
+            trace_id VARCHAR(250) NOT NULL,
+            INDEX ix_energy_consumption_date_created (date_created),
+            INDEX ix_energy_consumption_device_id_timestamp (device_id, timestamp),
+            PRIMARY KEY (id, date_created),
+            UNIQUE INDEX ux_energy_consumption_trace_id_date_created (trace_id, date_created)
+          )
+          PARTITION BY RANGE (TO_DAYS(date_created)) (
+            PARTITION p_future VALUES LESS THAN MAXVALUE
           )  
           ''')  
 
 c.execute('''  
           CREATE TABLE IF NOT EXISTS solar_generation (  
-            id INT AUTO_INCREMENT PRIMARY KEY,   
+            id INT AUTO_INCREMENT,   
             device_id VARCHAR(250) NOT NULL,   
-            timestamp VARCHAR(100) NOT NULL,   
+            timestamp DATETIME NOT NULL,   
             power_generated FLOAT NOT NULL,   
             temperature FLOAT NOT NULL,   
-            date_created VARCHAR(100) NOT NULL,
-            trace_id VARCHAR(250) NOT NULL  
+            date_created DATETIME NOT NULL,
+            trace_id VARCHAR(250) NOT NULL,
+            INDEX ix_solar_generation_date_created (date_created),
+            INDEX ix_solar_generation_device_id_timestamp (device_id, timestamp),
+            PRIMARY KEY (id, date_created),
+            UNIQUE INDEX ux_solar_generation_trace_id_date_created (trace_id, date_created)
+          )
+          PARTITION BY RANGE (TO_DAYS(date_created)) (
+            PARTITION p_future VALUES LESS THAN MAXVALUE
           )  
           ''')  
 
+# Hourly per-device summaries of the partitions dropped by the retention job
+for table in TABLES:
+    c.execute(summary_table_ddl(table))
+c.execute(ROLLUP_LOG_DDL)
+
 conn.commit()  
 conn.close()
\ No newline at end of file
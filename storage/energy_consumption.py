@@ -1,5 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime  
-from sqlalchemy.sql.functions import now  
+from sqlalchemy import Column, Integer, String, Float, DateTime, Index  
 from base import Base
 import datetime  
 
@@ -7,13 +6,19 @@ class EnergyConsumption(Base):
     """ Energy Consumption """  
 
     __tablename__ = "energy_consumption"  
+    __table_args__ = (
+        Index("ix_energy_consumption_date_created", "date_created"),
+        Index("ix_energy_consumption_device_id_timestamp", "device_id", "timestamp"),
+        # Partitioned on date_created, which every unique key has to include
+        Index("ux_energy_consumption_trace_id_date_created", "trace_id", "date_created", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)  
     device_id = Column(String(250), nullable=False)  # UUID format  
-    timestamp = Column(String(100), nullable=False)  
+    timestamp = Column(DateTime, nullable=False)  
     energy_consumed = Column(Float, nullable=False)  # in kWh  
     voltage = Column(Float, nullable=False)  # in volts  
-    date_created = Column(DateTime, nullable=False)
+    date_created = Column(DateTime, primary_key=True, nullable=False)
     trace_id = Column(String(250), nullable=False)  
 
     def __init__(self, device_id, timestamp, energy_consumed, voltage, trace_id):  
@@ -22,7 +27,7 @@ class EnergyConsumption(Base):
         self.timestamp = timestamp  
         self.energy_consumed = energy_consumed  
         self.voltage = voltage
-        self.date_created = datetime.datetime.now() # Set the date/time record is created
+        self.date_created = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) # Set the UTC date/time record is created
         self.trace_id = trace_id
 
     def to_dict(self):  
@@ -30,7 +35,7 @@ class EnergyConsumption(Base):
         dict = {}
         dict['id'] = self.id  
         dict['device_id'] = self.device_id  
-        dict['timestamp'] = self.timestamp  
+        dict['timestamp'] = self.timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")  
         dict['energy_consumed'] = self.energy_consumed  
         dict['voltage'] = self.voltage  
         dict['date_created'] = self.date_created
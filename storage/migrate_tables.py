@@ -0,0 +1,196 @@
+"""
+Migrates existing event tables to the indexed schema:
+- `timestamp` and `date_created` become DATETIME columns instead of VARCHAR
+- duplicate trace_ids are removed so trace_id can get a unique index
+- indexes on (date_created), (device_id, timestamp) and unique (trace_id)
+- daily RANGE partitions on date_created: the primary key becomes
+  (id, date_created) and the trace_id unique index (trace_id, date_created),
+  as every unique key of a partitioned table has to include date_created
+- the hourly summary tables the retention job rolls expired partitions into
+
+Each step checks the current schema first, so the script can be run again
+safely. Usage (from the storage container or the storage directory):
+
+    python migrate_tables.py [--chunk-size 50000] [--days-ahead 7]
+"""
+from dotenv import load_dotenv
+# Load environment variables from .env file
+load_dotenv()
+
+import argparse
+import datetime
+import os
+import time
+import yaml
+import MySQLdb
+
+from partitions import ROLLUP_LOG_DDL, daily_partitions, summary_table_ddl, utc_now
+
+TABLES = ["energy_consumption", "solar_generation"]
+
+def connect():
+    """ Connects to the storage database using the storage configuration """
+    with open('config/app_conf_dev.yml', 'r') as f:
+        db_config = yaml.safe_load(f.read())['datastore']
+    return MySQLdb.connect(
+        host=db_config['hostname'],
+        port=db_config['port'],
+        user=os.getenv('DB_USER'),
+        passwd=os.getenv('DB_PASSWORD'),
+        db=db_config['db']
+    )
+
+def column_type(c, table, column):
+    c.execute('''
+              SELECT DATA_TYPE FROM information_schema.COLUMNS
+              WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+              ''', (table, column))
+    row = c.fetchone()
+    return row[0].lower() if row else None
+
+def index_names(c, table):
+    c.execute('''
+              SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS
+              WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+              ''', (table,))
+    return {row[0] for row in c.fetchall()}
+
+def convert_timestamp(conn, c, table, chunk_size):
+    """
+    Converts the ISO 8601 strings of `timestamp` (e.g. 2025-01-09T12:00:00Z)
+    into a DATETIME column. The values are copied into a new column by id
+    ranges so no single transaction has to hold the whole table.
+    """
+    if column_type(c, table, 'timestamp') == 'datetime':
+        print(f"{table}.timestamp is already DATETIME")
+        return
+    if column_type(c, table, 'timestamp_dt') is None:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN timestamp_dt DATETIME NULL AFTER timestamp")
+
+    c.execute(f"SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM {table}")
+    min_id, max_id = c.fetchone()
+    for start in range(min_id, max_id + 1, chunk_size):
+        # Seconds precision, the offset is dropped: the receiver sends UTC times
+        c.execute(f'''
+                  UPDATE {table}
+                  SET timestamp_dt = CAST(LEFT(REPLACE(timestamp, 'T', ' '), 19) AS DATETIME)
+                  WHERE id >= %s AND id < %s
+                  ''', (start, start + chunk_size))
+        conn.commit()
+        print(f"{table}: converted timestamps of ids {start} to {min(start + chunk_size, max_id + 1) - 1}")
+
+    c.execute(f'''
+              ALTER TABLE {table}
+              DROP COLUMN timestamp,
+              CHANGE COLUMN timestamp_dt timestamp DATETIME NOT NULL
+              ''')
+    print(f"{table}.timestamp converted to DATETIME")
+
+def convert_date_created(c, table):
+    """ date_created holds `YYYY-MM-DD HH:MM:SS[.ffffff]` strings that MySQL casts directly """
+    if column_type(c, table, 'date_created') == 'datetime':
+        print(f"{table}.date_created is already DATETIME")
+        return
+    c.execute(f"ALTER TABLE {table} MODIFY COLUMN date_created DATETIME NOT NULL")
+    print(f"{table}.date_created converted to DATETIME")
+
+def remove_duplicate_trace_ids(conn, c, table, chunk_size):
+    """
+    Keeps the first row stored for each trace_id. trace_id has no index yet,
+    so a self-join on it would compare every pair of rows: the ids to keep
+    are collected with one GROUP BY into a temporary table instead, then the
+    other rows are deleted by id ranges, joined on that table's primary key.
+    """
+    c.execute(f"DROP TEMPORARY TABLE IF EXISTS {table}_first_ids")
+    c.execute(f'''
+              CREATE TEMPORARY TABLE {table}_first_ids (PRIMARY KEY (id))
+              SELECT MIN(id) AS id FROM {table} GROUP BY trace_id
+              ''')
+    c.execute(f"SELECT COUNT(*) FROM {table}_first_ids")
+    kept = c.fetchone()[0]
+    c.execute(f"SELECT COUNT(*), COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM {table}")
+    total, min_id, max_id = c.fetchone()
+    if kept < total:
+        for start in range(min_id, max_id + 1, chunk_size):
+            c.execute(f'''
+                      DELETE duplicate FROM {table} duplicate
+                      LEFT JOIN {table}_first_ids kept ON kept.id = duplicate.id
+                      WHERE duplicate.id >= %s AND duplicate.id < %s AND kept.id IS NULL
+                      ''', (start, start + chunk_size))
+            conn.commit()
+    c.execute(f"DROP TEMPORARY TABLE {table}_first_ids")
+    print(f"{table}: removed {total - kept} rows with a duplicate trace_id")
+
+def add_indexes(conn, c, table, chunk_size):
+    existing = index_names(c, table)
+    indexes = {
+        f"ix_{table}_date_created": "INDEX {name} (date_created)",
+        f"ix_{table}_device_id_timestamp": "INDEX {name} (device_id, timestamp)",
+        f"ux_{table}_trace_id": "UNIQUE INDEX {name} (trace_id)",
+    }
+    if f"ux_{table}_trace_id_date_created" in existing:
+        # Replaced when the table was partitioned
+        del indexes[f"ux_{table}_trace_id"]
+    missing = [definition.format(name=name) for name, definition in indexes.items() if name not in existing]
+    if not missing:
+        print(f"{table}: indexes already exist")
+        return
+    if f"ux_{table}_trace_id" not in existing:
+        remove_duplicate_trace_ids(conn, c, table, chunk_size)
+    # One ALTER so the table is only rebuilt once
+    c.execute(f"ALTER TABLE {table} " + ", ".join(f"ADD {definition}" for definition in missing))
+    print(f"{table}: added {len(missing)} indexes")
+
+def partition_table(c, table, days_ahead):
+    """
+    Partitions the table by day of date_created, from the day of its oldest
+    row to days_ahead days from today. Rebuilds the table, twice.
+    """
+    c.execute('''
+              SELECT COUNT(*) FROM information_schema.PARTITIONS
+              WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+              ''', (table,))
+    if c.fetchone()[0]:
+        print(f"{table} is already partitioned")
+        return
+    today = utc_now().date()
+    c.execute(f"SELECT MIN(date_created) FROM {table}")
+    oldest = c.fetchone()[0]
+    first_day = min(oldest.date(), today) if oldest else today
+    c.execute(f'''
+              ALTER TABLE {table}
+              DROP PRIMARY KEY,
+              ADD PRIMARY KEY (id, date_created),
+              DROP INDEX ux_{table}_trace_id,
+              ADD UNIQUE INDEX ux_{table}_trace_id_date_created (trace_id, date_created)
+              ''')
+    c.execute(f"ALTER TABLE {table} PARTITION BY RANGE (TO_DAYS(date_created)) "
+              f"({daily_partitions(first_day, today + datetime.timedelta(days=days_ahead))})")
+    print(f"{table}: partitioned by day from {first_day}")
+
+def create_summary_tables(c):
+    for table in TABLES:
+        c.execute(summary_table_ddl(table))
+    c.execute(ROLLUP_LOG_DDL)
+    print("Summary tables exist")
+
+def migrate(chunk_size, days_ahead):
+    conn = connect()
+    c = conn.cursor()
+    for table in TABLES:
+        start = time.time()
+        convert_timestamp(conn, c, table, chunk_size)
+        convert_date_created(c, table)
+        add_indexes(conn, c, table, chunk_size)
+        partition_table(c, table, days_ahead)
+        print(f"{table}: migrated in {time.time() - start:.1f}s")
+    create_summary_tables(c)
+    conn.commit()
+    conn.close()
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Migrate the event tables to partitioned DATETIME columns with indexes")
+    arg_parser.add_argument("--chunk-size", type=int, default=50000, help="rows converted or deduplicated per transaction")
+    arg_parser.add_argument("--days-ahead", type=int, default=7, help="daily partitions created after today")
+    args = arg_parser.parse_args()
+    migrate(args.chunk_size, args.days_ahead)
@@ -0,0 +1,272 @@
+"""
+Daily RANGE partitions of the event tables on TO_DAYS(date_created), and the
+retention job that rolls the expired partitions up into hourly per-device
+summary tables before dropping them. An expired partition is first
+exchanged into a staging table and dropped, so a late reading cannot land
+in it between the rollup and the drop.
+
+The last partition, p_future, holds every date past the daily partitions;
+it is split into new daily partitions ahead of time, while still empty, so
+the split does not copy rows. Tables that are not partitioned (not migrated
+yet) are left alone.
+"""
+import datetime
+import logging
+import time
+from threading import Thread
+
+from sqlalchemy import text
+
+logger = logging.getLogger('basicLogger')
+
+FUTURE_PARTITION = "p_future"
+ONE_DAY = datetime.timedelta(days=1)
+# MySQL TO_DAYS(d) is d.toordinal() + 365
+TO_DAYS_OFFSET = 365
+
+# Value columns of each table, summarized per device and hour by the rollup
+VALUE_COLUMNS = {
+    "energy_consumption": ("energy_consumed", "voltage"),
+    "solar_generation": ("power_generated", "temperature"),
+}
+
+def summary_table(table):
+    return f"{table}_hourly"
+
+def summary_table_ddl(table):
+    """CREATE TABLE of the hourly per-device summary of a table"""
+    columns = ",\n".join(
+        f"    {column}_min FLOAT NOT NULL,\n    {column}_max FLOAT NOT NULL,\n    {column}_sum DOUBLE NOT NULL"
+        for column in VALUE_COLUMNS[table]
+    )
+    return f'''
+CREATE TABLE IF NOT EXISTS {summary_table(table)} (
+    device_id VARCHAR(250) NOT NULL,
+    hour DATETIME NOT NULL,
+    count INT NOT NULL,
+{columns},
+    PRIMARY KEY (device_id, hour)
+)'''
+
+# Staging tables already rolled up, by partition name (with a _<n> suffix for a
+# later round), so one rolled up but not dropped yet is not counted twice
+ROLLUP_LOG_DDL = '''
+CREATE TABLE IF NOT EXISTS rollup_log (
+    table_name VARCHAR(64) NOT NULL,
+    partition_name VARCHAR(64) NOT NULL,
+    row_count INT NOT NULL,
+    date_created DATETIME NOT NULL,
+    PRIMARY KEY (table_name, partition_name)
+)'''
+
+def utc_now():
+    """Current UTC date/time as a naive datetime: date_created holds UTC times, so partition days are UTC days"""
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def partition_name(day):
+    return f"p{day:%Y%m%d}"
+
+def to_days(day):
+    return day.toordinal() + TO_DAYS_OFFSET
+
+def from_days(days):
+    return datetime.date.fromordinal(days - TO_DAYS_OFFSET)
+
+def daily_partitions(first_day, last_day):
+    """PARTITION definitions of each day from first_day to last_day, then p_future"""
+    definitions = []
+    day = first_day
+    while day <= last_day:
+        definitions.append(f"PARTITION {partition_name(day)} VALUES LESS THAN ({to_days(day + ONE_DAY)})")
+        day += ONE_DAY
+    definitions.append(f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE")
+    return ", ".join(definitions)
+
+def list_partitions(connection, table):
+    """
+    Returns: (name, first day, day after the last) of each partition in
+    order, None for the open ends; empty when the table is not partitioned
+    """
+    rows = connection.execute(text('''
+                                   SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS
+                                   WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL
+                                   ORDER BY PARTITION_ORDINAL_POSITION
+                                   '''), {"table": table}).all()
+    partitions = []
+    start = None
+    for name, description in rows:
+        end = None if description == "MAXVALUE" else from_days(int(description))
+        partitions.append((name, start, end))
+        start = end
+    return partitions
+
+def ensure_partitions(connection, table, today, days_ahead):
+    """Splits p_future into the daily partitions up to days_ahead days from today. Returns: number added"""
+    partitions = list_partitions(connection, table)
+    if not partitions:
+        logger.warning(f"{table} is not partitioned, run migrate_tables.py to partition it")
+        return 0
+    if partitions[-1][0] != FUTURE_PARTITION:
+        return 0
+    first_day = partitions[-1][1] or today
+    last_day = today + days_ahead * ONE_DAY
+    if first_day > last_day:
+        return 0
+    connection.execute(text(
+        f"ALTER TABLE {table} REORGANIZE PARTITION {FUTURE_PARTITION} INTO ({daily_partitions(first_day, last_day)})"
+    ))
+    return (last_day - first_day).days + 1
+
+def staging_table(table, key):
+    """Table holding the rows of an expired partition until they are rolled up"""
+    return f"{table}_expired_{key}"
+
+def staging_keys(connection, table):
+    """Rollup keys of the staging tables of a table left by an interrupted expiry"""
+    prefix = staging_table(table, "")
+    names = connection.execute(text('''
+                                    SELECT TABLE_NAME FROM information_schema.TABLES
+                                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME LIKE :pattern
+                                    ORDER BY TABLE_NAME
+                                    '''), {"pattern": f"{table}%"}).scalars().all()
+    return [name[len(prefix):] for name in names if name.startswith(prefix)]
+
+def rollup_key(connection, table, partition):
+    """
+    rollup_log key of the next rollup of a partition: its name, with a _<n>
+    suffix when readings that landed in it after an interrupted expiry are
+    rolled up again
+    """
+    rounds = connection.execute(text(
+        "SELECT COUNT(*) FROM rollup_log WHERE table_name = :table AND partition_name LIKE :pattern"
+    ), {"table": table, "pattern": f"{partition}%"}).scalar()
+    return f"{partition}_{rounds}" if rounds else partition
+
+def detach_partition(connection, table, partition, staging):
+    """
+    Moves the rows of a partition into a new staging table and drops the
+    partition. Both are metadata changes, made with the table locked so no
+    reading lands in the partition between the exchange and the drop.
+    """
+    connection.execute(text(f"CREATE TABLE {staging} LIKE {table}"))
+    connection.execute(text(f"ALTER TABLE {staging} REMOVE PARTITIONING"))
+    connection.execute(text(f"LOCK TABLES {table} WRITE, {staging} WRITE"))
+    try:
+        connection.execute(text(f"ALTER TABLE {table} EXCHANGE PARTITION {partition} WITH TABLE {staging}"))
+        connection.execute(text(f"ALTER TABLE {table} DROP PARTITION {partition}"))
+    finally:
+        connection.execute(text("UNLOCK TABLES"))
+
+def rollup_staging(connection, table, key):
+    """
+    Adds the readings of a staging table to the hourly per-device summaries,
+    in one transaction with its rollup_log entry, then drops the table.
+    Returns: rows rolled up, None if they were rolled up before the table
+    could be dropped
+    """
+    staging = staging_table(table, key)
+    logged = connection.execute(text(
+        "SELECT row_count FROM rollup_log WHERE table_name = :table AND partition_name = :partition"
+    ), {"table": table, "partition": key}).first()
+    row_count = None
+    if logged is None:
+        columns = VALUE_COLUMNS[table]
+        summary_columns = ", ".join(f"{column}_min, {column}_max, {column}_sum" for column in columns)
+        aggregates = ", ".join(f"MIN({column}), MAX({column}), SUM({column})" for column in columns)
+        updates = ", ".join(["count = count + VALUES(count)"] + [
+            f"{column}_min = LEAST({column}_min, VALUES({column}_min)), "
+            f"{column}_max = GREATEST({column}_max, VALUES({column}_max)), "
+            f"{column}_sum = {column}_sum + VALUES({column}_sum)"
+            for column in columns
+        ])
+        # Hours of the reading timestamps: an hour can span two partitions, so counts are added up
+        connection.execute(text(f'''
+                                INSERT INTO {summary_table(table)} (device_id, hour, count, {summary_columns})
+                                SELECT device_id, DATE_FORMAT(timestamp, '%Y-%m-%d %H:00:00') AS hour, COUNT(*), {aggregates}
+                                FROM {staging}
+                                GROUP BY device_id, hour
+                                ON DUPLICATE KEY UPDATE {updates}
+                                '''))
+        row_count = connection.execute(text(f"SELECT COUNT(*) FROM {staging}")).scalar()
+        connection.execute(text('''
+                                INSERT INTO rollup_log (table_name, partition_name, row_count, date_created)
+                                VALUES (:table, :partition, :row_count, :date_created)
+                                '''), {"table": table, "partition": key, "row_count": row_count,
+                                       "date_created": utc_now()})
+        connection.commit()
+    connection.execute(text(f"DROP TABLE {staging}"))
+    return row_count
+
+def expire_partitions(connection, table, today, retention_days):
+    """
+    Detaches the partitions whose days are all older than retention_days
+    into staging tables, then rolls those up and drops them. The staging
+    tables of an interrupted run are rolled up first.
+    Returns: the partitions dropped
+    """
+    for key in staging_keys(connection, table):
+        row_count = rollup_staging(connection, table, key)
+        logger.info(f"Rolled up the staging table {staging_table(table, key)} of an interrupted expiry"
+                    + (f": {row_count} readings" if row_count is not None else " (already rolled up)"))
+    cutoff = today - retention_days * ONE_DAY
+    dropped = []
+    for name, _, end in list_partitions(connection, table):
+        if name == FUTURE_PARTITION or end is None or end > cutoff:
+            continue
+        key = rollup_key(connection, table, name)
+        detach_partition(connection, table, name, staging_table(table, key))
+        row_count = rollup_staging(connection, table, key)
+        logger.info(f"Dropped partition {table}.{name} after rolling up {row_count} readings")
+        dropped.append(name)
+    return dropped
+
+def first_day_with_ids_after(connection, table, after_id):
+    """
+    Start of the oldest partition holding an id greater than after_id, found
+    with one probe of the id index of each partition, so a query for the ids
+    past a watermark can be pruned to the partitions from that day on.
+    Returns: a datetime, or None when every partition has to be read
+    """
+    partitions = list_partitions(connection, table)
+    if not partitions:
+        return None
+    probes = " UNION ALL ".join(
+        f"SELECT {position} AS position, MAX(id) AS last_id FROM {table} PARTITION ({name})"
+        for position, (name, _, _) in enumerate(partitions)
+    )
+    positions = [position for position, last_id in connection.execute(text(probes)) if last_id is not None and last_id > after_id]
+    # No newer id anywhere: only the newest partitions can get one
+    start = partitions[min(positions)][1] if positions else partitions[-1][1]
+    return datetime.datetime.combine(start, datetime.time()) if start is not None else None
+
+class PartitionMaintainer(Thread):
+    """
+    Every interval: adds the daily partitions of the coming days, and rolls up
+    then drops the partitions past the retention period, for each table
+    """
+    def __init__(self, engine, tables, days_ahead, retention_days, interval, stop_event):
+        super().__init__(name="partition-maintainer", daemon=True)
+        self.engine = engine
+        self.tables = tables
+        self.days_ahead = days_ahead
+        self.retention_days = retention_days
+        self.interval = interval
+        self.stop_event = stop_event
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.maintain()
+            except Exception as e:
+                logger.error(f"Partition maintenance failed: {e}")
+            self.stop_event.wait(self.interval)
+
+    def maintain(self):
+        today = utc_now().date()
+        for table in self.tables:
+            start = time.time()
+            with self.engine.connect() as connection:
+                added = ensure_partitions(connection, table, today, self.days_ahead)
+                dropped = expire_partitions(connection, table, today, self.retention_days)
+            if added or dropped:
+                logger.info(f"{table}: added {added} daily partitions, dropped {len(dropped)} in {time.time() - start:.1f}s")
@@ -0,0 +1,40 @@
+"""
+ORM-free read path of the event range queries: Core SELECTs of only the
+fields asked for, serialized by orjson straight from the row tuples,
+without building a model instance and a to_dict() per row.
+"""
+import orjson
+from sqlalchemy import select
+
+from energy_consumption import EnergyConsumption
+from solar_generation import SolarGeneration
+
+# Fields of each table, in the order of to_dict()
+FIELDS = {
+    EnergyConsumption: ("id", "device_id", "timestamp", "energy_consumed", "voltage", "date_created", "trace_id"),
+    SolarGeneration: ("id", "device_id", "timestamp", "power_generated", "temperature", "date_created", "trace_id")
+}
+# The naive DATETIME columns hold UTC times: rendered as 2025-01-09T12:00:00Z
+JSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+
+def field_names(model, fields=None):
+    """ The fields asked for in to_dict() order, all of them when none are """
+    if not fields:
+        return FIELDS[model]
+    return tuple(name for name in FIELDS[model] if name in fields)
+
+def select_fields(model, names):
+    """
+    SELECT of the fields, then of the id: the keyset cursor of the next page,
+    left out of the JSON by dumps_rows() and dumps_lines() as it has no name
+    """
+    return select(*(getattr(model, name) for name in names), model.id)
+
+def dumps_rows(names, rows):
+    """ JSON array of the rows, one object per row """
+    return orjson.dumps([dict(zip(names, row)) for row in rows], option=JSON_OPTIONS)
+
+def dumps_lines(names, rows):
+    """ NDJSON of the rows, one object per line """
+    option = JSON_OPTIONS | orjson.OPT_APPEND_NEWLINE
+    return b"".join(orjson.dumps(dict(zip(names, row)), option=option) for row in rows)
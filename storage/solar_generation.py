@@ -1,18 +1,24 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime  
-from sqlalchemy.sql.functions import now  
+from sqlalchemy import Column, Integer, String, Float, DateTime, Index  
 from base import Base  
+import datetime  
 
 class SolarGeneration(Base):  
     """ Solar Generation """  
 
     __tablename__ = "solar_generation"  
+    __table_args__ = (
+        Index("ix_solar_generation_date_created", "date_created"),
+        Index("ix_solar_generation_device_id_timestamp", "device_id", "timestamp"),
+        # Partitioned on date_created, which every unique key has to include
+        Index("ux_solar_generation_trace_id_date_created", "trace_id", "date_created", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)  
     device_id = Column(String(250), nullable=False)  # UUID format  
-    timestamp = Column(String(100), nullable=False)  
+    timestamp = Column(DateTime, nullable=False)  
     power_generated = Column(Float, nullable=False)  # in kWh  
     temperature = Column(Float, nullable=False)  # in degrees Celsius  
-    date_created = Column(DateTime, nullable=False)
+    date_created = Column(DateTime, primary_key=True, nullable=False)
     trace_id = Column(String(250), nullable=False)
 
     def __init__(self, device_id, timestamp, power_generated, temperature, trace_id):  
@@ -21,7 +27,7 @@ class SolarGeneration(Base):
         self.timestamp = timestamp  
         self.power_generated = power_generated  
         self.temperature = temperature
-        self.date_created = now() # Set the date/time record is created
+        self.date_created = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) # Set the UTC date/time record is created
         self.trace_id = trace_id
 
     def to_dict(self):  
@@ -29,7 +35,7 @@ class SolarGeneration(Base):
         dict = {}
         dict["id"] = self.id  
         dict["device_id"] = self.device_id  
-        dict["timestamp"] = self.timestamp
+        dict["timestamp"] = self.timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
         dict["power_generated"] = self.power_generated  
         dict["temperature"] = self.temperature
         dict["date_created"] = self.date_created
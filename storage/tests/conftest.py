@@ -0,0 +1,71 @@
+"""
+Imports the storage app against the configuration of config/storage, with
+its log files in a temporary directory, and serves its queries from an
+in-memory SQLite copy of the event tables instead of MySQL. The Kafka
+consumers and the partition maintenance are not started.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+import yaml
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_DIR = os.path.join(os.path.dirname(SERVICE_DIR), "config", "storage")
+
+def load_app():
+    work_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(work_dir, "config"))
+    shutil.copy(os.path.join(CONFIG_DIR, "app_conf_dev.yml"), os.path.join(work_dir, "config"))
+    with open(os.path.join(CONFIG_DIR, "log_conf_dev.yml")) as f:
+        log_config = yaml.safe_load(f)
+    for handler in log_config["handlers"].values():
+        if "filename" in handler:
+            handler["filename"] = os.path.join(work_dir, os.path.basename(handler["filename"]))
+    # Only to the log files: the console stream is closed before the atexit handlers log
+    for logger_config in [log_config["root"], *log_config.get("loggers", {}).values()]:
+        logger_config["handlers"] = [name for name in logger_config["handlers"] if name != "console"]
+    with open(os.path.join(work_dir, "config", "log_conf_dev.yml"), "w") as f:
+        yaml.safe_dump(log_config, f)
+
+    sys.path.insert(0, SERVICE_DIR)
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        import app
+    finally:
+        os.chdir(cwd)
+    return app
+
+storage_app = load_app()
+
+# The event tables without their MySQL partitioning and autoincrement
+TABLE_DDL = '''
+CREATE TABLE {table} (
+  id INTEGER NOT NULL,
+  device_id VARCHAR(250) NOT NULL,
+  timestamp DATETIME NOT NULL,
+  {first} FLOAT NOT NULL,
+  {second} FLOAT NOT NULL,
+  date_created DATETIME NOT NULL,
+  trace_id VARCHAR(250) NOT NULL,
+  PRIMARY KEY (id, date_created)
+)'''
+
+@pytest.fixture
+def db(monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    with engine.begin() as connection:
+        connection.execute(text(TABLE_DDL.format(table="energy_consumption", first="energy_consumed", second="voltage")))
+        connection.execute(text(TABLE_DDL.format(table="solar_generation", first="power_generated", second="temperature")))
+    monkeypatch.setattr(storage_app, "DBSession", sessionmaker(bind=engine))
+    return engine
+
+@pytest.fixture
+def client(db):
+    return storage_app.app.test_client()
@@ -0,0 +1,12 @@
+from test_events import add_readings
+
+def test_aggregate_up_to_id_reports_head(client, db):
+    add_readings(db, 3)
+    response = client.get("/storage/aggregates/energy-consumption", params={"up_to_id": 2})
+
+    assert response.status_code == 200
+    aggregate = response.json()
+    assert aggregate["count"] == 2
+    assert aggregate["last_id"] == 2
+    assert aggregate["head_id"] == 3
+    assert aggregate["energy_consumed"]["max"] == 6.5
@@ -0,0 +1,29 @@
+from sqlalchemy.orm import Session
+
+import app as storage_app
+from test_events import add_readings
+
+class ClosingSession(Session):
+    """ A session that records its close() """
+    def __init__(self, bind, closed):
+        super().__init__(bind=bind)
+        self.closed = closed
+
+    def close(self):
+        self.closed.append(True)
+        super().close()
+
+def test_count_closes_its_session(client, db, monkeypatch):
+    add_readings(db, 3)
+    closed = []
+    monkeypatch.setattr(storage_app, "DBSession", lambda: ClosingSession(db, closed))
+    response = client.get("/storage/count")
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "energy_consumption_count": 3,
+        "solar_generation_count": 0,
+        "energy_consumption_last_id": 3,
+        "solar_generation_last_id": 0
+    }
+    assert closed == [True]
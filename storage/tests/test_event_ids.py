@@ -0,0 +1,11 @@
+from test_events import add_readings
+
+def test_event_ids_since(client, db):
+    add_readings(db, 3)
+    response = client.get("/storage/event-ids/energy-consumption", params={"since": "2025-01-09T12:00:02Z"})
+
+    assert response.status_code == 200
+    assert response.json() == [
+        {"event_id": "2", "trace_id": "00000000-0000-0000-0000-000000000001"},
+        {"event_id": "3", "trace_id": "00000000-0000-0000-0000-000000000002"}
+    ]
@@ -0,0 +1,53 @@
+import datetime
+
+import orjson
+from energy_consumption import EnergyConsumption
+
+WINDOW = {"start_timestamp": "2025-01-09T00:00:00Z", "end_timestamp": "2025-01-10T00:00:00Z"}
+
+def add_readings(db, count):
+    start = datetime.datetime(2025, 1, 9, 12)
+    with db.begin() as connection:
+        connection.execute(EnergyConsumption.__table__.insert(), [
+            {
+                "id": i + 1,
+                "device_id": "123e4567-e89b-12d3-a456-426614174000",
+                "timestamp": start + datetime.timedelta(seconds=i),
+                "energy_consumed": 5.5 + i,
+                "voltage": 230.5,
+                "date_created": start + datetime.timedelta(seconds=i + 1),
+                "trace_id": f"00000000-0000-0000-0000-{i:012d}"
+            }
+            for i in range(count)
+        ])
+
+def test_ndjson_streams_one_event_per_line(client, db):
+    add_readings(db, 3)
+    response = client.get("/storage/events/energy-consumption", params={**WINDOW, "format": "ndjson"})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    events = [orjson.loads(line) for line in response.text.splitlines()]
+    assert [event["id"] for event in events] == [1, 2, 3]
+    assert events[0]["timestamp"] == "2025-01-09T12:00:00Z"
+    assert events[2]["energy_consumed"] == 7.5
+
+def test_json_page_with_fields(client, db):
+    add_readings(db, 3)
+    response = client.get("/storage/events/energy-consumption",
+                          params={**WINDOW, "limit": 2, "fields": "timestamp,energy_consumed"})
+
+    assert response.status_code == 200
+    assert response.json() == [
+        {"timestamp": "2025-01-09T12:00:00Z", "energy_consumed": 5.5},
+        {"timestamp": "2025-01-09T12:00:01Z", "energy_consumed": 6.5}
+    ]
+    assert response.headers["x-next-after-id"] == "2"
+
+def test_window_with_an_offset_is_read_as_utc(client, db):
+    add_readings(db, 3)
+    response = client.get("/storage/events/energy-consumption",
+                          params={"start_timestamp": "2025-01-09T14:00:02+02:00", "end_timestamp": "2025-01-09T14:00:04+02:00"})
+
+    assert response.status_code == 200
+    assert [event["id"] for event in response.json()] == [2, 3]
@@ -0,0 +1,181 @@
+"""
+Wire format of the Kafka event messages.
+
+Messages are either the JSON envelope {"type", "datetime", "payload"}
+encoded as UTF-8, or a compact struct-packed binary encoding of the same
+envelope:
+
+    magic (1 byte, 0xEB)  version (1 byte)  type code (1 byte)  body
+
+The body of version 1 is, big-endian:
+
+    datetime      int64    seconds since 1970-01-01 of the (naive) envelope datetime
+    device_id     16 bytes UUID
+    trace_id      16 bytes UUID
+    uuid          16 bytes UUID
+    timestamp     int64    microseconds since the epoch of the UTC timestamp (ending in Z)
+    2 readings    float64  the two readings of the event type, in SCHEMAS order
+
+A JSON message always starts with "{" (or whitespace), never with the
+magic byte, so decode() reads both and consumers stay compatible with
+the JSON messages already in the topic. An event that the binary schema
+cannot represent exactly (not a UUID, a timestamp with an offset, an
+extra field) is encoded as JSON.
+
+This module is copied in every service that reads or writes events: keep
+the copies identical, and add a new version rather than changing one.
+"""
+import json
+import struct
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+MAGIC = 0xEB
+# Offsets of the envelope datetime, event id and trace id in a version 1 message
+SENT_AT = 3
+TRACE_ID_AT = SENT_AT + 8 + 16
+EVENT_ID_AT = TRACE_ID_AT + 16
+VERSION = 1
+HEADER = struct.Struct('>BBB')
+BODY_V1 = struct.Struct('>q16s16s16sqdd')
+SENT = struct.Struct('>q')
+
+# Type code -> (event type, the two readings of its payload)
+SCHEMAS = {
+    1: ("energy-consumption", ("energy_consumed", "voltage")),
+    2: ("solar-generation", ("power_generated", "temperature")),
+}
+TYPE_CODES = {event_type: code for code, (event_type, _) in SCHEMAS.items()}
+
+FORMATS = ("json", "binary")
+EPOCH = datetime(1970, 1, 1)
+SECOND = timedelta(seconds=1)
+MICROSECOND = timedelta(microseconds=1)
+
+def encode(msg, format="json"):
+    """Serializes a message envelope in a format, JSON when binary cannot represent it exactly"""
+    if format == "binary":
+        encoded = encode_binary(msg)
+        if encoded is not None:
+            return encoded
+    return json.dumps(msg).encode('utf-8')
+
+def encode_binary(msg):
+    """Returns: the binary encoding of a message envelope, or None if it does not fit the schema"""
+    code = TYPE_CODES.get(msg.get("type"))
+    if code is None:
+        return None
+    readings = SCHEMAS[code][1]
+    payload = msg.get("payload")
+    if not isinstance(payload, dict) or set(payload) != {"device_id", "timestamp", "trace_id", "uuid", *readings}:
+        return None
+    try:
+        sent = datetime.fromisoformat(msg["datetime"])
+        timestamp = payload["timestamp"]
+        parsed = datetime.fromisoformat(timestamp[:-1])
+        # Only the forms decode() renders back identically
+        if (sent.isoformat() != msg["datetime"] or sent.microsecond
+                or timestamp[-1] != "Z" or parsed.isoformat() != timestamp[:-1]):
+            return None
+        values = [payload[key] for key in readings]
+        if any(isinstance(value, bool) or not isinstance(value, (int, float)) for value in values):
+            return None
+        return HEADER.pack(MAGIC, VERSION, code) + BODY_V1.pack(
+            (sent - EPOCH) // SECOND,
+            uuid_bytes(payload["device_id"]),
+            uuid_bytes(payload["trace_id"]),
+            uuid_bytes(payload["uuid"]),
+            (parsed - EPOCH) // MICROSECOND,
+            *map(float, values)
+        )
+    except (KeyError, ValueError, TypeError, AttributeError, OverflowError, struct.error):
+        return None
+
+def decode(value):
+    """
+    Decodes a message of either format into its envelope dict.
+    Raises: ValueError if the message is malformed or of an unknown version
+    """
+    if not value or value[0] != MAGIC:
+        return json.loads(value.decode('utf-8'))
+    if len(value) < HEADER.size:
+        raise ValueError("Truncated binary message")
+    _, version, code = HEADER.unpack_from(value)
+    if version != 1:
+        raise ValueError(f"Unknown binary message version {version}")
+    if code not in SCHEMAS:
+        raise ValueError(f"Unknown binary event type code {code}")
+    event_type, readings = SCHEMAS[code]
+    try:
+        sent, device_id, trace_id, event_id, timestamp, first, second = BODY_V1.unpack_from(value, HEADER.size)
+    except struct.error as e:
+        raise ValueError(f"Malformed binary message: {e}")
+    return {
+        "type": event_type,
+        "datetime": format_seconds(sent),
+        "payload": {
+            "device_id": format_uuid(device_id),
+            "timestamp": format_timestamp(timestamp),
+            readings[0]: first,
+            readings[1]: second,
+            "trace_id": format_uuid(trace_id),
+            "uuid": format_uuid(event_id)
+        }
+    }
+
+def decode_ids(value):
+    """
+    Event type, event id and trace id (16 bytes each) and envelope datetime
+    (seconds since the epoch) of a binary message, read without decoding the
+    rest. Returns: None for a JSON message
+    Raises: ValueError if the message is malformed or of an unknown version
+    """
+    if not value or value[0] != MAGIC:
+        return None
+    if len(value) < HEADER.size + BODY_V1.size:
+        raise ValueError("Truncated binary message")
+    _, version, code = HEADER.unpack_from(value)
+    if version != 1:
+        raise ValueError(f"Unknown binary message version {version}")
+    if code not in SCHEMAS:
+        raise ValueError(f"Unknown binary event type code {code}")
+    return (SCHEMAS[code][0], bytes(value[EVENT_ID_AT:EVENT_ID_AT + 16]), bytes(value[TRACE_ID_AT:TRACE_ID_AT + 16]),
+            SENT.unpack_from(value, SENT_AT)[0])
+
+def uuid_bytes(value):
+    """16 bytes of a UUID in its canonical form. Raises: ValueError for any other string"""
+    encoded = bytes.fromhex(value.replace("-", ""))
+    if len(encoded) != 16 or format_uuid(encoded) != value:
+        raise ValueError(f"Not a canonical UUID: {value!r}")
+    return encoded
+
+def datetime_seconds(value):
+    """
+    Seconds since the epoch of an ISO 8601 datetime string, such as an
+    envelope datetime; one with an offset is converted to UTC first.
+    Raises: ValueError, TypeError
+    """
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return (parsed - EPOCH) // SECOND
+
+def format_uuid(value):
+    """Canonical string of 16 UUID bytes, as str(uuid.UUID(bytes=value)) but faster"""
+    h = value.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+@lru_cache(maxsize=4096)
+def format_seconds(seconds):
+    """
+    ISO 8601 form of seconds since the epoch. Cached: the events of a batch
+    share their envelope datetime and mostly their reading second
+    """
+    return (EPOCH + timedelta(seconds=seconds)).isoformat()
+
+def format_timestamp(value):
+    """Renders microseconds since the epoch as the UTC timestamp (ending in Z) they were parsed from"""
+    seconds, fraction = divmod(value, 1000000)
+    if fraction:
+        return f"{format_seconds(seconds)}.{fraction:06d}Z"
+    return f"{format_seconds(seconds)}Z"